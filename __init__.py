@@ -2,14 +2,17 @@ import sys
 import os
 import traceback
 import anki
-import aqt
 import logging
 import pprint
 
 if hasattr(sys, '_pytest_mode'):
     # called from within a test run
     pass
+elif 'aqt' not in sys.modules:
+    # imported outside of Anki, by the headless runner (python -m <addon directory>.headless), which doesn't use the GUI
+    pass
 else:
+    import aqt
     # setup sentry crash reporting
     # ============================
 
@@ -89,7 +92,8 @@ else:
 
     ankiutils = anki_utils.AnkiUtils()
     deckutils = deck_utils.DeckUtils(ankiutils)
-    cloud_language_tools = cloudlanguagetools.CloudLanguageTools()
+    http_pool_size = aqt.mw.addonManager.getConfig(__name__).get(constants.CONFIG_HTTP_POOL_SIZE, constants.DEFAULT_HTTP_POOL_SIZE)
+    cloud_language_tools = cloudlanguagetools.CloudLanguageTools(pool_size=http_pool_size)
     languagetools = languagetools.LanguageTools(ankiutils, deckutils, cloud_language_tools)
     gui.init(languagetools)
     editor.init(languagetools)
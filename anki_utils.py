@@ -2,10 +2,12 @@ import sys
 import aqt
 import anki.template
 import anki.sound
+import anki.utils
 import logging
 import sentry_sdk
 import aqt.qt
 from . import constants    
+from . import field_sampler
 
     
 class AnkiUtils():
@@ -48,25 +50,23 @@ class AnkiUtils():
             filename = file_list[0]
             aqt.sound.av_player.play_file(filename)
 
+    def get_collection_key(self):
+        # identifies the collection of the current profile
+        return aqt.mw.col.path
+
     def get_deckid_modelid_pairs(self):
         return aqt.mw.col.db.all("select did, mid from notes inner join cards on notes.id = cards.nid group by mid, did")
 
     def get_noteids_for_deck_note_type(self, deck_id, model_id, sample_size):
-        sql_query = f'SELECT notes.id FROM notes INNER JOIN cards ON notes.id = cards.nid WHERE notes.mid={model_id} AND cards.did={deck_id} ORDER BY RANDOM() LIMIT {sample_size}'
-
-        note_id_result = aqt.mw.col.db.all(sql_query)
-        note_ids = []
-        query_strings = []
-        for entry in note_id_result:
-            note_id = entry[0]
-            note_ids.append(note_id)
-
-        return note_ids
+        return field_sampler.sample_note_ids(aqt.mw.col.db.all, deck_id, model_id, sample_size)
 
     def get_note_by_id(self, note_id):
         note = aqt.mw.col.getNote(note_id)
         return note
 
+    def get_field_values_for_notes(self, note_id_list, field_name_list):
+        return field_sampler.get_field_values_for_notes(aqt.mw.col.db.all, self.get_model, note_id_list, field_name_list)
+
     def get_model(self, model_id):
         return aqt.mw.col.models.get(model_id)
 
@@ -161,6 +161,13 @@ class AnkiUtils():
     def update_note(self, note):
         aqt.mw.col.update_note(note)
 
+    def update_notes(self, notes):
+        # one backend call and database transaction per chunk, instead of one per note. the undo entries
+        # of each chunk get merged into the custom undo entry by undo_end, so this is still a single undo step
+        chunk_size = constants.NOTE_UPDATE_CHUNK_SIZE
+        for chunk_start in range(0, len(notes), chunk_size):
+            aqt.mw.col.update_notes(notes[chunk_start:chunk_start + chunk_size])
+
     def display_dialog(self, dialog):
         return dialog.exec()
 
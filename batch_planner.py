@@ -0,0 +1,175 @@
+import sys
+import math
+import logging
+
+if hasattr(sys, '_pytest_mode'):
+    import constants
+    import errors
+    import rules_engine
+else:
+    from . import constants
+    from . import errors
+    from . import rules_engine
+
+# dry run of a batch job (batch translation / transliteration, add audio, run rules). the selected notes are read
+# with the bulk field loader and go through the same text processing as the real job, nothing gets sent to the server.
+# the job is described as a list of rules, in the rules_engine format.
+
+def new_plan_entry(rule):
+    return {
+        'action': rule['action'],
+        'service': None,
+        'notes': 0,
+        'empty': 0,
+        'duplicates': 0,
+        'cached': 0,
+        'requests': 0,
+        'characters': 0,
+        'estimated_seconds': 0,
+        'latency_measured': False,
+        # for rules reading the output of another rule, the text isn't known in advance
+        'output_of': None,
+        'error': None
+    }
+
+class BatchPlanner():
+    def __init__(self, languagetools):
+        self.languagetools = languagetools
+
+    def plan(self, deck_note_type, rule_list, note_id_list):
+        # returns a dict: notes, entries (one per rule), requests, characters, estimated_seconds
+        # same order as the rules engine
+        ordered_rule_list = [rule for rule_stage in rules_engine.get_rule_stages(rule_list) for rule in rule_stage]
+
+        entries = {} # by action
+        states = {} # by action, distinct processed texts
+        upstream_rules = {} # by action, for rules reading the output of a rule which runs before them
+        direct_rule_list = []
+        written_by = {}
+        for rule in ordered_rule_list:
+            entry = new_plan_entry(rule)
+            entries[rule['action']] = entry
+            if rule['from_field'] in written_by:
+                upstream_rules[rule['action']] = written_by[rule['from_field']]
+            written_by[rule['to_field']] = rule
+            try:
+                rule = self.resolve_option(deck_note_type, rule)
+            except errors.LanguageToolsError as e:
+                entry['error'] = str(e)
+                continue
+            entry['service'] = rule['option'].get('service')
+            if rule['action'] not in upstream_rules:
+                states[rule['action']] = set()
+                direct_rule_list.append(rule)
+
+        # read the source fields of all the rules at once, one segment of notes at a time
+        field_name_list = list(set([rule['from_field'] for rule in direct_rule_list]))
+        segment_size = constants.NOTE_QUERY_CHUNK_SIZE
+        for segment_start in range(0, len(note_id_list), segment_size):
+            segment_note_id_list = note_id_list[segment_start:segment_start + segment_size]
+            field_values = self.languagetools.anki_utils.get_field_values_for_notes(segment_note_id_list, field_name_list)
+            for rule in direct_rule_list:
+                entry = entries[rule['action']]
+                distinct_texts = states[rule['action']]
+                for note_id in segment_note_id_list:
+                    entry['notes'] += 1
+                    processed_text = self.languagetools.text_utils.process(field_values.get(note_id, {}).get(rule['from_field'], ''), rule['type'])
+                    if self.languagetools.text_utils.is_processed_empty(processed_text):
+                        entry['empty'] += 1
+                    elif processed_text in distinct_texts:
+                        entry['duplicates'] += 1
+                    else:
+                        distinct_texts.add(processed_text)
+                        if self.is_cached(rule, processed_text):
+                            entry['cached'] += 1
+                        else:
+                            entry['characters'] += len(processed_text)
+
+        for rule in direct_rule_list:
+            entry = entries[rule['action']]
+            self.estimate_requests(rule, entry, len(states[rule['action']]) - entry['cached'])
+
+        # rules reading a field written by another rule: one request per distinct output of that rule, at most
+        for rule in ordered_rule_list:
+            entry = entries[rule['action']]
+            if entry['error'] != None or rule['action'] in states:
+                continue
+            upstream_rule = upstream_rules[rule['action']]
+            upstream_entry = entries[upstream_rule['action']]
+            entry['output_of'] = upstream_rule['action']
+            entry['notes'] = len(note_id_list)
+            entry['empty'] = upstream_entry['empty']
+            entry['duplicates'] = upstream_entry['duplicates']
+            entry['characters'] = None
+            self.estimate_requests(self.resolve_option(deck_note_type, rule), entry, upstream_entry['notes'] - upstream_entry['empty'] - upstream_entry['duplicates'])
+
+        entry_list = [entries[rule['action']] for rule in rule_list]
+        plan = {
+            'notes': len(note_id_list),
+            'entries': entry_list,
+            'requests': sum([entry['requests'] for entry in entry_list]),
+            'characters': sum([entry['characters'] for entry in entry_list if entry['characters'] != None]),
+            'estimated_seconds': sum([entry['estimated_seconds'] for entry in entry_list])
+        }
+        logging.info(f'batch plan: {plan}')
+        return plan
+
+    def resolve_option(self, deck_note_type, rule):
+        # audio rules stored for a Deck / Note Type use the voice selected for the language of their from field
+        if rule['type'] == constants.TransformationType.Audio and rule['option'] == None:
+            from_dntf = self.languagetools.deck_utils.build_dntf_from_dnt(deck_note_type, rule['from_field'])
+            return dict(rule, option=self.languagetools.get_voice_for_field(from_dntf))
+        return rule
+
+    def is_cached(self, rule, processed_text):
+        option = rule['option']
+        if rule['type'] == constants.TransformationType.Audio:
+            hash_str = self.languagetools.get_hash_for_audio_request(processed_text, option['service'], option['voice_key'], {})
+            return self.languagetools.audio_cache.contains(hash_str)
+        return self.languagetools.translation_cache.contains(rule['type'], processed_text, option)
+
+    def estimate_requests(self, rule, entry, text_count):
+        # text_count: number of distinct texts which aren't cached
+        if rule['type'] == constants.TransformationType.Audio:
+            # one request per text
+            timed_request_count = text_count
+            entry['requests'] = text_count
+        else:
+            # texts are sent in chunks, the latency is measured per chunk
+            timed_request_count = math.ceil(text_count / constants.BATCH_REQUEST_CHUNK_SIZE)
+            if self.languagetools.batch_api_supported[rule['type']]:
+                entry['requests'] = timed_request_count
+            else:
+                entry['requests'] = text_count
+        latency, measured = self.languagetools.request_latency.get(rule['type'], entry['service'])
+        entry['latency_measured'] = measured
+        entry['estimated_seconds'] = timed_request_count * latency / self.languagetools.get_batch_concurrency()
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f'{math.ceil(seconds)}s'
+    minutes = seconds / 60
+    if minutes < 60:
+        return f'{math.ceil(minutes)}min'
+    return f'{minutes / 60:.1f}h'
+
+def plan_entry_str(entry):
+    if entry['error'] != None:
+        return f"<b>{entry['action']}</b>: {entry['error']}"
+    characters = entry['characters'] if entry['characters'] != None else 'unknown'
+    time_str = format_duration(entry['estimated_seconds'])
+    if not entry['latency_measured']:
+        time_str += ' (service not used yet)'
+    entry_str = f"<b>{entry['action']}</b> ({entry['service']}): requests: {entry['requests']}, characters: {characters}, " + \
+        f"cached: {entry['cached']}, duplicates: {entry['duplicates']}, empty: {entry['empty']}, time: {time_str}"
+    if entry['output_of'] != None:
+        entry_str += f", uses the output of {entry['output_of']}"
+    return entry_str
+
+def plan_str(plan):
+    # human-readable, html like the batch stats
+    plan_html_list = [f"<b>Estimate for {plan['notes']} notes.</b><br/>"]
+    for entry in plan['entries']:
+        plan_html_list.append(plan_entry_str(entry))
+    plan_html_list.append(f"Total: requests: {plan['requests']}, characters: {plan['characters']}, time: {format_duration(plan['estimated_seconds'])}")
+    return '<br/>\n'.join(plan_html_list)
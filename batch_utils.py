@@ -0,0 +1,160 @@
+import sys
+import math
+import time
+import logging
+import threading
+import concurrent.futures
+
+if hasattr(sys, '_pytest_mode'):
+    import constants
+else:
+    from . import constants
+
+# helpers shared by the batch operations (batch transformation dialog, rules)
+
+def split_chunks(item_list, max_workers, max_chunk_size=constants.BATCH_REQUEST_CHUNK_SIZE):
+    # split into chunks no larger than max_chunk_size, but small enough that every worker gets some work
+    # returns a list of (start_index, chunk)
+    if len(item_list) == 0:
+        return []
+    chunk_size = min(max_chunk_size, math.ceil(len(item_list) / max(1, max_workers)))
+    return [(start, item_list[start:start + chunk_size]) for start in range(0, len(item_list), chunk_size)]
+
+def group_identical(key_list):
+    # rows which share the same key (processed text, the option being the same for the whole batch) only need
+    # one request. returns a list of row index lists, one per distinct key, in order of first appearance
+    groups = {}
+    for i, key in enumerate(key_list):
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+class CancellationToken():
+    # set from the main thread (Cancel button), checked by the batch task between items
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+    def wait(self, seconds):
+        # sleeps, returns True as soon as the token gets cancelled
+        return self.event.wait(seconds)
+
+# the cancellation token of the batch job a BoundedExecutor worker thread is running an item for, so that
+# the requests made by that item stop waiting to be retried once the job gets cancelled
+worker_state = threading.local()
+
+def get_current_cancellation_token():
+    return getattr(worker_state, 'cancellation_token', None)
+
+class ProgressReporter():
+    # the batch tasks report progress from a background thread, after every item. rather than queueing a
+    # run_on_main call each time, updates are coalesced and delivered at most updates_per_second times.
+    # ui_fn callbacks (table cells for example) are queued and delivered with the next progress update.
+
+    def __init__(self, anki_utils, progress_fn, updates_per_second=constants.PROGRESS_UPDATES_PER_SECOND):
+        self.anki_utils = anki_utils
+        self.progress_fn = progress_fn
+        self.interval = 1.0 / updates_per_second
+        self.lock = threading.Lock()
+        self.value = 0
+        self.pending_ui_fn_list = []
+        self.last_update = None
+
+    def increment(self, count):
+        with self.lock:
+            self.value += count
+        self.update()
+
+    def add_ui_fn(self, ui_fn):
+        with self.lock:
+            self.pending_ui_fn_list.append(ui_fn)
+        self.update()
+
+    def update(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.last_update != None and now - self.last_update < self.interval:
+                return
+            self.last_update = now
+            value = self.value
+            ui_fn_list = self.pending_ui_fn_list
+            self.pending_ui_fn_list = []
+        def update_ui():
+            for ui_fn in ui_fn_list:
+                ui_fn()
+            self.progress_fn(value)
+        self.anki_utils.run_on_main(update_ui)
+
+    def finish(self):
+        # deliver whatever is left
+        self.update(force=True)
+
+class LatencyTracker():
+    # moving average of the request latency, per transformation type and service, over the requests sent since startup.
+    # used to estimate how long a batch job will take
+
+    def __init__(self, smoothing=0.2):
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.latency = {}
+
+    def record(self, transformation_type, service, seconds):
+        key = (transformation_type, service)
+        with self.lock:
+            if key not in self.latency:
+                self.latency[key] = seconds
+            else:
+                self.latency[key] = self.latency[key] * (1 - self.smoothing) + seconds * self.smoothing
+
+    def get(self, transformation_type, service):
+        # returns (seconds, measured)
+        with self.lock:
+            if (transformation_type, service) in self.latency:
+                return self.latency[(transformation_type, service)], True
+        return constants.DEFAULT_REQUEST_LATENCY_SECONDS, False
+
+class BoundedExecutor():
+    # runs a function over a list of items on a fixed number of worker threads.
+    # at most max_workers * 2 items are submitted at any given time, so that a very large
+    # list doesn't get queued all at once.
+    def __init__(self, max_workers):
+        self.max_workers = max(1, max_workers)
+
+    def run(self, fn, items, cancellation_token=None):
+        # generator, yields (item, result, exception) in completion order, on the calling thread.
+        # once cancelled, no more items are submitted, the ones in flight still get yielded
+        items = iter(items)
+        max_pending = self.max_workers * 2
+        def run_item(item):
+            worker_state.cancellation_token = cancellation_token
+            try:
+                return fn(item)
+            finally:
+                worker_state.cancellation_token = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {}
+            def submit_next():
+                if cancellation_token != None and cancellation_token.is_cancelled():
+                    return False
+                for item in items:
+                    pending[executor.submit(run_item, item)] = item
+                    return True
+                return False
+            while len(pending) < max_pending and submit_next():
+                pass
+            while len(pending) > 0:
+                done, _ = concurrent.futures.wait(pending.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logging.exception(e)
+                        yield item, None, e
+                    else:
+                        yield item, result, None
+                    submit_next()
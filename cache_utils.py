@@ -0,0 +1,357 @@
+import os
+import glob
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import collections
+
+class CachedResponse():
+    # looks like a requests response, so that cache hits can go through the regular interpret_*_response functions
+    def __init__(self, content_obj):
+        self.status_code = 200
+        self.content = json.dumps(content_obj)
+
+class TranslationCache():
+    # persistent cache of translation / transliteration results, stored in sqlite.
+    # entries are keyed by the processed text and the full option, once the total size goes over
+    # max_bytes, the least recently used entries get evicted.
+
+    # the access times of cache hits are written in bulk, a commit on every hit syncs the disk on every lookup
+    ACCESS_FLUSH_COUNT = 100
+
+    def __init__(self, db_path, max_bytes):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.pending_access = {} # cache_key -> last_access, not written yet
+        self.db_connection = None
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM translation_cache').fetchone()[0]
+
+    @property
+    def connection(self):
+        # opened on first use, and again after close(): the profile got closed, but the add-on keeps running.
+        # the batch operations use the cache from several worker threads, access is serialized by self.lock
+        if self.db_connection == None:
+            self.db_connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db_connection.execute('''CREATE TABLE IF NOT EXISTS translation_cache (
+                cache_key TEXT PRIMARY KEY,
+                service TEXT,
+                result TEXT,
+                size INTEGER,
+                last_access REAL)''')
+            self.db_connection.execute('CREATE INDEX IF NOT EXISTS translation_cache_last_access ON translation_cache(last_access)')
+            self.db_connection.commit()
+        return self.db_connection
+
+    def get_cache_key(self, transformation_type, processed_text, option):
+        combined_data = {
+            'transformation_type': transformation_type.name,
+            'text': processed_text,
+            'option': option
+        }
+        return hashlib.sha224(json.dumps(combined_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, transformation_type, processed_text, option):
+        # returns None if not present
+        cache_key = self.get_cache_key(transformation_type, processed_text, option)
+        with self.lock:
+            row = self.connection.execute('SELECT result FROM translation_cache WHERE cache_key=?', (cache_key,)).fetchone()
+            if row == None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.pending_access[cache_key] = time.time()
+            if len(self.pending_access) >= self.ACCESS_FLUSH_COUNT:
+                self.write_pending_access()
+                self.connection.commit()
+            return row[0]
+
+    def write_pending_access(self):
+        self.connection.executemany('UPDATE translation_cache SET last_access=? WHERE cache_key=?',
+            [(last_access, cache_key) for cache_key, last_access in self.pending_access.items()])
+        self.pending_access = {}
+
+    def contains(self, transformation_type, processed_text, option):
+        # doesn't count as a hit / miss, nor as an access
+        cache_key = self.get_cache_key(transformation_type, processed_text, option)
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM translation_cache WHERE cache_key=?', (cache_key,)).fetchone() != None
+
+    def put(self, transformation_type, processed_text, option, result):
+        cache_key = self.get_cache_key(transformation_type, processed_text, option)
+        size = len(cache_key) + len(result.encode('utf-8'))
+        with self.lock:
+            previous = self.connection.execute('SELECT size FROM translation_cache WHERE cache_key=?', (cache_key,)).fetchone()
+            if previous != None:
+                self.total_bytes -= previous[0]
+            self.connection.execute('INSERT OR REPLACE INTO translation_cache (cache_key, service, result, size, last_access) VALUES (?, ?, ?, ?, ?)',
+                (cache_key, option.get('service'), result, size, time.time()))
+            self.total_bytes += size
+            # goes out with this commit, and eviction needs the access times
+            self.write_pending_access()
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        # drop least recently used entries until we're back under 90% of the budget, so that we don't
+        # have to evict again on the very next insert
+        target_bytes = self.max_bytes * 0.9
+        cursor = self.connection.execute('SELECT cache_key, size FROM translation_cache ORDER BY last_access')
+        evicted_keys = []
+        for cache_key, size in cursor:
+            if self.total_bytes <= target_bytes:
+                break
+            evicted_keys.append((cache_key,))
+            self.total_bytes -= size
+        cursor.close()
+        self.connection.executemany('DELETE FROM translation_cache WHERE cache_key=?', evicted_keys)
+        logging.info(f'translation cache: evicted {len(evicted_keys)} entries')
+
+    def invalidate(self, service):
+        # remove all entries for a given service, for example after the service changed its output
+        with self.lock:
+            self.connection.execute('DELETE FROM translation_cache WHERE service=?', (service,))
+            self.connection.commit()
+            self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM translation_cache').fetchone()[0]
+
+    def get_services(self):
+        # services which have entries in the cache
+        with self.lock:
+            return [row[0] for row in self.connection.execute('SELECT DISTINCT service FROM translation_cache WHERE service IS NOT NULL ORDER BY service')]
+
+    def clear(self):
+        with self.lock:
+            self.pending_access = {}
+            self.connection.execute('DELETE FROM translation_cache')
+            self.connection.commit()
+            self.total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        with self.lock:
+            entry_count = self.connection.execute('SELECT COUNT(*) FROM translation_cache').fetchone()[0]
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': entry_count,
+                'bytes': self.total_bytes
+            }
+
+    def flush(self):
+        # write the access times of the cache hits so far
+        with self.lock:
+            if len(self.pending_access) > 0:
+                self.write_pending_access()
+                self.connection.commit()
+
+    def close(self):
+        # the connection gets reopened if the cache is used again
+        self.flush()
+        with self.lock:
+            if self.db_connection != None:
+                self.db_connection.close()
+                self.db_connection = None
+
+class AudioCache():
+    # index of the audio files stored in user_files. the index is kept in memory (in least recently used order)
+    # and persisted in sqlite, so a lookup is a dict access, and a miss never touches the filesystem.
+    # once the total size goes over max_bytes, the least recently used files get deleted.
+
+    # like TranslationCache, the access times of cache hits are written in bulk
+    ACCESS_FLUSH_COUNT = 100
+
+    def __init__(self, directory, db_path, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.pending_access = {} # hash_str -> last_access, not written yet
+        self.total_bytes = 0
+        self.db_path = db_path
+        self.db_connection = None
+        self.load_index()
+
+    @property
+    def connection(self):
+        # opened on first use, and again after close(), the in-memory index stays valid
+        if self.db_connection == None:
+            self.db_connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db_connection.execute('''CREATE TABLE IF NOT EXISTS audio_cache (
+                hash_str TEXT PRIMARY KEY,
+                service TEXT,
+                voice TEXT,
+                size INTEGER,
+                last_access REAL)''')
+            self.db_connection.commit()
+        return self.db_connection
+
+    def load_index(self):
+        rows = self.connection.execute('SELECT hash_str, service, voice, size, last_access FROM audio_cache ORDER BY last_access').fetchall()
+        for hash_str, service, voice, size, last_access in rows:
+            self.entries[hash_str] = {'service': service, 'voice': voice, 'size': size, 'last_access': last_access}
+            self.total_bytes += size
+        # audio files written before the index existed get picked up once
+        for filename in glob.glob(os.path.join(self.directory, 'languagetools-*.mp3')):
+            hash_str = os.path.basename(filename)[len('languagetools-'):-len('.mp3')]
+            if hash_str not in self.entries:
+                self.add_entry(hash_str, None, None, os.path.getsize(filename), os.path.getmtime(filename))
+                self.entries.move_to_end(hash_str, last=False)
+        self.connection.commit()
+
+    def get_filename(self, hash_str):
+        return os.path.join(self.directory, f'languagetools-{hash_str}.mp3')
+
+    def add_entry(self, hash_str, service, voice, size, last_access):
+        self.entries[hash_str] = {'service': service, 'voice': voice, 'size': size, 'last_access': last_access}
+        self.total_bytes += size
+        self.connection.execute('INSERT OR REPLACE INTO audio_cache (hash_str, service, voice, size, last_access) VALUES (?, ?, ?, ?, ?)',
+            (hash_str, service, voice, size, last_access))
+
+    def remove_entry(self, hash_str):
+        entry = self.entries.pop(hash_str)
+        self.pending_access.pop(hash_str, None)
+        self.total_bytes -= entry['size']
+        self.connection.execute('DELETE FROM audio_cache WHERE hash_str=?', (hash_str,))
+        filename = self.get_filename(hash_str)
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+    def get(self, hash_str):
+        # returns the filename, or None if not present
+        with self.lock:
+            if hash_str not in self.entries:
+                self.misses += 1
+                return None
+            filename = self.get_filename(hash_str)
+            if not os.path.isfile(filename):
+                # deleted behind our back
+                self.remove_entry(hash_str)
+                self.connection.commit()
+                self.misses += 1
+                return None
+            self.hits += 1
+            last_access = time.time()
+            self.entries[hash_str]['last_access'] = last_access
+            self.entries.move_to_end(hash_str)
+            # the in-memory index has the order already, the index on disk only needs it after a restart
+            self.pending_access[hash_str] = last_access
+            if len(self.pending_access) >= self.ACCESS_FLUSH_COUNT:
+                self.write_pending_access()
+                self.connection.commit()
+            return filename
+
+    def write_pending_access(self):
+        self.connection.executemany('UPDATE audio_cache SET last_access=? WHERE hash_str=?',
+            [(last_access, hash_str) for hash_str, last_access in self.pending_access.items()])
+        self.pending_access = {}
+
+    def contains(self, hash_str):
+        # doesn't count as a hit / miss, nor as an access
+        with self.lock:
+            return hash_str in self.entries and os.path.isfile(self.get_filename(hash_str))
+
+    def put(self, hash_str, audio_content, service, voice):
+        # writes the audio file and returns its filename
+        filename = self.get_filename(hash_str)
+        with open(filename, 'wb') as f:
+            f.write(audio_content)
+        with self.lock:
+            if hash_str in self.entries:
+                self.total_bytes -= self.entries.pop(hash_str)['size']
+            self.add_entry(hash_str, service, voice, len(audio_content), time.time())
+            self.evict(keep=hash_str)
+            self.write_pending_access()
+            self.connection.commit()
+        return filename
+
+    def evict(self, keep):
+        evicted_count = 0
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            hash_str = next(iter(self.entries))
+            if hash_str == keep:
+                break
+            self.remove_entry(hash_str)
+            evicted_count += 1
+        if evicted_count > 0:
+            logging.info(f'audio cache: evicted {evicted_count} files')
+
+    def clear(self):
+        with self.lock:
+            for hash_str in list(self.entries.keys()):
+                self.remove_entry(hash_str)
+            self.connection.commit()
+            # also remove anything which isn't in the index
+            for filename in glob.glob(os.path.join(self.directory, '*.mp3')):
+                os.remove(filename)
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        with self.lock:
+            lookup_count = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookup_count if lookup_count > 0 else 0,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes
+            }
+
+    def flush(self):
+        with self.lock:
+            if len(self.pending_access) > 0:
+                self.write_pending_access()
+                self.connection.commit()
+
+    def close(self):
+        # the connection gets reopened if the cache is used again
+        self.flush()
+        with self.lock:
+            if self.db_connection != None:
+                self.db_connection.close()
+                self.db_connection = None
+
+class SingleFlight():
+    # concurrent callers asking for the same key share a single call to fn, and get its result or exception.
+    # nothing is kept once the call completes, that's the job of the caches above.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.in_flight.get(key)
+            leader = call == None
+            if leader:
+                call = {'done': threading.Event(), 'result': None, 'exception': None, 'waiters': 0}
+                self.in_flight[key] = call
+            else:
+                call['waiters'] += 1
+
+        if not leader:
+            call['done'].wait()
+            if call['exception'] != None:
+                raise call['exception']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+        except Exception as e:
+            call['exception'] = e
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            call['done'].set()
+        if call['exception'] != None:
+            raise call['exception']
+        return call['result']
@@ -1,29 +1,218 @@
 import os
 import sys
 import requests
+import requests.adapters
 import json
 import logging
+import hashlib
+import threading
+import time
+import random
+import datetime
+import email.utils
 import sentry_sdk
 
 if hasattr(sys, '_pytest_mode'):
     import constants
     import errors
     import version
+    import batch_utils
 else:
     from . import constants
     from . import errors
     from . import version
+    from . import batch_utils
+
+class RequestScheduler():
+    # shared by all requests to the API. requests which got throttled (429) or hit a temporarily unavailable
+    # server get retried with exponential backoff and jitter, honoring Retry-After up to retry_after_max.
+    # requests aren't paced until the server throttles us, from then on the global request rate gets halved
+    # on every 429 and slowly increases again with every successful request, until it's back above max_rate.
+    # the requests of a batch job stop waiting as soon as the job gets cancelled.
+
+    RETRY_STATUS_CODES = [429, 502, 503, 504]
+
+    def __init__(self, max_retries=constants.REQUEST_MAX_RETRIES, 
+                 backoff_base=constants.REQUEST_BACKOFF_BASE_SECONDS,
+                 backoff_max=constants.REQUEST_BACKOFF_MAX_SECONDS,
+                 retry_after_max=constants.REQUEST_RETRY_AFTER_MAX_SECONDS,
+                 max_rate=constants.REQUEST_MAX_RATE,
+                 min_rate=constants.REQUEST_MIN_RATE,
+                 sleep_fn=time.sleep,
+                 clock_fn=time.monotonic):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_after_max = retry_after_max
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.sleep_fn = sleep_fn
+        self.clock_fn = clock_fn
+
+        self.lock = threading.Lock()
+        self.rate = None # requests per second, None when not throttled
+        self.next_request_time = 0
+        self.retry_count = 0
+        self.throttle_count = 0
+
+    def execute(self, request_fn):
+        attempt = 0
+        while True:
+            self.wait_for_slot()
+            try:
+                response = request_fn()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning(f'request failed ({e}), retrying')
+                if not self.record_retry(self.get_backoff_delay(attempt)):
+                    raise
+                attempt += 1
+                continue
+
+            if response.status_code not in self.RETRY_STATUS_CODES:
+                self.record_success()
+                return response
+            if response.status_code == 429:
+                self.record_throttled()
+            if attempt >= self.max_retries:
+                return response
+            delay = self.get_retry_after(response)
+            if delay != None and delay > self.retry_after_max:
+                logging.warning(f'request returned status {response.status_code}, the server asks to retry in {delay:.1f}s, not retrying')
+                return response
+            if delay == None:
+                delay = self.get_backoff_delay(attempt)
+            logging.warning(f'request returned status {response.status_code}, retrying in {delay:.1f}s')
+            if not self.record_retry(delay):
+                return response
+            attempt += 1
+
+    def wait_for_slot(self):
+        # space requests out according to the current rate
+        with self.lock:
+            if self.rate == None:
+                return
+            now = self.clock_fn()
+            slot = max(now, self.next_request_time)
+            self.next_request_time = slot + 1.0 / self.rate
+        if slot > now:
+            self.wait(slot - now)
+
+    def get_backoff_delay(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        # equal jitter: at least half the delay, the rest random, so that parallel workers don't retry in lockstep
+        return random.uniform(delay / 2, delay)
+
+    def get_retry_after(self, response):
+        # Retry-After is either a number of seconds or an http date
+        retry_after = response.headers.get('Retry-After')
+        if retry_after == None:
+            return None
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                retry_date = email.utils.parsedate_to_datetime(retry_after)
+                delay = (retry_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        # the server knows how long it needs, backoff_max only applies to our own backoff
+        return max(0, delay)
+
+    def wait(self, delay):
+        # returns False if the batch job running on this thread got cancelled while waiting
+        cancellation_token = batch_utils.get_current_cancellation_token()
+        if cancellation_token == None:
+            self.sleep_fn(delay)
+            return True
+        return not cancellation_token.wait(delay)
+
+    def record_retry(self, delay):
+        # returns False if cancelled
+        with self.lock:
+            self.retry_count += 1
+        return self.wait(delay)
+
+    def record_throttled(self):
+        with self.lock:
+            self.throttle_count += 1
+            current_rate = self.max_rate if self.rate == None else self.rate
+            self.rate = max(self.min_rate, current_rate / 2)
+            logging.info(f'throttled by the server, request rate now {self.rate:.2f}/s')
+
+    def record_success(self):
+        with self.lock:
+            if self.rate != None:
+                self.rate += constants.REQUEST_RATE_INCREASE
+                if self.rate >= self.max_rate:
+                    self.rate = None
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'retries': self.retry_count,
+                'throttled': self.throttle_count
+            }
 
 class CloudLanguageTools():
-    def __init__(self):
+    def __init__(self, pool_size=constants.DEFAULT_HTTP_POOL_SIZE):
         self.clt_api_base_url = os.environ.get(constants.ENV_VAR_ANKI_LANGUAGE_TOOLS_BASE_URL, constants.CLT_API_BASE_URL)
         self.vocab_api_base_url = os.environ.get(constants.ENV_VAR_ANKI_LANGUAGE_TOOLS_VOCABAI_BASE_URL, constants.VOCABAI_API_BASE_URL)
         self.initialization_done = False
         self.api_key = None
+        # which api the key belongs to, known once the key got verified
+        self.use_vocabai_api = None
+
+        # one keep-alive session per base url, shared by all endpoints
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+        self.scheduler = RequestScheduler()
+
+    # connection management
+    # =====================
+
+    def get_session(self, base_url):
+        with self.sessions_lock:
+            if base_url not in self.sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[base_url] = session
+            return self.sessions[base_url]
+
+    def close(self):
+        # close all pooled connections, sessions get re-created on the next request
+        with self.sessions_lock:
+            for base_url, session in self.sessions.items():
+                logging.debug(f'closing http session for {base_url}')
+                session.close()
+            self.sessions = {}
+
+    def get(self, base_url, url, **kwargs):
+        return self.scheduler.execute(lambda: self.get_session(base_url).get(url, **kwargs))
+
+    def post(self, base_url, url, **kwargs):
+        return self.scheduler.execute(lambda: self.get_session(base_url).post(url, **kwargs))
+
+    def get_request_stats(self):
+        return self.scheduler.get_stats()
 
     def api_key_set(self):
         return self.api_key != None
 
+    def set_api_key(self, api_key, use_vocabai_api):
+        # a key verified during an earlier session, requests can go out before it gets verified again
+        self.api_key = api_key
+        self.use_vocabai_api = use_vocabai_api
+
+    def clear_api_key(self):
+        self.api_key = None
+        self.use_vocabai_api = None
+
     def get_base_url(self):
         if self.use_vocabai_api:
             return self.vocab_api_base_url
@@ -65,32 +254,48 @@ class CloudLanguageTools():
 
     def authenticated_get_request(self, endpoint):
         url = self.get_url(endpoint)
-        response = requests.get(url, headers=self.get_headers())
+        response = self.get(self.get_base_url(), url, headers=self.get_headers())
         response.raise_for_status()
         return response.json()
 
     def authenticated_post_request(self, endpoint, data):
         url = self.get_url(endpoint)
-        response = requests.post(url, json=data, headers=self.get_headers())
+        response = self.post(self.get_base_url(), url, json=data, headers=self.get_headers())
         response.raise_for_status()
         return response.json()
 
     def authenticated_post_request_response(self, endpoint, data):
         # just return the response without any processing
         url = self.get_url(endpoint)
-        response = requests.post(url, json=data, headers=self.get_headers())
+        response = self.post(self.get_base_url(), url, json=data, headers=self.get_headers())
         return response
 
     def get_language_data(self):
         with sentry_sdk.start_transaction(op=constants.SENTRY_OPERATION, name='get_language_data'):
             return self.authenticated_get_request('language_data')
 
+    def get_language_data_conditional(self, etag):
+        # returns None if the language data hasn't changed since etag was received, otherwise (language_data, etag)
+        with sentry_sdk.start_transaction(op=constants.SENTRY_OPERATION, name='get_language_data_conditional'):
+            headers = self.get_headers()
+            if etag != None:
+                headers['If-None-Match'] = etag
+            response = self.get(self.get_base_url(), self.get_url('language_data'), headers=headers)
+            if response.status_code == 304:
+                return None
+            response.raise_for_status()
+            # if the server doesn't send an ETag, a hash of the payload still tells us whether it changed
+            new_etag = response.headers.get('ETag', hashlib.sha224(response.content).hexdigest())
+            if new_etag == etag:
+                return None
+            return response.json(), new_etag
+
     def api_key_validate_query(self, api_key):
         with sentry_sdk.start_transaction(op=constants.SENTRY_OPERATION, name='verify_api_key'):
             # first, try to validate api key using the account endpoint on vocabai
 
             # try to get account data on vocabai first
-            response = requests.get(self.vocab_api_base_url + '/account', headers=self.get_headers_vocabai_api(api_key))
+            response = self.get(self.vocab_api_base_url, self.vocab_api_base_url + '/account', headers=self.get_headers_vocabai_api(api_key))
             if response.status_code == 200:
                 # API key is valid on vocab API
                 self.use_vocabai_api = True
@@ -102,7 +307,7 @@ class CloudLanguageTools():
 
             # now try to get account data on CLT API
             url = self.clt_api_base_url + '/account'
-            response = requests.get(url, headers=self.get_headers_clt_api(api_key))
+            response = self.get(self.clt_api_base_url, url, headers=self.get_headers_clt_api(api_key))
             if response.status_code == 200:
                 self.use_vocabai_api = False
                 # API key is valid on CLT API
@@ -151,7 +356,7 @@ class CloudLanguageTools():
             'options': options
         }
         headers = self.get_headers()
-        return requests.post(url, json=data, headers=headers)
+        return self.post(self.get_base_url(), url, json=data, headers=headers)
 
     def get_tts_audio(self, source_text, service, language_code, voice_key, options):
         with sentry_sdk.start_transaction(op=constants.SENTRY_OPERATION, name=f'Audio_{service}'):
@@ -185,6 +390,25 @@ class CloudLanguageTools():
                     'transliteration_key': transliteration_option['transliteration_key']
             })
 
+    def get_translation_batch(self, source_text_list, translation_option):
+        # returns the response from requests directly, results are in the same order as source_text_list
+        with sentry_sdk.start_transaction(op=constants.SENTRY_OPERATION, name='TranslationBatch_'+translation_option['service']):
+            return self.authenticated_post_request_response('translate_batch', {
+                'text_list': source_text_list,
+                'service': translation_option['service'],
+                'from_language_key': translation_option['source_language_id'],
+                'to_language_key': translation_option['target_language_id']
+            })
+
+    def get_transliteration_batch(self, source_text_list, transliteration_option):
+        # returns the response from requests directly, results are in the same order as source_text_list
+        with sentry_sdk.start_transaction(op=constants.SENTRY_OPERATION, name='TransliterationBatch_'+transliteration_option['service']):
+            return self.authenticated_post_request_response('transliterate_batch', {
+                'text_list': source_text_list,
+                'service': transliteration_option['service'],
+                'transliteration_key': transliteration_option['transliteration_key']
+            })
+
     def get_breakdown(self, source_text, tokenization_option, translation_option, transliteration_option):
         # returns the response from requests directly
         with sentry_sdk.start_transaction(op=constants.SENTRY_OPERATION, name='breakdown'):
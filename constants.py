@@ -15,6 +15,10 @@ CONFIG_VOICE_SELECTION = 'voice_selection'
 CONFIG_APPLY_UPDATES_AUTOMATICALLY = 'apply_updates_automatically'
 CONFIG_LIVE_UPDATE_DELAY = 'live_update_delay'
 CONFIG_TEXT_PROCESSING = 'text_processing'
+CONFIG_HTTP_POOL_SIZE = 'http_pool_size'
+CONFIG_BATCH_CONCURRENCY = 'batch_concurrency'
+CONFIG_TRANSLATION_CACHE_SIZE_MB = 'translation_cache_size_mb'
+CONFIG_AUDIO_CACHE_SIZE_MB = 'audio_cache_size_mb'
 ADDON_NAME = 'Language Tools'
 MENU_PREFIX = ADDON_NAME + ':'
 DEFAULT_LANGUAGE = 'en' # always add this language, even if the user didn't add it themselves
@@ -38,6 +42,65 @@ COMMAND_FULLUPDATE = 'fullupdate'
 
 SENTRY_OPERATION = 'languagetools'
 
+# maximum number of keep-alive connections kept open per API base url
+DEFAULT_HTTP_POOL_SIZE = 8
+
+# retries of throttled / failed requests, with exponential backoff
+REQUEST_MAX_RETRIES = 5
+REQUEST_BACKOFF_BASE_SECONDS = 1.0
+REQUEST_BACKOFF_MAX_SECONDS = 10.0
+# the wait asked for by the server with Retry-After is honored up to this ceiling, when the server asks
+# for a longer wait, the response goes back to the caller rather than blocking a worker
+REQUEST_RETRY_AFTER_MAX_SECONDS = 10.0
+# global request rate (requests per second) once the server throttles us, halved on every 429
+REQUEST_MAX_RATE = 20.0
+REQUEST_MIN_RATE = 0.5
+REQUEST_RATE_INCREASE = 0.1
+
+# number of notes read from the collection in a single query
+NOTE_QUERY_CHUNK_SIZE = 1000
+# number of notes written to the collection in a single call
+NOTE_UPDATE_CHUNK_SIZE = 500
+
+# the batch transformation preview table shows notes one page at a time, and keeps a few pages of field values
+NOTE_TABLE_PAGE_SIZE = 200
+NOTE_TABLE_MAX_CACHED_PAGES = 10
+
+# number of texts sent in a single translate_batch / transliterate_batch request
+BATCH_REQUEST_CHUNK_SIZE = 25
+
+# number of requests running in parallel during batch operations
+DEFAULT_BATCH_CONCURRENCY = 4
+
+# request latency assumed by the batch planner for a service which hasn't been used yet
+DEFAULT_REQUEST_LATENCY_SECONDS = 1.0
+
+# language detection sends at most this many field samples (max supported by azure), each one restricted to a few characters
+LANGUAGE_DETECTION_SAMPLE_SIZE = 100
+FIELD_SAMPLE_MAX_LENGTH = 200
+
+# number of field values kept with their html stripped, the same value usually gets checked, processed and used as a cache key
+HTML_TO_TEXT_CACHE_SIZE = 2000
+
+# batch operations refresh the progress bar / table at most this many times per second
+PROGRESS_UPDATES_PER_SECOND = 20
+
+# size budget of the translation / transliteration cache, least recently used entries are evicted
+DEFAULT_TRANSLATION_CACHE_SIZE_MB = 50
+TRANSLATION_CACHE_FILENAME = 'translation_cache.sqlite3'
+
+# size budget of the audio files kept in user_files
+DEFAULT_AUDIO_CACHE_SIZE_MB = 200
+AUDIO_CACHE_FILENAME = 'audio_cache.sqlite3'
+
+# language data from the last session, used at startup until it's been revalidated
+LANGUAGE_DATA_CACHE_FILENAME = 'language_data.json'
+
+# checkpoints of the add audio / run rules jobs, so that an interrupted job can be resumed
+JOB_JOURNAL_FILENAME = 'job_journal.sqlite3'
+JOB_TYPE_ADD_AUDIO = 'add_audio'
+JOB_TYPE_RUN_RULES = 'run_rules'
+
 class TransformationType(enum.Enum):
     Translation = enum.auto()
     Transliteration = enum.auto()
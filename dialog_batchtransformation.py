@@ -1,5 +1,6 @@
 import sys
 import logging
+import collections
 from typing import List, Dict
 import aqt.qt
 
@@ -8,19 +9,30 @@ if hasattr(sys, '_pytest_mode'):
     import deck_utils
     import gui_utils
     import errors
+    import batch_utils
+    import batch_planner
     from languagetools import LanguageTools
 else:
     from . import constants
     from . import deck_utils
     from . import gui_utils
     from . import errors
+    from . import batch_utils
+    from . import batch_planner
     from .languagetools import LanguageTools
 
 class NoteTableModel(aqt.qt.QAbstractTableModel):
-    def __init__(self):
+    # the view gets rows one page at a time (canFetchMore / fetchMore). the from field values are read from the
+    # collection a page at a time when they get displayed, only the most recently used pages are kept.
+    # results are stored by row, only for the rows which have one.
+
+    def __init__(self, anki_utils):
         aqt.qt.QAbstractTableModel.__init__(self, None)
-        self.from_field_data = []
-        self.to_field_data = []
+        self.anki_utils = anki_utils
+        self.note_id_list = []
+        self.loaded_row_count = 0
+        self.from_field_pages = collections.OrderedDict() # by page index
+        self.to_field_data = {} # by row
         self.from_field = 'From'
         self.to_field = 'To'
 
@@ -38,23 +50,61 @@ class NoteTableModel(aqt.qt.QAbstractTableModel):
         self.to_field = field_name
         self.headerDataChanged.emit(aqt.qt.Qt.Orientation.Horizontal, 0, 1)
 
-    def setFromFieldData(self, data):
-        self.from_field_data = data
-        self.to_field_data = [None] * len(self.from_field_data)
-        # print(f'**** len(self.to_field_data): {len(self.to_field_data)}')
-        start_index = self.createIndex(0, 0)
-        end_index = self.createIndex(len(self.from_field_data)-1, 0)
-        self.dataChanged.emit(start_index, end_index)
+    def setNoteIdList(self, note_id_list):
+        self.note_id_list = note_id_list
+        self.resetData()
+
+    def resetData(self):
+        # the from field changed, or the notes did
+        self.beginResetModel()
+        self.from_field_pages.clear()
+        self.to_field_data = {}
+        self.loaded_row_count = min(constants.NOTE_TABLE_PAGE_SIZE, len(self.note_id_list))
+        self.endResetModel()
+
+    def getFromFieldValue(self, row):
+        page_size = constants.NOTE_TABLE_PAGE_SIZE
+        page_index = row // page_size
+        if page_index not in self.from_field_pages:
+            page_note_id_list = self.note_id_list[page_index * page_size:(page_index + 1) * page_size]
+            field_values = self.anki_utils.get_field_values_for_notes(page_note_id_list, [self.from_field])
+            self.from_field_pages[page_index] = [field_values.get(note_id, {}).get(self.from_field) for note_id in page_note_id_list]
+            if len(self.from_field_pages) > constants.NOTE_TABLE_MAX_CACHED_PAGES:
+                self.from_field_pages.popitem(last=False)
+        self.from_field_pages.move_to_end(page_index)
+        return self.from_field_pages[page_index][row - page_index * page_size]
 
     def setToFieldData(self, row, to_field_result):
-        # print(f'**** setToFieldData:, row: {row}')
         self.to_field_data[row] = to_field_result
-        start_index = self.createIndex(row, 1)
-        end_index = self.createIndex(row, 1)
-        self.dataChanged.emit(start_index, end_index)
+        # rows the view hasn't fetched yet will get displayed with their result later
+        if row < self.loaded_row_count:
+            start_index = self.createIndex(row, 1)
+            end_index = self.createIndex(row, 1)
+            self.dataChanged.emit(start_index, end_index)
+
+    def getToFieldResults(self):
+        # list of (row, result), in row order
+        return sorted(self.to_field_data.items())
+
+    def canFetchMore(self, parent):
+        if parent.isValid():
+            return False
+        return self.loaded_row_count < len(self.note_id_list)
+
+    def fetchMore(self, parent):
+        if parent.isValid():
+            return
+        fetch_count = min(constants.NOTE_TABLE_PAGE_SIZE, len(self.note_id_list) - self.loaded_row_count)
+        if fetch_count <= 0:
+            return
+        self.beginInsertRows(aqt.qt.QModelIndex(), self.loaded_row_count, self.loaded_row_count + fetch_count - 1)
+        self.loaded_row_count += fetch_count
+        self.endInsertRows()
 
     def rowCount(self, parent):
-        return len(self.from_field_data)
+        if parent.isValid():
+            return 0
+        return self.loaded_row_count
 
     def columnCount(self, parent):
         return 2
@@ -66,10 +116,10 @@ class NoteTableModel(aqt.qt.QAbstractTableModel):
            return aqt.qt.QVariant()
         if index.column() == 0:
             # from field
-            return aqt.qt.QVariant(self.from_field_data[index.row()])
+            return aqt.qt.QVariant(self.getFromFieldValue(index.row()))
         else:
             # result field
-            return aqt.qt.QVariant(self.to_field_data[index.row()])
+            return aqt.qt.QVariant(self.to_field_data.get(index.row()))
 
     def setData(self, index, value, role):
         if index.column() != 1:
@@ -101,6 +151,8 @@ class BatchConversionDialog(aqt.qt.QDialog):
         self.deck_note_type = deck_note_type
         self.note_id_list = note_id_list
         self.transformation_type = transformation_type
+        # set while translations are loading, the Cancel button stops the job
+        self.cancellation_token = None
 
         # get field list
         field_names = self.languagetools.deck_utils.get_field_names(deck_note_type)
@@ -110,12 +162,7 @@ class BatchConversionDialog(aqt.qt.QDialog):
         self.deck_note_type_field_list = []
         self.field_language = []
 
-        self.from_field_data = []
-        self.to_field_data = []
-
-        self.to_fields_empty = True
-
-        self.noteTableModel = NoteTableModel()
+        self.noteTableModel = NoteTableModel(self.languagetools.anki_utils)
 
         at_least_one_field_language_set = False
 
@@ -275,6 +322,7 @@ class BatchConversionDialog(aqt.qt.QDialog):
         buttonBox = aqt.qt.QDialogButtonBox()
         self.applyButton = buttonBox.addButton("Apply To Notes", aqt.qt.QDialogButtonBox.ButtonRole.AcceptRole)
         self.applyButton.setEnabled(False)
+        self.estimateButton = buttonBox.addButton("Estimate", aqt.qt.QDialogButtonBox.ButtonRole.ActionRole)
         self.cancelButton = buttonBox.addButton("Cancel", aqt.qt.QDialogButtonBox.ButtonRole.RejectRole)
         self.cancelButton.setStyleSheet(self.languagetools.anki_utils.get_red_stylesheet())
 
@@ -289,6 +337,7 @@ class BatchConversionDialog(aqt.qt.QDialog):
         self.from_combobox.currentIndexChanged.connect(self.fromFieldIndexChanged)
         self.to_combobox.currentIndexChanged.connect(self.toFieldIndexChanged)
         self.load_translations_button.pressed.connect(self.loadTranslations)
+        self.estimateButton.pressed.connect(self.show_estimate)
         buttonBox.accepted.connect(self.accept)
         buttonBox.rejected.connect(self.reject)
 
@@ -396,20 +445,10 @@ class BatchConversionDialog(aqt.qt.QDialog):
                     self.service_combobox.setCurrentIndex(service_index)
 
     def updateSampleData(self):
-        # self.from_field
+        # the table reads the field values when they get displayed
         self.noteTableModel.setFromField(self.from_field)
         self.noteTableModel.setToField(self.to_field)
-        from_field_data = []
-        self.to_fields_empty = True
-        for note_id in self.note_id_list:
-            note = self.languagetools.anki_utils.get_note_by_id(note_id)
-            field_data = note[self.from_field]
-            from_field_data.append(field_data)
-            # self.to_fields_empty = True
-            if len(note[self.to_field]) > 0:
-                self.to_fields_empty = False
-        self.from_field_data = from_field_data
-        self.noteTableModel.setFromFieldData(from_field_data)
+        self.noteTableModel.setNoteIdList(self.note_id_list)
 
     def loadTranslations(self):
         if self.languagetools.ensure_api_key_checked() == False:
@@ -422,67 +461,134 @@ class BatchConversionDialog(aqt.qt.QDialog):
             if len(self.transliteration_options) == 0:
                 self.languagetools.anki_utils.critical_message(f'No service found for transliteration from language {self.languagetools.get_language_name(self.from_language)}', self)
                 return
+        self.cancellation_token = batch_utils.CancellationToken()
         self.languagetools.anki_utils.run_in_background(self.loadTranslationsTask, self.loadTranslationDone)
 
     def loadTranslationsTask(self):
         self.load_errors = []
+        self.request_stats_start = self.languagetools.get_request_stats()
 
         try:
-            self.languagetools.anki_utils.run_on_main(lambda: self.load_translations_button.setDisabled(True))
-            self.languagetools.anki_utils.run_on_main(lambda: self.load_translations_button.setStyleSheet(None))
-            self.languagetools.anki_utils.run_on_main(lambda: self.applyButton.setDisabled(True))
-            self.languagetools.anki_utils.run_on_main(lambda: self.applyButton.setStyleSheet(None))
-            self.languagetools.anki_utils.run_on_main(lambda: self.load_translations_button.setText('Loading...'))
-
-            self.languagetools.anki_utils.run_on_main(lambda: self.progress_bar.setValue(0))
-            self.languagetools.anki_utils.run_on_main(lambda: self.progress_bar.setMaximum(len(self.from_field_data)))
-
-            # get service
-            if self.transformation_type == constants.TransformationType.Translation:
-                service = self.translation_service_names[self.service_combobox.currentIndex()]
-                translation_options = self.languagetools.get_translation_options(self.from_language, self.to_language)
-                translation_option_subset = [x for x in translation_options if x['service'] == service]
-                assert(len(translation_option_subset) == 1)
-                self.translation_option = translation_option_subset[0]
-            elif self.transformation_type == constants.TransformationType.Transliteration:
-                self.transliteration_option = self.transliteration_options[self.service_combobox.currentIndex()]
+            self.languagetools.anki_utils.run_on_main(self.set_loading_state)
 
-            def get_set_to_field_lambda(i, translation_result):
-                def set_to_field():
-                    self.noteTableModel.setToFieldData(i, translation_result)
-                return set_to_field
+            self.update_selected_option()
 
         except Exception as e:
             self.load_errors.append(e)
             return
 
 
-        i = 0
-        for field_data in self.from_field_data:
-            try:
-                if self.transformation_type == constants.TransformationType.Translation:
-                    translation_result = self.languagetools.get_translation(field_data, self.translation_option)
-                elif self.transformation_type == constants.TransformationType.Transliteration:
-                    translation_result = self.languagetools.get_transliteration(field_data, self.transliteration_option)
-                self.languagetools.anki_utils.run_on_main(get_set_to_field_lambda(i, translation_result))
-            except errors.LanguageToolsError as e:
-                self.load_errors.append(e)
-            except Exception as e:
-                logging.exception(e)
-                self.load_errors.append(e)
-            i += 1
-            self.languagetools.anki_utils.run_on_main(lambda: self.progress_bar.setValue(i))
-
-        self.languagetools.anki_utils.run_on_main(lambda: self.applyButton.setDisabled(False))
-        self.languagetools.anki_utils.run_on_main(lambda: self.applyButton.setStyleSheet(self.languagetools.anki_utils.get_green_stylesheet()))
-
-
-        self.languagetools.anki_utils.run_on_main(lambda: self.load_translations_button.setDisabled(False))
-        self.languagetools.anki_utils.run_on_main(lambda: self.load_translations_button.setStyleSheet(self.languagetools.anki_utils.get_green_stylesheet()))
-        self.languagetools.anki_utils.run_on_main(lambda: self.load_translations_button.setText(self.load_button_text_map[self.transformation_type]))
-
+        def load_chunk(chunk_entry):
+            chunk_text_list, chunk_field_data = chunk_entry
+            if self.transformation_type == constants.TransformationType.Translation:
+                return self.languagetools.get_translation_batch(chunk_field_data, self.translation_option)
+            elif self.transformation_type == constants.TransformationType.Transliteration:
+                return self.languagetools.get_transliteration_batch(chunk_field_data, self.transliteration_option)
+
+        concurrency = self.languagetools.get_batch_concurrency()
+
+        # rows are sent to the server in chunks, several chunks in parallel. each row gets
+        # delivered to the table once its chunk completes, in whatever order they finish
+        executor = batch_utils.BoundedExecutor(concurrency)
+        # table cells and progress bar get refreshed together, a few times per second
+        progress = batch_utils.ProgressReporter(self.languagetools.anki_utils, self.progress_bar.setValue)
+        def get_set_to_field_lambda(row_list, translation_result):
+            def set_to_field():
+                for i in row_list:
+                    self.noteTableModel.setToFieldData(i, translation_result)
+            return set_to_field
+        def deliver(row_list, result):
+            if 'error' in result:
+                self.load_errors.extend([result['error']] * len(row_list))
+            else:
+                progress.add_ui_fn(get_set_to_field_lambda(row_list, result['result']))
+            progress.increment(len(row_list))
+
+        # rows with the same processed text share a request, over the whole selection: a text which shows up again in a later
+        # segment joins the rows of the request in flight, or gets the result right away once that request completed.
+        # build_chunks and the loop below both run on this thread.
+        rows_by_text = {} # requests in flight
+        results_by_text = {} # requests completed
+
+        def build_chunks():
+            # the from field is read one segment of notes at a time, while the chunks of the previous segment are in flight
+            segment_size = constants.NOTE_QUERY_CHUNK_SIZE
+            for segment_start in range(0, len(self.note_id_list), segment_size):
+                segment_note_id_list = self.note_id_list[segment_start:segment_start + segment_size]
+                field_values = self.languagetools.anki_utils.get_field_values_for_notes(segment_note_id_list, [self.from_field])
+                from_field_data = [field_values[note_id][self.from_field] for note_id in segment_note_id_list]
+                request_list = [] # (processed text, field data), one per text not seen before
+                for i, field_data in enumerate(from_field_data):
+                    processed_text = self.languagetools.text_utils.process(field_data, self.transformation_type)
+                    if processed_text in results_by_text:
+                        deliver([segment_start + i], results_by_text[processed_text])
+                    elif processed_text in rows_by_text:
+                        rows_by_text[processed_text].append(segment_start + i)
+                    else:
+                        rows_by_text[processed_text] = [segment_start + i]
+                        request_list.append((processed_text, field_data))
+                self.languagetools.add_deduplicated_requests(len(from_field_data) - len(request_list))
+                logging.info(f'{len(from_field_data)} rows, {len(request_list)} new distinct texts')
+                for chunk_start, chunk in batch_utils.split_chunks(request_list, concurrency):
+                    yield [processed_text for processed_text, field_data in chunk], [field_data for processed_text, field_data in chunk]
+
+        for (chunk_text_list, chunk_field_data), chunk_results, exception in executor.run(load_chunk, build_chunks(), self.cancellation_token):
+            if exception != None:
+                chunk_results = [{'error': exception}] * len(chunk_text_list)
+            for processed_text, result in zip(chunk_text_list, chunk_results):
+                results_by_text[processed_text] = result
+                deliver(rows_by_text.pop(processed_text), result)
+        progress.finish()
+        self.languagetools.flush_caches()
+
+        self.languagetools.anki_utils.run_on_main(self.set_loaded_state)
+
+    def update_selected_option(self):
+        # get service
+        if self.transformation_type == constants.TransformationType.Translation:
+            service = self.translation_service_names[self.service_combobox.currentIndex()]
+            translation_options = self.languagetools.get_translation_options(self.from_language, self.to_language)
+            translation_option_subset = [x for x in translation_options if x['service'] == service]
+            assert(len(translation_option_subset) == 1)
+            self.translation_option = translation_option_subset[0]
+            return self.translation_option
+        elif self.transformation_type == constants.TransformationType.Transliteration:
+            self.transliteration_option = self.transliteration_options[self.service_combobox.currentIndex()]
+            return self.transliteration_option
+
+    def show_estimate(self):
+        # dry run, counts the requests / characters Load Translations would send
+        with self.languagetools.error_manager.get_single_action_context(f'estimating {self.transformation_type.name.lower()}'):
+            rule = {'type': self.transformation_type, 'from_field': self.from_field, 'to_field': self.to_field,
+                'option': self.update_selected_option(), 'action': f'adding {self.transformation_type.name.lower()} to field {self.to_field}'}
+            planner = batch_planner.BatchPlanner(self.languagetools)
+            self.languagetools.anki_utils.run_in_background(lambda: planner.plan(self.deck_note_type, [rule], self.note_id_list), self.show_estimate_done)
+
+    def show_estimate_done(self, future_result):
+        with self.languagetools.error_manager.get_single_action_context(f'estimating {self.transformation_type.name.lower()}'):
+            self.languagetools.anki_utils.info_message(batch_planner.plan_str(future_result.result()), self)
+
+    def set_loading_state(self):
+        self.load_translations_button.setDisabled(True)
+        self.load_translations_button.setStyleSheet(None)
+        self.applyButton.setDisabled(True)
+        self.applyButton.setStyleSheet(None)
+        self.load_translations_button.setText('Loading...')
+        self.progress_bar.setValue(0)
+        self.progress_bar.setMaximum(len(self.note_id_list))
+
+    def set_loaded_state(self):
+        self.applyButton.setDisabled(False)
+        self.applyButton.setStyleSheet(self.languagetools.anki_utils.get_green_stylesheet())
+        self.load_translations_button.setDisabled(False)
+        self.load_translations_button.setStyleSheet(self.languagetools.anki_utils.get_green_stylesheet())
+        self.load_translations_button.setText(self.load_button_text_map[self.transformation_type])
 
     def loadTranslationDone(self, future_result):
+        self.cancellation_token = None
+        self.cancelButton.setText('Cancel')
+        self.cancelButton.setEnabled(True)
+        request_stats = errors.request_stats_str(self.request_stats_start, self.languagetools.get_request_stats())
         if len(self.load_errors) > 0:
             error_counts = {}
             for error_exception in self.load_errors:
@@ -490,23 +596,40 @@ class BatchConversionDialog(aqt.qt.QDialog):
                 current_count = error_counts.get(error, 0)
                 error_counts[error] = current_count + 1
             error_message = '<p><b>Errors</b>: ' + ', '.join([f'{key} ({value} times)' for key, value in error_counts.items()]) + '</p>'
+            if len(request_stats) > 0:
+                error_message += f'<p>{request_stats}</p>'
             complete_message = f'<p>Encountered errors while generating {self.transformation_type.name}. You can still click <b>Apply to Notes</b> to apply the values retrieved to your notes.</p>' + error_message
             self.languagetools.anki_utils.critical_message(complete_message, self)
+        elif len(request_stats) > 0:
+            # the results are in the table, no need for a dialog
+            self.languagetools.anki_utils.tooltip_message(request_stats)
+
+    def reject(self):
+        if self.cancellation_token != None:
+            # stop loading, the rows loaded so far can still be applied
+            self.cancellation_token.cancel()
+            self.cancelButton.setText('Cancelling...')
+            self.cancelButton.setEnabled(False)
+        else:
+            super().reject()
 
     def accept(self):
-        if self.to_fields_empty == False:
+        field_values = self.languagetools.anki_utils.get_field_values_for_notes(self.note_id_list, [self.to_field])
+        to_fields_empty = all([len(note_field_values[self.to_field]) == 0 for note_field_values in field_values.values()])
+        if to_fields_empty == False:
             proceed = self.languagetools.anki_utils.ask_user(f'Overwrite existing data in field {self.to_field} ?', self)
             if proceed == False:
                 return
         # set field on notes
         action_str = self.transformation_type.name
         self.undo_id = self.languagetools.anki_utils.undo_start(action_str)
-        for (note_id, i) in zip(self.note_id_list, range(len(self.note_id_list))):
-            to_field_data = self.noteTableModel.to_field_data[i]
+        modified_notes = []
+        for i, to_field_data in self.noteTableModel.getToFieldResults():
             if to_field_data != None:
-                note = self.languagetools.anki_utils.get_note_by_id(note_id)
+                note = self.languagetools.anki_utils.get_note_by_id(self.note_id_list[i])
                 note[self.to_field] = to_field_data
-                self.languagetools.anki_utils.update_note(note)
+                modified_notes.append(note)
+        self.languagetools.anki_utils.update_notes(modified_notes)
         self.languagetools.anki_utils.undo_end(self.undo_id)
         self.close()
         # memorize this setting
@@ -362,29 +362,25 @@ class LanguageMappingDialog_UI(object):
             self.disableApplyButton()
 
             dtnf_list: List[deck_utils.DeckNoteTypeField] = self.languagetools.get_populated_dntf()
-            progress_max = 0
-            for dntf in dtnf_list:
-                deck_name = dntf.deck_note_type.deck_name
-                if self.matchFilter(self.filter_text, deck_name):
-                    progress_max += 1
+            dtnf_list = [dntf for dntf in dtnf_list if self.matchFilter(self.filter_text, dntf.deck_note_type.deck_name)]
+            progress_max = len(dtnf_list)
             self.setProgressBarMax(progress_max)
 
+            # the fields are detected in parallel, the combo boxes get updated as the results come in
             progress = 0
-            for dntf in dtnf_list:
+            for dntf, language, exception in self.languagetools.perform_language_detection_dntf_list(dtnf_list):
                 if self.interrupt_autodetect == True:
                     return
+                if exception != None:
+                    raise exception
 
-                deck_name = dntf.deck_note_type.deck_name
-                if self.matchFilter(self.filter_text, deck_name):
-                    language = self.languagetools.perform_language_detection_deck_note_type_field(dntf)
-                    #self.language_mapping_changes[deck_note_type_field] = language
-                    # need to set combo box correctly.
-                    comboBox = self.dntfComboxBoxMap[dntf]
-                    self.setFieldLanguageIndex(comboBox, language)
-
-                    # progress bar
-                    self.setProgressValue(progress)
-                    progress += 1
+                # need to set combo box correctly.
+                comboBox = self.dntfComboxBoxMap[dntf]
+                self.setFieldLanguageIndexOnMain(comboBox, language)
+
+                # progress bar
+                progress += 1
+                self.setProgressValue(progress)
             
             self.setProgressValue(progress_max)
         except:
@@ -393,6 +389,9 @@ class LanguageMappingDialog_UI(object):
             self.displayErrorMessage(error_message)
 
 
+    def setFieldLanguageIndexOnMain(self, comboBox, language):
+        self.languagetools.anki_utils.run_on_main(lambda: self.setFieldLanguageIndex(comboBox, language))
+
     def setProgressBarMax(self, progress_max):
         self.languagetools.anki_utils.run_on_main(lambda: self.autodetect_progressbar.setMaximum(progress_max))
 
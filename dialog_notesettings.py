@@ -7,12 +7,20 @@ if hasattr(sys, '_pytest_mode'):
     import deck_utils
     import gui_utils
     import errors
+    import job_journal
+    import batch_utils
+    import batch_planner
+    import rules_engine
     from languagetools import LanguageTools
 else:
     from . import constants
     from . import deck_utils
     from . import gui_utils
     from . import errors
+    from . import job_journal
+    from . import batch_utils
+    from . import batch_planner
+    from . import rules_engine
     from .languagetools import LanguageTools
 
 class NoteSettingsDialogBase(aqt.qt.QDialog):
@@ -315,9 +323,13 @@ class NoteSettingsDialog(NoteSettingsDialogBase):
 
 
 class RunRulesDialog(NoteSettingsDialogBase):
-    def __init__(self, languagetools: LanguageTools, deck_note_type: deck_utils.DeckNoteType, note_id_list):
+    def __init__(self, languagetools: LanguageTools, deck_note_type: deck_utils.DeckNoteType, note_id_list, resume_job=None):
         super(RunRulesDialog, self).__init__(languagetools, deck_note_type)
         self.note_id_list = note_id_list
+        # interrupted job from the job journal, this run replaces it
+        self.resume_job = resume_job
+        # set while the rules are running, the Cancel button stops the job
+        self.cancellation_token = None
         self.target_field_enabled_map = {}
         self.target_field_checkbox_map = {}
 
@@ -342,6 +354,12 @@ class RunRulesDialog(NoteSettingsDialogBase):
 
         self.layout_rules(vlayout)
 
+        if self.resume_job != None:
+            # restore the rules which were selected when the job was started
+            enabled_fields = self.resume_job['parameters']['enabled_fields']
+            for to_field, checkbox in self.target_field_checkbox_map.items():
+                checkbox.setChecked(to_field in enabled_fields)
+
         # progress bar
         hlayout = aqt.qt.QHBoxLayout()
         hlayout.setContentsMargins(0, 20, 0, 0)
@@ -353,6 +371,7 @@ class RunRulesDialog(NoteSettingsDialogBase):
         buttonBox = aqt.qt.QDialogButtonBox()
         self.applyButton = buttonBox.addButton("Apply Rules", aqt.qt.QDialogButtonBox.ButtonRole.AcceptRole)
         self.applyButton.setStyleSheet(self.languagetools.anki_utils.get_green_stylesheet())
+        self.estimateButton = buttonBox.addButton("Estimate", aqt.qt.QDialogButtonBox.ButtonRole.ActionRole)
         self.cancelButton = buttonBox.addButton("Cancel", aqt.qt.QDialogButtonBox.ButtonRole.RejectRole)
         self.cancelButton.setStyleSheet(self.languagetools.anki_utils.get_red_stylesheet())
         vlayout.addWidget(buttonBox)
@@ -360,105 +379,112 @@ class RunRulesDialog(NoteSettingsDialogBase):
         vlayout.addStretch()        
   
         # wire events
+        self.estimateButton.pressed.connect(self.show_estimate)
         buttonBox.accepted.connect(self.accept)
         buttonBox.rejected.connect(self.reject)
 
+    def show_estimate(self):
+        # dry run of the enabled rules, nothing gets sent to the server
+        rule_list = self.get_rule_list()
+        planner = batch_planner.BatchPlanner(self.languagetools)
+        self.languagetools.anki_utils.run_in_background(lambda: planner.plan(self.deck_note_type, rule_list, self.note_id_list), self.show_estimate_done)
+
+    def show_estimate_done(self, future_result):
+        with self.languagetools.error_manager.get_single_action_context('estimating rules'):
+            self.languagetools.anki_utils.info_message(batch_planner.plan_str(future_result.result()), self)
+
     def accept(self):
         proceed = self.languagetools.anki_utils.ask_user(f'Overwrite existing data in target fields ?', self)
         if proceed == False:
             # don't continue
             return
 
-        self.languagetools.anki_utils.run_in_background(self.process_rules_task, self.process_rules_task_done)
-
-    def verify_to_from_fields(self, note, from_dntf, to_dntf):
-        if from_dntf.field_name not in note:
-            raise errors.FieldNotFoundError(from_dntf)
-        if to_dntf.field_name not in note:
-            raise errors.FieldNotFoundError(to_dntf)
+        if self.resume_job != None and self.resume_job['fingerprint'] != self.get_rules_fingerprint():
+            proceed = self.languagetools.anki_utils.ask_user(f'Rules have changed since this job was started, continue with the current rules ?', self)
+            if proceed == False:
+                return
 
+        self.cancellation_token = batch_utils.CancellationToken()
+        self.languagetools.anki_utils.run_in_background(self.process_rules_task, self.process_rules_task_done)
 
+    def reject(self):
+        if self.cancellation_token != None:
+            # stop after the requests in flight, the notes done so far are kept
+            self.cancellation_token.cancel()
+            self.cancelButton.setText('Cancelling...')
+            self.cancelButton.setEnabled(False)
+        else:
+            super().reject()
 
     def process_rules_task(self):
         self.batch_error_manager = self.languagetools.error_manager.get_batch_error_manager('processing rules')
 
-        translation_settings = self.languagetools.get_batch_translation_settings(self.deck_note_type)
-        transliteration_settings = self.languagetools.get_batch_transliteration_settings(self.deck_note_type)
-        audio_settings = self.languagetools.get_batch_audio_settings(self.deck_note_type)
-
-        num_rules = 0
-        for rule_list in [translation_settings, transliteration_settings, audio_settings]:
-            for to_field, setting in rule_list.items():
-                if self.target_field_checkbox_map[to_field].isChecked():
-                    num_rules += 1
-
+        rule_list = self.get_rule_list()
+        num_rules = len(rule_list)
         logging.debug(f'num rules enabled: {num_rules}')
         self.languagetools.anki_utils.run_on_main(lambda: self.progress_bar.setMaximum(len(self.note_id_list) * num_rules))
 
         action_str = 'Process Rules'
         self.undo_id = self.languagetools.anki_utils.undo_start(action_str)
 
-        progress_value = 0
         self.generate_errors = []
-        for note_id in self.note_id_list:
-            note = self.languagetools.anki_utils.get_note_by_id(note_id)
-            need_to_flush = False
-            for to_field, setting in translation_settings.items():
-                if self.target_field_checkbox_map[to_field].isChecked():
-                    with self.batch_error_manager.get_batch_action_context(f'adding translation to field {to_field}'):
-                        from_field = setting['from_field']
-                        from_dntf = self.languagetools.deck_utils.build_dntf_from_dnt(self.deck_note_type, from_field)
-                        to_dntf = self.languagetools.deck_utils.build_dntf_from_dnt(self.deck_note_type, to_field)
-                        self.verify_to_from_fields(note, from_dntf, to_dntf)
-                        logging.info(f'generating translation from {from_dntf} to {to_dntf}')
-
-                        field_data = note[from_field]
-                        translation_option = setting['translation_option']
-                        translation_result = self.languagetools.get_translation(field_data, translation_option)
-                        note[to_field] = translation_result
-                        need_to_flush = True
-                    progress_value += 1
-                    self.languagetools.anki_utils.run_on_main(lambda: self.progress_bar.setValue(progress_value))
-            for to_field, setting in transliteration_settings.items():
-                if self.target_field_checkbox_map[to_field].isChecked():
-                    with self.batch_error_manager.get_batch_action_context(f'adding transliteration to field {to_field}'):
-                        from_field = setting['from_field']
-                        from_dntf = self.languagetools.deck_utils.build_dntf_from_dnt(self.deck_note_type, from_field)
-                        to_dntf = self.languagetools.deck_utils.build_dntf_from_dnt(self.deck_note_type, to_field)
-                        self.verify_to_from_fields(note, from_dntf, to_dntf)
-                        logging.info(f'generating transliteration from {from_dntf} to {to_dntf}')
-
-                        field_data = note[from_field]
-                        transliteration_option = setting['transliteration_option']
-                        transliteration_result = self.languagetools.get_transliteration(field_data, transliteration_option)
-                        note[to_field] = transliteration_result
-                        need_to_flush = True
-                    progress_value += 1
-                    self.languagetools.anki_utils.run_on_main(lambda: self.progress_bar.setValue(progress_value))
-            for to_field, from_field in audio_settings.items():
-                if self.target_field_checkbox_map[to_field].isChecked():
-                    with self.batch_error_manager.get_batch_action_context(f'adding audio to field {to_field}'):
-                        from_dntf = self.languagetools.deck_utils.build_dntf_from_dnt(self.deck_note_type, from_field)
-                        to_dntf = self.languagetools.deck_utils.build_dntf_from_dnt(self.deck_note_type, to_field)
-                        self.verify_to_from_fields(note, from_dntf, to_dntf)
-                        logging.info(f'generating audio from {from_dntf} to {to_dntf}')
-
-                        field_data = note[from_field]
-                        voice = self.languagetools.get_voice_for_field(from_dntf)
-                        result = self.languagetools.generate_audio_tag_collection(field_data, voice)
-                        note[to_field] = result['sound_tag']
-                        need_to_flush = True
-                    progress_value += 1
-                    self.languagetools.anki_utils.run_on_main(lambda: self.progress_bar.setValue(progress_value))
-
-            # write output to note
-            if need_to_flush:
-                self.languagetools.anki_utils.update_note(note)
 
+        # rules which read a field written by another rule run in a later stage, and see the values it wrote
+        engine = rules_engine.RulesEngine(self.languagetools, self.deck_note_type, rule_list, self.languagetools.get_batch_concurrency(),
+            self.cancellation_token)
+
+        # notes are processed and written in segments, each segment gets checkpointed in the job journal,
+        # so that an interrupted run can be resumed from the Browser menu
+        journal = self.languagetools.job_journal
+        if self.resume_job != None:
+            journal.discard_job(self.resume_job['job_id'])
+        job_id = journal.start_job(constants.JOB_TYPE_RUN_RULES, f'Run Rules for {self.deck_note_type}',
+            self.get_rules_fingerprint(), {'enabled_fields': self.get_enabled_fields()}, self.note_id_list)
+
+        progress = batch_utils.ProgressReporter(self.languagetools.anki_utils, self.progress_bar.setValue)
+        engine.process_notes(self.note_id_list, self.batch_error_manager, progress.increment,
+            lambda segment_note_id_list: journal.mark_done(job_id, segment_note_id_list))
+        progress.finish()
+        self.languagetools.flush_caches()
+
+        # the remaining notes (cancelled, or failed) can be processed with Resume Interrupted Job
+        self.remaining_count = len(journal.get_remaining_note_ids(job_id))
+        if self.cancellation_token.is_cancelled():
+            logging.info(f'job {job_id} cancelled')
+        elif self.remaining_count > 0:
+            logging.info(f'job {job_id} completed, {self.remaining_count} notes failed')
+        else:
+            journal.finish_job(job_id)
         self.languagetools.anki_utils.undo_end(self.undo_id)
 
+    def get_rule_list(self):
+        # enabled rules, in the order they are displayed
+        rule_list = rules_engine.build_rule_list(self.languagetools, self.deck_note_type)
+        return [rule for rule in rule_list if self.target_field_checkbox_map[rule['to_field']].isChecked()]
+
+    def get_enabled_fields(self):
+        return [to_field for to_field, checkbox in self.target_field_checkbox_map.items() if checkbox.isChecked()]
+
+    def get_rules_fingerprint(self):
+        return job_journal.get_fingerprint({
+            'translation': self.languagetools.get_batch_translation_settings(self.deck_note_type),
+            'transliteration': self.languagetools.get_batch_transliteration_settings(self.deck_note_type),
+            'audio': self.languagetools.get_batch_audio_settings(self.deck_note_type),
+            'enabled_fields': self.get_enabled_fields()
+        })
 
     def process_rules_task_done(self, future_result):
+        cancelled = self.cancellation_token.is_cancelled()
+        self.cancellation_token = None
         self.close()
-        self.batch_error_manager.display_stats(self)
+        if cancelled:
+            stats_str = self.batch_error_manager.get_stats_str()
+            stats_str += '<br/>\nCancelled, the remaining notes can be processed with <b>Resume Interrupted Job</b>.'
+            self.languagetools.anki_utils.info_message(stats_str, self)
+        elif self.remaining_count > 0:
+            stats_str = self.batch_error_manager.get_stats_str()
+            stats_str += f'<br/>\nThe {self.remaining_count} notes which failed can be retried with <b>Resume Interrupted Job</b>.'
+            self.languagetools.anki_utils.info_message(stats_str, self)
+        else:
+            self.batch_error_manager.display_stats(self)
 
@@ -15,12 +15,11 @@ else:
     from .languagetools import LanguageTools
 
 class VoiceSelectionDialog(aqt.qt.QDialog):
-    def __init__(self, languagetools: LanguageTools, voice_list):
+    def __init__(self, languagetools: LanguageTools):
         super(aqt.qt.QDialog, self).__init__()
         self.languagetools = languagetools
         
         # get list of languages
-        self.voice_list = voice_list
         wanted_language_arrays = languagetools.get_wanted_language_arrays()
         self.language_name_list = wanted_language_arrays['language_name_list']
         self.language_code_list = wanted_language_arrays['language_code_list']
@@ -141,9 +140,8 @@ class VoiceSelectionDialog(aqt.qt.QDialog):
         self.voice_select_callback_enabled = False
         self.language_code = self.language_code_list[current_index]
         self.language_name = self.language_name_list[current_index]
-        # filter voices that match this language
-        available_voices = [x for x in self.voice_list if x['language_code'] == self.language_code]
-        self.available_voices = sorted(available_voices, key=lambda x: x['voice_description'])
+        # voices that match this language, sorted by description
+        self.available_voices = self.languagetools.get_voices_for_language(self.language_code)
         available_voice_mappings = self.available_voices
         available_voice_names = [x['voice_description'] for x in self.available_voices]
         self.voice_combobox.clear()
@@ -235,7 +233,7 @@ class VoiceSelectionDialog(aqt.qt.QDialog):
 
 
 def prepare_voice_selection_dialog(languagetools):
-    voice_selection_dialog = VoiceSelectionDialog(languagetools, languagetools.voice_list)
+    voice_selection_dialog = VoiceSelectionDialog(languagetools)
     voice_selection_dialog.setupUi()
     return voice_selection_dialog
 
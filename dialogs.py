@@ -17,6 +17,9 @@ if hasattr(sys, '_pytest_mode'):
     import dialog_apikey
     import dialog_batchtransformation
     import dialog_notesettings
+    import job_journal
+    import batch_utils
+    import batch_planner
     from languagetools import LanguageTools
 else:
     from . import constants
@@ -28,16 +31,23 @@ else:
     from . import dialog_apikey
     from . import dialog_batchtransformation
     from . import dialog_notesettings
+    from . import job_journal
+    from . import batch_utils
+    from . import batch_planner
     from .languagetools import LanguageTools
 
 
 
 class AddAudioDialog(aqt.qt.QDialog):
-    def __init__(self, languagetools: LanguageTools, deck_note_type: deck_utils.DeckNoteType, note_id_list):
+    def __init__(self, languagetools: LanguageTools, deck_note_type: deck_utils.DeckNoteType, note_id_list, resume_job=None):
         super(aqt.qt.QDialog, self).__init__()
         self.languagetools = languagetools
         self.deck_note_type = deck_note_type
         self.note_id_list = note_id_list
+        # interrupted job from the job journal, this run replaces it
+        self.resume_job = resume_job
+        # set while audio is being added, the Cancel button stops the job
+        self.cancellation_token = None
 
         # get field list
         field_names = self.languagetools.deck_utils.get_field_names(self.deck_note_type)
@@ -118,12 +128,15 @@ class AddAudioDialog(aqt.qt.QDialog):
         buttonBox = aqt.qt.QDialogButtonBox()
         self.applyButton = buttonBox.addButton("Apply To Notes", aqt.qt.QDialogButtonBox.ButtonRole.AcceptRole)
         self.applyButton.setEnabled(False)
+        self.estimateButton = buttonBox.addButton("Estimate", aqt.qt.QDialogButtonBox.ButtonRole.ActionRole)
+        self.estimateButton.setEnabled(False)
         self.cancelButton = buttonBox.addButton("Cancel", aqt.qt.QDialogButtonBox.ButtonRole.RejectRole)
         self.cancelButton.setStyleSheet(self.languagetools.anki_utils.get_red_stylesheet())
 
         vlayout.addWidget(buttonBox)
 
         # wire events
+        self.estimateButton.pressed.connect(self.show_estimate)
         self.pick_default_fields()
         self.from_field_combobox.currentIndexChanged.connect(self.from_field_index_changed)
         self.to_field_combobox.currentIndexChanged.connect(self.to_field_index_changed)
@@ -138,10 +151,15 @@ class AddAudioDialog(aqt.qt.QDialog):
         self.to_field_index = 0
 
         # logging.debug(f'batch_audio_settings: {self.batch_audio_settings}')
-        if len(self.batch_audio_settings) > 0:
+        if len(self.batch_audio_settings) > 0 or self.resume_job != None:
             # logging.info(f'some batch audio settings found')
-            to_field = list(self.batch_audio_settings.keys())[0]
-            from_field = self.batch_audio_settings[to_field]
+            if self.resume_job != None:
+                # pick the fields the interrupted job was using
+                to_field = self.resume_job['parameters']['to_field']
+                from_field = self.resume_job['parameters']['from_field']
+            else:
+                to_field = list(self.batch_audio_settings.keys())[0]
+                from_field = self.batch_audio_settings[to_field]
             try:
                 from_field_index = self.from_field_name_list.index(from_field)
                 to_field_index = self.to_field_name_list.index(to_field)
@@ -174,12 +192,14 @@ class AddAudioDialog(aqt.qt.QDialog):
             self.voice_label.setText('<b>' + voice_description + '</b>')
             self.applyButton.setEnabled(True)
             self.applyButton.setStyleSheet(self.languagetools.anki_utils.get_green_stylesheet())
+            self.estimateButton.setEnabled(True)
         else:
             language_name = self.languagetools.get_language_name(from_language)
             self.voice_label.setText(f'No Voice setup for <b>{language_name}</b>. Please go to Anki main window, ' +
             '<b>Tools -> Language Tools: Voice Selection </b>')
             self.applyButton.setEnabled(False)
             self.applyButton.setStyleSheet(None)
+            self.estimateButton.setEnabled(False)
 
     def to_field_index_changed(self, field_index):
         self.to_field_index = field_index
@@ -187,9 +207,9 @@ class AddAudioDialog(aqt.qt.QDialog):
 
     def accept(self):
         to_fields_empty = True
+        field_values = self.languagetools.anki_utils.get_field_values_for_notes(self.note_id_list, [self.to_field])
         for note_id in self.note_id_list:
-            note = aqt.mw.col.getNote(note_id)
-            if len(note[self.to_field]) > 0:
+            if len(field_values[note_id][self.to_field]) > 0:
                 to_fields_empty = False
         if to_fields_empty == False:
             proceed = aqt.utils.askUser(f'Overwrite existing data in field {self.to_field} ?')
@@ -197,6 +217,11 @@ class AddAudioDialog(aqt.qt.QDialog):
                 # don't continue
                 return
 
+        if self.resume_job != None and self.resume_job['fingerprint'] != self.get_job_fingerprint():
+            proceed = self.languagetools.anki_utils.ask_user(f'Fields or voice have changed since this job was started, continue with the current settings ?', self)
+            if proceed == False:
+                return
+
         self.applyButton.setText('Adding Audio...')
         self.applyButton.setEnabled(False)
         self.applyButton.setStyleSheet(None)
@@ -208,25 +233,137 @@ class AddAudioDialog(aqt.qt.QDialog):
 
         self.success_count = 0
 
-        aqt.mw.taskman.run_in_background(self.add_audio_task, self.add_audio_task_done)
+        self.cancellation_token = batch_utils.CancellationToken()
+        self.languagetools.anki_utils.run_in_background(self.add_audio_task, self.add_audio_task_done)
+
+    def reject(self):
+        if self.cancellation_token != None:
+            # stop after the downloads in flight, the notes done so far are kept
+            self.cancellation_token.cancel()
+            self.cancelButton.setText('Cancelling...')
+            self.cancelButton.setEnabled(False)
+        else:
+            super().reject()
+
+    def show_estimate(self):
+        # dry run, counts the audio requests this would send
+        rule = {'type': constants.TransformationType.Audio, 'from_field': self.from_field, 'to_field': self.to_field,
+            'option': self.voice, 'action': f'adding audio to field {self.to_field}'}
+        planner = batch_planner.BatchPlanner(self.languagetools)
+        self.languagetools.anki_utils.run_in_background(lambda: planner.plan(self.deck_note_type, [rule], self.note_id_list), self.show_estimate_done)
+
+    def show_estimate_done(self, future_result):
+        with self.languagetools.error_manager.get_single_action_context('estimating audio requests'):
+            self.languagetools.anki_utils.info_message(batch_planner.plan_str(future_result.result()), self)
+
+    def get_job_fingerprint(self):
+        return job_journal.get_fingerprint({
+            'from_field': self.from_field,
+            'to_field': self.to_field,
+            'voice_key': self.voice['voice_key'],
+            'service': self.voice['service']
+        })
 
     def add_audio_task(self):
         action_str = f'Add Audio to {self.to_field}'
         undo_id = self.languagetools.anki_utils.undo_start(action_str)        
         self.generate_audio_errors = []
-        i = 0
-        for note_id in self.note_id_list:
-            try:
-                result = self.languagetools.generate_audio_for_field(note_id, self.from_field, self.to_field, self.voice)
-                if result == True:
-                    self.success_count += 1
-            except errors.LanguageToolsRequestError as err:
-                self.generate_audio_errors.append(str(err))
-            i += 1
-            aqt.mw.taskman.run_on_main(lambda: self.progress_bar.setValue(i))
+        self.request_stats_start = self.languagetools.get_request_stats()
+
+        # notes are written in segments, each segment gets checkpointed in the job journal,
+        # so that an interrupted run can be resumed from the Browser menu
+        journal = self.languagetools.job_journal
+        if self.resume_job != None:
+            journal.discard_job(self.resume_job['job_id'])
+        job_id = journal.start_job(constants.JOB_TYPE_ADD_AUDIO, f'Add Audio to {self.to_field} ({self.deck_note_type})',
+            self.get_job_fingerprint(), {'from_field': self.from_field, 'to_field': self.to_field}, self.note_id_list)
+
+        executor = batch_utils.BoundedExecutor(self.languagetools.get_batch_concurrency())
+        self.progress = batch_utils.ProgressReporter(self.languagetools.anki_utils, self.progress_bar.setValue)
+        # by processed text, the sound tags added in the earlier segments. the notes are grouped by text over the
+        # whole selection, like the estimate of the batch planner
+        self.sound_tags_by_text = {}
+        segment_size = constants.NOTE_UPDATE_CHUNK_SIZE
+        for segment_start in range(0, len(self.note_id_list), segment_size):
+            if self.cancellation_token.is_cancelled():
+                break
+            segment_note_id_list = self.note_id_list[segment_start:segment_start + segment_size]
+            done_note_id_list = self.add_audio_segment(executor, segment_note_id_list)
+            journal.mark_done(job_id, done_note_id_list)
+        self.progress.finish()
+        self.languagetools.flush_caches()
+
+        # the remaining notes (cancelled, or failed) can be processed with Resume Interrupted Job
+        self.remaining_count = len(journal.get_remaining_note_ids(job_id))
+        if self.cancellation_token.is_cancelled():
+            logging.info(f'job {job_id} cancelled')
+        elif self.remaining_count > 0:
+            logging.info(f'job {job_id} completed, {self.remaining_count} notes failed')
+        else:
+            journal.finish_job(job_id)
         self.languagetools.anki_utils.undo_end(undo_id)
 
+    def add_audio_segment(self, executor, note_id_list):
+        # returns the note ids which are done: written, or with nothing to write. the notes which failed, or which
+        # the job got cancelled before, remain in the job journal
+        field_values = self.languagetools.anki_utils.get_field_values_for_notes(note_id_list, [self.from_field])
+        source_text_list = [field_values[note_id][self.from_field] for note_id in note_id_list]
+
+        # notes with an empty field are skipped, the others are grouped by text, one download per distinct text
+        empty_list = [self.languagetools.text_utils.is_empty(source_text) for source_text in source_text_list]
+        pending_index_list = [i for i, empty in enumerate(empty_list) if not empty]
+        done_index_list = [i for i, empty in enumerate(empty_list) if empty]
+        modified_notes = []
+        request_index_list = []
+        processed_text_list = []
+        for i in pending_index_list:
+            processed_text = self.languagetools.text_utils.process(source_text_list[i], constants.TransformationType.Audio)
+            if processed_text in self.sound_tags_by_text:
+                # downloaded for an earlier segment
+                modified_notes.append(self.set_sound_tag(note_id_list[i], self.sound_tags_by_text[processed_text]))
+                done_index_list.append(i)
+            else:
+                request_index_list.append(i)
+                processed_text_list.append(processed_text)
+        self.progress.increment(len(done_index_list))
+        group_list = batch_utils.group_identical(processed_text_list)
+        group_text_list = [processed_text_list[group[0]] for group in group_list]
+        group_list = [[request_index_list[j] for j in group] for group in group_list]
+        self.languagetools.add_deduplicated_requests(len(pending_index_list) - len(group_list))
+
+        def download_audio(request):
+            # runs on a worker thread, doesn't touch the collection
+            group, processed_text = request
+            voice = self.voice
+            return self.languagetools.get_tts_audio(source_text_list[group[0]], voice['service'], voice['language_code'], voice['voice_key'], {})
+
+        # downloads run concurrently, media files and notes are only handled here, on a single thread
+        for (group, processed_text), generated_filename, exception in executor.run(download_audio, list(zip(group_list, group_text_list)), self.cancellation_token):
+            if exception != None:
+                self.generate_audio_errors.extend([str(exception)] * len(group))
+                if isinstance(exception, errors.LanguageToolsValidationFieldEmpty):
+                    # nothing left once processed, retrying won't change that
+                    done_index_list.extend(group)
+            else:
+                sound_tag = self.languagetools.add_audio_to_collection(generated_filename)['sound_tag']
+                if sound_tag != None:
+                    self.sound_tags_by_text[processed_text] = sound_tag
+                    for i in group:
+                        modified_notes.append(self.set_sound_tag(note_id_list[i], sound_tag))
+                    done_index_list.extend(group)
+            self.progress.increment(len(group))
+        self.languagetools.anki_utils.update_notes(modified_notes)
+        return [note_id_list[i] for i in sorted(done_index_list)]
+
+    def set_sound_tag(self, note_id, sound_tag):
+        note = self.languagetools.anki_utils.get_note_by_id(note_id)
+        note[self.to_field] = sound_tag
+        self.success_count += 1
+        return note
+
     def add_audio_task_done(self, future_result):
+        cancelled = self.cancellation_token.is_cancelled()
+        self.cancellation_token = None
         # are there any errors ?
         errors_str = ''
         if len(self.generate_audio_errors) > 0:
@@ -236,6 +373,13 @@ class AddAudioDialog(aqt.qt.QDialog):
                 error_counts[error] = current_count + 1
             errors_str = '<p><b>Errors</b>: ' + ', '.join([f'{key} ({value} times)' for key, value in error_counts.items()]) + '</p>'
         completion_message = f"Added Audio to field <b>{self.to_field}</b> using voice <b>{self.voice['voice_description']}</b>. Success: <b>{self.success_count}</b> out of <b>{len(self.note_id_list)}</b>.{errors_str}"
+        if cancelled:
+            completion_message += '<p>Cancelled, the remaining notes can be processed with <b>Resume Interrupted Job</b>.</p>'
+        elif self.remaining_count > 0:
+            completion_message += f'<p>The {self.remaining_count} notes which failed can be retried with <b>Resume Interrupted Job</b>.</p>'
+        request_stats = errors.request_stats_str(self.request_stats_start, self.languagetools.get_request_stats())
+        if len(request_stats) > 0:
+            completion_message += f'<p>{request_stats}</p>'
         self.close()
         if len(errors_str) > 0:
             aqt.utils.showWarning(completion_message, title=constants.ADDON_NAME, parent=self)
@@ -387,12 +531,12 @@ def add_translation_dialog(languagetools, browser: aqt.browser.Browser, note_id_
 def add_transliteration_dialog(languagetools, browser: aqt.browser.Browser, note_id_list):
     add_transformation_dialog(languagetools, browser, note_id_list, constants.TransformationType.Transliteration)
 
-def run_rules_dialog(languagetools, browser: aqt.browser.Browser, note_id_list):
+def run_rules_dialog(languagetools, browser: aqt.browser.Browser, note_id_list, resume_job=None):
     deck_note_type = verify_deck_note_type_consistent(note_id_list, languagetools.deck_utils)
     if deck_note_type == None:
         return
 
-    dialog = dialog_notesettings.RunRulesDialog(languagetools, deck_note_type, note_id_list)
+    dialog = dialog_notesettings.RunRulesDialog(languagetools, deck_note_type, note_id_list, resume_job=resume_job)
     dialog.setupUi()
     dialog.exec()
 
@@ -408,7 +552,7 @@ def show_settings_dialog(languagetools, browser: aqt.browser.Browser, note_id_li
     dialog.setupUi()
     dialog.exec()
 
-def add_audio_dialog(languagetools, browser: aqt.browser.Browser, note_id_list):
+def add_audio_dialog(languagetools, browser: aqt.browser.Browser, note_id_list, resume_job=None):
     # did the user perform language mapping ? 
     if not languagetools.language_detection_done():
         aqt.utils.showInfo(text='Please setup Language Mappings, from the Anki main screen: Tools -> Language Tools: Language Mapping', title=constants.ADDON_NAME)
@@ -419,7 +563,7 @@ def add_audio_dialog(languagetools, browser: aqt.browser.Browser, note_id_list):
         return
 
     try:
-        dialog = AddAudioDialog(languagetools, deck_note_type, note_id_list)
+        dialog = AddAudioDialog(languagetools, deck_note_type, note_id_list, resume_job=resume_job)
         dialog.setupUi()
         dialog.exec()
 
@@ -432,6 +576,30 @@ def add_audio_dialog(languagetools, browser: aqt.browser.Browser, note_id_list):
         aqt.utils.showCritical(final_message, title=constants.ADDON_NAME)
 
 
+def resume_job_dialog(languagetools, browser: aqt.browser.Browser):
+    job_list = languagetools.job_journal.get_interrupted_jobs()
+    if len(job_list) == 0:
+        aqt.utils.showInfo(text='No interrupted jobs to resume.', title=constants.ADDON_NAME)
+        return
+
+    job_description_list = [f"{job['description']}: {job['remaining']} out of {job['total']} notes remaining" for job in job_list]
+    chosen_index = aqt.utils.chooseList(f'{constants.MENU_PREFIX} Choose Job to Resume', job_description_list)
+    job = job_list[chosen_index]
+
+    # leave out notes which were deleted since the job was interrupted
+    remaining_note_id_list = languagetools.job_journal.get_remaining_note_ids(job['job_id'])
+    existing_notes = languagetools.anki_utils.get_field_values_for_notes(remaining_note_id_list, [])
+    note_id_list = [note_id for note_id in remaining_note_id_list if note_id in existing_notes]
+    if len(note_id_list) == 0:
+        languagetools.job_journal.discard_job(job['job_id'])
+        aqt.utils.showInfo(text='All the remaining notes of this job have been deleted.', title=constants.ADDON_NAME)
+        return
+
+    if job['job_type'] == constants.JOB_TYPE_ADD_AUDIO:
+        add_audio_dialog(languagetools, browser, note_id_list, resume_job=job)
+    elif job['job_type'] == constants.JOB_TYPE_RUN_RULES:
+        run_rules_dialog(languagetools, browser, note_id_list, resume_job=job)
+
 def show_api_key_dialog(languagetools):
     dialog = dialog_apikey.prepare_api_key_dialog(languagetools)
     dialog.exec()
\ No newline at end of file
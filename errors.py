@@ -93,11 +93,24 @@ class BatchActionContext():
         self.batch_error_manager.report_success(self.action)
         return False
 
+def request_stats_str(stats_start, stats_end):
+    # retries, throttling and deduplication which happened between two snapshots of the request stats, empty if none
+    retries = stats_end['retries'] - stats_start['retries']
+    throttled = stats_end['throttled'] - stats_start['throttled']
+    deduplicated = stats_end.get('deduplicated', 0) - stats_start.get('deduplicated', 0)
+    stats_list = []
+    if retries > 0 or throttled > 0:
+        stats_list.append(f'Retried requests: {retries}, throttled by server: {throttled}')
+    if deduplicated > 0:
+        stats_list.append(f'Requests saved on duplicate text: {deduplicated}')
+    return ', '.join(stats_list)
+
 class BatchErrorManager():
     def __init__(self, error_manager, batch_action):
         self.error_manager = error_manager
         self.batch_action = batch_action
         self.action_stats = {}
+        self.request_stats_start = self.error_manager.get_request_stats()
 
     def get_batch_action_context(self, action):
         return BatchActionContext(self, action)
@@ -144,6 +157,9 @@ class BatchErrorManager():
         action_html_list = [f'<b>Finished {self.batch_action}.</b><br/>']
         for action, action_data in self.action_stats.items():
             action_html_list.append(self.action_stats_str(action, action_data))
+        request_stats = request_stats_str(self.request_stats_start, self.error_manager.get_request_stats())
+        if len(request_stats) > 0:
+            action_html_list.append(request_stats)
         action_html = '<br/>\n'.join(action_html_list)
         return action_html
 
@@ -153,8 +169,14 @@ class BatchErrorManager():
 
 
 class ErrorManager():
-    def __init__(self, anki_utils):
+    def __init__(self, anki_utils, request_stats_fn=None):
         self.anki_utils = anki_utils
+        self.request_stats_fn = request_stats_fn
+
+    def get_request_stats(self):
+        if self.request_stats_fn == None:
+            return {'retries': 0, 'throttled': 0}
+        return self.request_stats_fn()
 
     def report_single_exception(self, exception, action):
         self.anki_utils.report_known_exception_interactive(exception, action)
@@ -0,0 +1,84 @@
+import sys
+import re
+import random
+import logging
+import anki.utils
+
+if hasattr(sys, '_pytest_mode'):
+    import constants
+    import errors
+else:
+    from . import constants
+    from . import errors
+
+# the image tags are removed before the html is stripped, html_to_text_line would keep the image filename
+STRIP_IMAGES_RE = re.compile("(?i)<img[^>]+src=[\"']?([^\"'>]+)[\"']?[^>]*>")
+
+def sample_note_ids(db_all, deck_id, model_id, sample_size):
+    # random notes of a Deck / Note Type, db_all runs a query and returns the rows.
+    # sqlite runs ORDER BY RANDOM() LIMIT n with a sorter which only keeps n rows, the matching cards are scanned once and never
+    # sorted as a whole. reading all the note ids and sampling them in python is slower, the ids have to be sent over from the
+    # collection backend (see test_benchmark_sample_note_ids). the notes are selected before the LIMIT applies, a note with
+    # several cards in the deck is only picked once, and doesn't take the place of another note.
+    sql_query = f'SELECT id FROM notes WHERE mid={model_id} AND id IN (SELECT nid FROM cards WHERE did={deck_id}) ORDER BY RANDOM() LIMIT {sample_size}'
+    return [entry[0] for entry in db_all(sql_query)]
+
+def get_field_values_for_notes(db_all, get_model, note_id_list, field_name_list):
+    # read some fields for many notes straight from the notes table, without building a Note object for each.
+    # returns a dict note_id -> {field_name: value}, fields which don't exist on the note type are left out
+    field_values = {}
+    field_index_map = {} # by model id
+    chunk_size = constants.NOTE_QUERY_CHUNK_SIZE
+    for chunk_start in range(0, len(note_id_list), chunk_size):
+        chunk = note_id_list[chunk_start:chunk_start + chunk_size]
+        sql_query = f'SELECT id, mid, flds FROM notes WHERE id IN {anki.utils.ids2str(chunk)}'
+        for note_id, model_id, flds in db_all(sql_query):
+            if model_id not in field_index_map:
+                model_field_names = [x['name'] for x in get_model(model_id)['flds']]
+                field_index_map[model_id] = {field_name: model_field_names.index(field_name) for field_name in field_name_list if field_name in model_field_names}
+            note_fields = anki.utils.split_fields(flds)
+            field_values[note_id] = {field_name: note_fields[index] for field_name, index in field_index_map[model_id].items()}
+    return field_values
+
+class FieldSampler():
+    # samples of the field values of a Deck / Note Type, used for language detection and to show the user what's in a field.
+    # the sampled notes are read once, along with all the fields of the note type, and the same notes are used for every
+    # field of that Deck / Note Type for the lifetime of the sampler.
+
+    def __init__(self, languagetools, sample_size):
+        self.languagetools = languagetools
+        self.sample_size = sample_size
+        self.field_samples = {} # by deck_note_type, dict field_name -> list of samples
+
+    def get_field_samples(self, deck_note_type_field):
+        deck_note_type = deck_note_type_field.deck_note_type
+        if deck_note_type not in self.field_samples:
+            self.field_samples[deck_note_type] = self.load_field_samples(deck_note_type)
+        field_samples = self.field_samples[deck_note_type]
+        if deck_note_type_field.field_name not in field_samples:
+            # field was removed
+            raise errors.AnkiItemNotFoundError(f'field {deck_note_type_field.field_name} not found')
+        return field_samples[deck_note_type_field.field_name]
+
+    def load_field_samples(self, deck_note_type):
+        field_name_list = self.languagetools.deck_utils.get_field_names(deck_note_type)
+        note_id_list = list(self.languagetools.get_noteids_for_deck_note_type(deck_note_type, self.sample_size))
+        field_values = self.languagetools.anki_utils.get_field_values_for_notes(note_id_list, field_name_list)
+
+        field_samples = {field_name: [] for field_name in field_name_list}
+        for note_id in note_id_list:
+            for field_name, field_value in field_values.get(note_id, {}).items():
+                sample = self.process_field_value(field_value)
+                if len(sample) > 0:
+                    field_samples[field_name].append(sample)
+
+        for field_name, sample_list in field_samples.items():
+            if len(sample_list) > self.sample_size:
+                field_samples[field_name] = random.sample(sample_list, self.sample_size)
+        logging.debug(f'loaded field samples for {deck_note_type}: {len(note_id_list)} notes, {len(field_name_list)} fields')
+        return field_samples
+
+    def process_field_value(self, field_value):
+        field_value = STRIP_IMAGES_RE.sub('', field_value)
+        field_value = self.languagetools.anki_utils.html_to_text_line(field_value)
+        return field_value[:constants.FIELD_SAMPLE_MAX_LENGTH]
@@ -50,6 +50,29 @@ def init(languagetools):
     def show_api_key_dialog():
         dialogs.show_api_key_dialog(languagetools)
 
+    def show_clear_translation_cache():
+        # when a service changed its output, its cached translations / transliterations can be removed
+        service_list = languagetools.get_translation_cache_services()
+        if len(service_list) == 0:
+            aqt.utils.showInfo('The translation cache is empty.', title=constants.ADDON_NAME)
+            return
+        choice_list = ['All Services'] + service_list
+        chosen_index = aqt.utils.chooseList(f'{constants.MENU_PREFIX} Clear cached translations and transliterations of', choice_list)
+        service = None if chosen_index == 0 else service_list[chosen_index - 1]
+        if not aqt.utils.askUser(f'Remove the cached translations and transliterations of {choice_list[chosen_index]} ?'):
+            return
+        languagetools.invalidate_translation_cache(service)
+        aqt.utils.tooltip(f'Removed the cached translations and transliterations of {choice_list[chosen_index]}')
+
+    def show_cache_statistics():
+        aqt.utils.showInfo(languagetools.get_cache_stats_str(), title=f'{constants.MENU_PREFIX} Cache Statistics', textFormat="rich")
+
+    def show_clear_audio_cache():
+        if not aqt.utils.askUser('Remove all the audio files cached by Language Tools ? Audio already added to notes is not affected.'):
+            return
+        languagetools.clean_user_files_audio()
+        aqt.utils.tooltip('Removed the cached audio files')
+
     # unused for now
     def show_change_language(deck_note_type_field: deck_utils.DeckNoteTypeField):
         current_language = languagetools.get_language(deck_note_type_field)
@@ -117,6 +140,18 @@ def init(languagetools):
     action.triggered.connect(show_api_key_dialog)
     aqt.mw.form.menuTools.addAction(action)    
 
+    action = aqt.qt.QAction(f"{constants.MENU_PREFIX} Clear Translation Cache", aqt.mw)
+    action.triggered.connect(show_clear_translation_cache)
+    aqt.mw.form.menuTools.addAction(action)
+
+    action = aqt.qt.QAction(f"{constants.MENU_PREFIX} Clear Audio Cache", aqt.mw)
+    action.triggered.connect(show_clear_audio_cache)
+    aqt.mw.form.menuTools.addAction(action)
+
+    action = aqt.qt.QAction(f"{constants.MENU_PREFIX} Cache Statistics", aqt.mw)
+    action.triggered.connect(show_cache_statistics)
+    aqt.mw.form.menuTools.addAction(action)
+
     action = aqt.qt.QAction(f"{constants.MENU_PREFIX} Yomichan Integration", aqt.mw)
     action.triggered.connect(show_yomichan_integration)
     aqt.mw.form.menuTools.addAction(action)        
@@ -137,10 +172,15 @@ def init(languagetools):
     def deckBrowserDidRender(deck_browser: aqt.deckbrowser.DeckBrowser):
         languagetools.setDeckBrowserRendered()
 
+    def profileWillClose():
+        languagetools.shutdown()
+
     # run some stuff after anki has initialized
     aqt.gui_hooks.collection_did_load.append(collectionDidLoad)
     aqt.gui_hooks.main_window_did_init.append(mainWindowInit)
     aqt.gui_hooks.deck_browser_did_render.append(deckBrowserDidRender)
+    # release network resources when the profile closes
+    aqt.gui_hooks.profile_will_close.append(profileWillClose)
 
     def browerMenusInit(browser: aqt.browser.Browser):
         menu = aqt.qt.QMenu(constants.ADDON_NAME, browser.form.menubar)
@@ -166,5 +206,9 @@ def init(languagetools):
         action.triggered.connect(lambda: dialogs.show_settings_dialog(languagetools, browser, browser.selectedNotes()))
         menu.addAction(action)                
 
+        action = aqt.qt.QAction(f'Resume Interrupted Job...', browser)
+        action.triggered.connect(lambda: dialogs.resume_job_dialog(languagetools, browser))
+        menu.addAction(action)
+
     # browser menus
     aqt.gui_hooks.browser_menus_did_init.append(browerMenusInit)
\ No newline at end of file
@@ -0,0 +1,221 @@
+import sys
+import os
+import json
+import logging
+import argparse
+
+if __name__ == '__main__':
+    # bundled dependencies (sentry_sdk), the add-on's __init__ only adds them to the path when running inside Anki
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'external'))
+
+import anki.lang
+import anki.utils
+import anki.collection
+
+if hasattr(sys, '_pytest_mode'):
+    import constants
+    import errors
+    import deck_utils
+    import languagetools
+    import cloudlanguagetools
+    import rules_engine
+    import batch_planner
+    import field_sampler
+else:
+    from . import constants
+    from . import errors
+    from . import deck_utils
+    from . import languagetools
+    from . import cloudlanguagetools
+    from . import rules_engine
+    from . import batch_planner
+    from . import field_sampler
+
+# run the stored rules (translation, transliteration, audio) over a collection file, without the Anki GUI. only the anki
+# package is needed, not aqt. from the addons21 directory, with the add-on installed in addons21/771677663:
+# python -m 771677663.headless --collection collection.anki2 --config config.json [--deck Deck] [--note-type "Note Type"] [--dry-run]
+
+class HeadlessAnkiUtils():
+    # the subset of AnkiUtils used by the batch operations, on a collection opened directly
+    # instead of aqt.mw.col. the add-on config is read from / written to a json file.
+
+    def __init__(self, col, config_path, output=None):
+        self.col = col
+        self.config_path = config_path
+        self.output = output if output != None else sys.stdout
+
+    def get_config(self):
+        with open(self.config_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def write_config(self, config):
+        with open(self.config_path, 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=4)
+
+    def html_to_text_line(self, html):
+        # goes through the i18n backend, the collection is opened on it by open_collection
+        return anki.utils.html_to_text_line(html)
+
+    def html_to_text(self, html):
+        # keep line breaks
+        return '\n'.join([self.html_to_text_line(line) for line in html.split('<br/>')]).strip()
+
+    def get_collection_key(self):
+        return self.col.path
+
+    def get_deckid_modelid_pairs(self):
+        return self.col.db.all("select did, mid from notes inner join cards on notes.id = cards.nid group by mid, did")
+
+    def get_noteids_for_deck_note_type(self, deck_id, model_id, sample_size):
+        return field_sampler.sample_note_ids(self.col.db.all, deck_id, model_id, sample_size)
+
+    def get_all_noteids_for_deck_note_type(self, deck_id, model_id):
+        sql_query = f'SELECT DISTINCT notes.id FROM notes INNER JOIN cards ON notes.id = cards.nid WHERE notes.mid={model_id} AND cards.did={deck_id} ORDER BY notes.id'
+        return [entry[0] for entry in self.col.db.all(sql_query)]
+
+    def get_note_by_id(self, note_id):
+        return self.col.get_note(note_id)
+
+    def get_field_values_for_notes(self, note_id_list, field_name_list):
+        return field_sampler.get_field_values_for_notes(self.col.db.all, self.get_model, note_id_list, field_name_list)
+
+    def get_model(self, model_id):
+        return self.col.models.get(model_id)
+
+    def get_deck(self, deck_id):
+        return self.col.decks.get(deck_id)
+
+    def get_model_id(self, model_name):
+        return self.col.models.id_for_name(model_name)
+
+    def get_deck_id(self, deck_name):
+        return self.col.decks.id_for_name(deck_name)
+
+    def media_add_file(self, filename):
+        return self.col.media.add_file(filename)
+
+    def info_message(self, message, parent):
+        print(self.html_to_text(message), file=self.output)
+
+    def critical_message(self, message, parent):
+        print(f'error: {self.html_to_text(message)}', file=self.output)
+
+    def ask_user(self, message, parent):
+        # the command line arguments are the user's answer
+        return True
+
+    def undo_start(self, action_name):
+        return None
+
+    def undo_end(self, undo_id):
+        pass
+
+    def update_note(self, note):
+        self.col.update_note(note)
+
+    def update_notes(self, notes):
+        chunk_size = constants.NOTE_UPDATE_CHUNK_SIZE
+        for chunk_start in range(0, len(notes), chunk_size):
+            self.col.update_notes(notes[chunk_start:chunk_start + chunk_size])
+
+    def report_known_exception_interactive(self, exception, action):
+        logging.warning(f'Encountered an error while {action}: {str(exception)}')
+
+    def report_unknown_exception_interactive(self, exception, action):
+        logging.error(f'Encountered an unknown error while {action}: {str(exception)}')
+
+    def report_unknown_exception_background(self, exception):
+        logging.error(f'Encountered an unknown error: {str(exception)}')
+
+
+class ProgressPrinter():
+    # prints a line every time another 10% of the work is done
+    def __init__(self, description, total, output):
+        self.description = description
+        self.total = total
+        self.output = output
+        self.value = 0
+        self.printed_step = 0
+
+    def increment(self, count):
+        self.value += count
+        step = int(self.value * 10 / max(1, self.total))
+        if step > self.printed_step:
+            self.printed_step = step
+            print(f'{self.description}: {self.value} / {self.total}', file=self.output)
+
+
+def run_rules(languagetools_instance, deck_name=None, note_type_name=None, dry_run=False):
+    # apply the stored rules to every Deck / Note Type which has some, optionally restricted to one deck and / or note type.
+    # returns the stats of each Deck / Note Type processed, as a list of strings. with dry_run, nothing gets sent
+    # or written, the estimate of each Deck / Note Type is returned instead
+    anki_utils = languagetools_instance.anki_utils
+    output = anki_utils.output
+    stats_list = []
+    for deck_id, model_id in anki_utils.get_deckid_modelid_pairs():
+        deck_note_type = languagetools_instance.deck_utils.build_deck_note_type(deck_id, model_id)
+        if deck_name != None and deck_note_type.deck_name != deck_name:
+            continue
+        if note_type_name != None and deck_note_type.model_name != note_type_name:
+            continue
+        rule_list = rules_engine.build_rule_list(languagetools_instance, deck_note_type)
+        if len(rule_list) == 0:
+            continue
+
+        note_id_list = anki_utils.get_all_noteids_for_deck_note_type(deck_id, model_id)
+        print(f'Run Rules for {deck_note_type}: {len(rule_list)} rules, {len(note_id_list)} notes', file=output)
+        if dry_run:
+            plan = batch_planner.BatchPlanner(languagetools_instance).plan(deck_note_type, rule_list, note_id_list)
+            estimate = batch_planner.plan_str(plan)
+            anki_utils.info_message(estimate, None)
+            stats_list.append(estimate)
+            continue
+        batch_error_manager = languagetools_instance.error_manager.get_batch_error_manager(f'processing rules for {deck_note_type}')
+        progress = ProgressPrinter(str(deck_note_type), len(note_id_list) * len(rule_list), output)
+        engine = rules_engine.RulesEngine(languagetools_instance, deck_note_type, rule_list, languagetools_instance.get_batch_concurrency())
+        engine.process_notes(note_id_list, batch_error_manager, progress.increment)
+        stats = batch_error_manager.get_stats_str()
+        anki_utils.info_message(stats, None)
+        stats_list.append(stats)
+    return stats_list
+
+def open_collection(collection_path):
+    # like the Anki GUI does, the collection is opened on the backend of the current language: anki.utils.html_to_text_line
+    # goes through that backend, and only works once it has a collection open
+    if anki.lang.current_i18n == None:
+        anki.lang.set_lang('en_US')
+    return anki.collection.Collection(os.path.abspath(collection_path), backend=anki.lang.current_i18n)
+
+def build_languagetools(col, config_path, output=None):
+    anki_utils = HeadlessAnkiUtils(col, config_path, output)
+    deckutils = deck_utils.DeckUtils(anki_utils)
+    languagetools_instance = languagetools.LanguageTools(anki_utils, deckutils, cloudlanguagetools.CloudLanguageTools())
+    languagetools_instance.initialize()
+    if languagetools_instance.initialization_error:
+        languagetools_instance.shutdown()
+        raise errors.LanguageToolsError('Could not verify API key or load language data from server')
+    return languagetools_instance
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=f'{constants.ADDON_NAME}: run rules on an Anki collection, without the Anki GUI')
+    parser.add_argument('--collection', required=True, help='path to the .anki2 collection file, Anki must not have it open')
+    parser.add_argument('--config', required=True, help='path to the add-on config (json), with the api key and rules')
+    parser.add_argument('--deck', help='only process this deck')
+    parser.add_argument('--note-type', help='only process this note type')
+    parser.add_argument('--dry-run', action='store_true', help='only show the number of requests / characters the rules would send')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.WARNING)
+
+    col = open_collection(args.collection)
+    try:
+        languagetools_instance = build_languagetools(col, args.config)
+        try:
+            run_rules(languagetools_instance, deck_name=args.deck, note_type_name=args.note_type, dry_run=args.dry_run)
+        finally:
+            languagetools_instance.shutdown()
+    finally:
+        col.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
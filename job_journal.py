@@ -0,0 +1,114 @@
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+
+class JobJournal():
+    # on-disk checkpoint of long running batch jobs (add audio, run rules). every note in the job is recorded,
+    # and marked as done once it's been written to the collection. if anki crashes or the job gets interrupted,
+    # the remaining notes can be processed later.
+
+    def __init__(self, db_path, get_collection_key):
+        # the journal lives in the add-on's user_files, which every profile shares. jobs are recorded along with
+        # get_collection_key(), and only the jobs of the collection currently open are offered for resuming.
+        self.db_path = db_path
+        self.get_collection_key = get_collection_key
+        self.lock = threading.Lock()
+        self.db_connection = None
+
+    @property
+    def connection(self):
+        # opened on first use, and again after close(), when the next profile opens
+        if self.db_connection == None:
+            self.db_connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db_connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_type TEXT,
+                description TEXT,
+                fingerprint TEXT,
+                parameters TEXT,
+                created REAL,
+                collection TEXT)''')
+            self.db_connection.execute('''CREATE TABLE IF NOT EXISTS job_notes (
+                job_id INTEGER,
+                note_id INTEGER,
+                done INTEGER,
+                PRIMARY KEY (job_id, note_id))''')
+            column_list = [row[1] for row in self.db_connection.execute('PRAGMA table_info(jobs)').fetchall()]
+            if 'collection' not in column_list:
+                # journal written by a previous version, its jobs can't be attributed to a collection anymore
+                self.db_connection.execute('ALTER TABLE jobs ADD COLUMN collection TEXT')
+            self.db_connection.commit()
+        return self.db_connection
+
+    def start_job(self, job_type, description, fingerprint, parameters, note_id_list):
+        collection_key = self.get_collection_key()
+        with self.lock:
+            cursor = self.connection.execute('INSERT INTO jobs (job_type, description, fingerprint, parameters, created, collection) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_type, description, fingerprint, json.dumps(parameters), time.time(), collection_key))
+            job_id = cursor.lastrowid
+            self.connection.executemany('INSERT OR IGNORE INTO job_notes (job_id, note_id, done) VALUES (?, ?, 0)',
+                [(job_id, note_id) for note_id in note_id_list])
+            self.connection.commit()
+        logging.info(f'started job {job_id}: {description}, {len(note_id_list)} notes')
+        return job_id
+
+    def mark_done(self, job_id, note_id_list):
+        with self.lock:
+            self.connection.executemany('UPDATE job_notes SET done=1 WHERE job_id=? AND note_id=?',
+                [(job_id, note_id) for note_id in note_id_list])
+            self.connection.commit()
+
+    def finish_job(self, job_id):
+        # the job completed, nothing left to resume
+        self.discard_job(job_id)
+        logging.info(f'finished job {job_id}')
+
+    def discard_job(self, job_id):
+        with self.lock:
+            self.connection.execute('DELETE FROM job_notes WHERE job_id=?', (job_id,))
+            self.connection.execute('DELETE FROM jobs WHERE job_id=?', (job_id,))
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM job_notes')
+            self.connection.execute('DELETE FROM jobs')
+            self.connection.commit()
+
+    def get_remaining_note_ids(self, job_id):
+        with self.lock:
+            rows = self.connection.execute('SELECT note_id FROM job_notes WHERE job_id=? AND done=0 ORDER BY rowid', (job_id,)).fetchall()
+            return [row[0] for row in rows]
+
+    def get_interrupted_jobs(self):
+        # jobs of the current collection which were started but never finished, most recent first
+        collection_key = self.get_collection_key()
+        with self.lock:
+            rows = self.connection.execute('''SELECT jobs.job_id, job_type, description, fingerprint, parameters, created,
+                COUNT(job_notes.note_id), COALESCE(SUM(job_notes.done), 0)
+                FROM jobs LEFT JOIN job_notes ON jobs.job_id = job_notes.job_id
+                WHERE jobs.collection=?
+                GROUP BY jobs.job_id ORDER BY created DESC''', (collection_key,)).fetchall()
+        return [{
+            'job_id': job_id,
+            'job_type': job_type,
+            'description': description,
+            'fingerprint': fingerprint,
+            'parameters': json.loads(parameters),
+            'created': created,
+            'total': total,
+            'remaining': total - done
+        } for job_id, job_type, description, fingerprint, parameters, created, total, done in rows]
+
+    def close(self):
+        with self.lock:
+            if self.db_connection != None:
+                self.db_connection.close()
+                self.db_connection = None
+
+def get_fingerprint(data):
+    # identifies the rules / options a job was started with
+    return hashlib.sha224(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
@@ -0,0 +1,129 @@
+import sys
+import re
+import logging
+
+if hasattr(sys, '_pytest_mode'):
+    import constants
+else:
+    from . import constants
+
+# decides the language of a field locally, from the unicode script of its samples, when the answer is obvious:
+# sound tags, fields without any letters, and the scripts which are used by a single language out of the ones the server lists.
+# everything else (latin, chinese characters on their own, mixed scripts) gets sent to the detect api.
+
+# a sample made only of sound tags, or of audio filenames: html_to_text_line replaces the sound tags with the filename
+SOUND_SAMPLE_RE = re.compile(r'^(\s*(\[sound:[^\]]+\]|[^\s\[\]]+\.(mp3|ogg|wav|m4a|aac|flac|opus|webm)))+\s*$', re.IGNORECASE)
+
+# (first code point, last code point, script)
+SCRIPT_RANGES = [
+    (0x0370, 0x03FF, 'greek'),
+    (0x1F00, 0x1FFF, 'greek'),
+    (0x0400, 0x052F, 'cyrillic'),
+    (0x0530, 0x058F, 'armenian'),
+    (0x0590, 0x05FF, 'hebrew'),
+    (0x0E00, 0x0E7F, 'thai'),
+    (0x10A0, 0x10FF, 'georgian'),
+    (0x1100, 0x11FF, 'hangul'),
+    (0x3040, 0x309F, 'kana'),
+    (0x30A0, 0x30FF, 'kana'),
+    (0x3130, 0x318F, 'hangul'),
+    (0x31F0, 0x31FF, 'kana'),
+    (0x3400, 0x4DBF, 'han'),
+    (0x4E00, 0x9FFF, 'han'),
+    (0xAC00, 0xD7AF, 'hangul'),
+    (0xF900, 0xFAFF, 'han'),
+    (0xFF66, 0xFF9F, 'kana'),
+]
+
+# the languages written in each script (kana and hangul: the samples can also have chinese characters). a script only decides
+# the language when the server lists a single one of them, hebrew for example is also used by yiddish and ladino
+SCRIPT_LANGUAGES = {
+    'kana': ['ja'],
+    'hangul': ['ko'],
+    'greek': ['el', 'grc'],
+    'armenian': ['hy'],
+    'hebrew': ['he', 'yi', 'lad'],
+    'thai': ['th'],
+    'georgian': ['ka'],
+}
+
+# cyrillic is russian when a sample has one of the letters ukrainian, bulgarian, serbian, macedonian don't use, and none of
+# the letters russian doesn't use, the other alphabets with ы, э or ё have some of their own (belarusian, kazakh, kyrgyz,
+# mongolian, tatar, bashkir, chuvash, tajik, yakut...)
+RUSSIAN_LETTERS = set('ыэё')
+NON_RUSSIAN_CYRILLIC_LETTERS = set('іїєґўђјљњћџѓќѕәөүңғқұһҗҳӣӯҙҡҫӑӗӳҷҕҥӧӓӱӹӝӟӥӵӏҝ')
+# written with the russian letters only, russian isn't decided locally when the server lists one of them (erzya, moksha)
+RUSSIAN_ALPHABET_LANGUAGES = ['myv', 'mdf']
+
+def get_script(char):
+    code_point = ord(char)
+    for first, last, script in SCRIPT_RANGES:
+        if first <= code_point <= last:
+            return script
+    if code_point < 0x0250 or 0x1E00 <= code_point <= 0x1EFF:
+        return 'latin'
+    return 'other'
+
+def get_base_language(language_code):
+    # zh_cn -> zh
+    return language_code.split('_')[0]
+
+def classify_sample(sample):
+    # returns None for a sample without letters, constants.SpecialLanguage.sound.name, a script of SCRIPT_LANGUAGES,
+    # 'ru' for cyrillic with letters only russian uses, 'cyrillic' when it could be russian, or 'ambiguous'
+    if SOUND_SAMPLE_RE.match(sample):
+        return constants.SpecialLanguage.sound.name
+    scripts = set([get_script(char) for char in sample if char.isalpha()])
+    if len(scripts) == 0:
+        return None
+    if 'kana' in scripts and scripts.issubset({'kana', 'han'}):
+        return 'kana'
+    if 'hangul' in scripts and scripts.issubset({'hangul', 'han'}):
+        return 'hangul'
+    if len(scripts) > 1:
+        return 'ambiguous'
+    script = scripts.pop()
+    if script in SCRIPT_LANGUAGES:
+        return script
+    if script == 'cyrillic':
+        letters = set(sample.lower())
+        if len(letters & NON_RUSSIAN_CYRILLIC_LETTERS) > 0:
+            return 'ambiguous'
+        if len(letters & RUSSIAN_LETTERS) > 0:
+            return 'ru'
+        return 'cyrillic'
+    return 'ambiguous'
+
+class LanguageClassifier():
+    def __init__(self, language_code_list):
+        # only the languages the server knows about get decided locally, and only when no other language
+        # the server knows about could be written the same way
+        language_code_list = list(language_code_list)
+        self.script_languages = {} # by script, the language it decides
+        for script, script_language_list in SCRIPT_LANGUAGES.items():
+            listed_language_list = [language for language in language_code_list if get_base_language(language) in script_language_list]
+            if len(listed_language_list) == 1:
+                self.script_languages[script] = listed_language_list[0]
+        base_language_set = set([get_base_language(language) for language in language_code_list])
+        if 'ru' in language_code_list and len(base_language_set & set(RUSSIAN_ALPHABET_LANGUAGES)) == 0:
+            self.script_languages['ru'] = 'ru'
+
+    def classify(self, field_sample):
+        # returns (decided, language). when decided is False, the field sample needs to go to the detect api
+        sample_language_set = set([classify_sample(sample) for sample in field_sample])
+        sample_language_set.discard(None)
+        if len(sample_language_set) == 0:
+            # empty, or only numbers / punctuation, there's no language
+            return True, None
+        if sample_language_set == {'ru', 'cyrillic'}:
+            sample_language_set = {'ru'}
+        if len(sample_language_set) > 1:
+            return False, None
+        sample_language = sample_language_set.pop()
+        if sample_language == constants.SpecialLanguage.sound.name:
+            return True, sample_language
+        if sample_language not in self.script_languages:
+            return False, None
+        language = self.script_languages[sample_language]
+        logging.debug(f'language decided locally: {language}')
+        return True, language
@@ -1,8 +1,7 @@
 # python imports
 import sys
 import os
-import glob
-import re
+import time
 import random
 import requests
 import json
@@ -12,10 +11,9 @@ from typing import List, Dict
 import hashlib
 import anki.utils
 
-# anki imports
-import aqt
-import aqt.progress
-import aqt.addcards
+# anki imports. aqt is only used through anki_utils, so that the headless runner doesn't need the GUI.
+# anki.collection comes first, importing anki.notes on its own runs into a circular import within anki
+import anki.collection
 import anki.notes
 import anki.cards
 
@@ -25,12 +23,22 @@ if hasattr(sys, '_pytest_mode'):
     import errors
     import deck_utils
     import text_utils
+    import cache_utils
+    import job_journal
+    import batch_utils
+    import field_sampler
+    import language_classifier
 else:
     from . import constants
     from . import version
     from . import errors
     from . import deck_utils
     from . import text_utils
+    from . import cache_utils
+    from . import job_journal
+    from . import batch_utils
+    from . import field_sampler
+    from . import language_classifier
 
 
 class LanguageTools():
@@ -39,13 +47,37 @@ class LanguageTools():
         self.anki_utils = anki_utils
         self.deck_utils = deck_utils
         self.cloud_language_tools = cloud_language_tools
-        self.error_manager = errors.ErrorManager(self.anki_utils)
+        self.error_manager = errors.ErrorManager(self.anki_utils, self.get_request_stats)
         self.config = self.anki_utils.get_config()
         self.text_utils = text_utils.TextUtils(self.anki_utils, self.get_text_processing_settings())
-        self.error_manager = errors.ErrorManager(self.anki_utils)
+        self.error_manager = errors.ErrorManager(self.anki_utils, self.get_request_stats)
 
         self.initialization_error = False
         self.language_data = None
+        self.language_data_etag = None
+        self.language_data_revalidated = False
+        # None until the api key from the config got an answer from the server
+        self.api_key_valid = None
+        self.api_key_verification_running = False
+
+        # set to False once the server tells us it doesn't support bulk requests
+        self.batch_api_supported = {
+            constants.TransformationType.Translation: True,
+            constants.TransformationType.Transliteration: True
+        }
+
+        cache_size_mb = self.config.get(constants.CONFIG_TRANSLATION_CACHE_SIZE_MB, constants.DEFAULT_TRANSLATION_CACHE_SIZE_MB)
+        cache_path = os.path.join(self.get_user_files_dir(), constants.TRANSLATION_CACHE_FILENAME)
+        self.translation_cache = cache_utils.TranslationCache(cache_path, cache_size_mb * 1024 * 1024)
+        audio_cache_size_mb = self.config.get(constants.CONFIG_AUDIO_CACHE_SIZE_MB, constants.DEFAULT_AUDIO_CACHE_SIZE_MB)
+        audio_cache_path = os.path.join(self.get_user_files_dir(), constants.AUDIO_CACHE_FILENAME)
+        self.audio_cache = cache_utils.AudioCache(self.get_user_files_dir(), audio_cache_path, audio_cache_size_mb * 1024 * 1024)
+        # identical requests running at the same time (editor live updates, batch operations) share one network call
+        self.single_flight = cache_utils.SingleFlight()
+        # requests which batch operations didn't have to make, because several notes had the same text
+        self.deduplicated_request_count = 0
+        self.request_latency = batch_utils.LatencyTracker()
+        self.job_journal = job_journal.JobJournal(os.path.join(self.get_user_files_dir(), constants.JOB_JOURNAL_FILENAME), self.anki_utils.get_collection_key)
 
         self.collectionLoaded = False
         self.mainWindowInitialized = False
@@ -66,7 +98,8 @@ class LanguageTools():
 
     def checkInitialize(self):
         if self.collectionLoaded and self.mainWindowInitialized and self.deckBrowserRendered and self.initDone == False:
-            aqt.mw.taskman.run_in_background(self.initialize, self.initializeDone)
+            self.api_key_verification_running = True
+            self.anki_utils.run_in_background(self.initialize, self.initializeDone)
 
     def initialize(self):
         try:
@@ -74,6 +107,9 @@ class LanguageTools():
 
             # do we have an API key in the config ?
             if len(self.config['api_key']) > 0:
+                # serve the language data from the last session right away, it gets revalidated
+                # once the API key is verified
+                self.load_cached_language_data()
                 self.verify_api_key(self.config['api_key'])
                 self.load_language_data()
 
@@ -82,8 +118,16 @@ class LanguageTools():
             logging.exception(f'could not load language data')
 
     def initializeDone(self, future):
+        self.api_key_verification_running = False
         if self.initialization_error:
-            self.anki_utils.critical_message('Could not verify API key or load language data from server, please try to restart Anki.', aqt.mw)
+            self.anki_utils.critical_message('Could not verify API key or load language data from server, please try to restart Anki.', None)
+
+    def shutdown(self):
+        # called when the profile closes
+        self.cloud_language_tools.close()
+        self.translation_cache.close()
+        self.audio_cache.close()
+        self.job_journal.close()
 
     def get_config_api_key(self):
         return self.config['api_key']
@@ -94,6 +138,11 @@ class LanguageTools():
 
     def verify_api_key(self, api_key):
         result = self.cloud_language_tools.api_key_validate_query(api_key)
+        if api_key == self.config['api_key']:
+            self.api_key_valid = result['key_valid']
+            if result['key_valid'] == False:
+                # the key may have been restored from the language data cache
+                self.cloud_language_tools.clear_api_key()
         if result['key_valid'] == True:
             message = result['msg']
             self.load_language_data()
@@ -106,26 +155,117 @@ class LanguageTools():
         # print(f'self.api_key_checked: {self.api_key_checked}')
         if self.cloud_language_tools.api_key_set():
             return True
-        aqt.utils.showInfo(f'Please enter API key from menu <b>Tools -> Language Tools: Verify API Key</b>', title=constants.MENU_PREFIX)
+        if len(self.config['api_key']) > 0 and self.api_key_valid != False:
+            # the key from the config wasn't verified yet (still starting up, or the server couldn't be reached),
+            # and wasn't verified during an earlier session either
+            self.verify_config_api_key_background()
+            if self.cloud_language_tools.api_key_set():
+                return True
+            if self.api_key_valid == None:
+                self.anki_utils.info_message(f'Language Tools is verifying the API key, please try again in a moment.', None)
+                return False
+        self.anki_utils.info_message(f'Please enter API key from menu <b>Tools -> Language Tools: Verify API Key</b>', None)
         return False
 
+    def verify_config_api_key_background(self):
+        if self.api_key_verification_running:
+            return
+        self.api_key_verification_running = True
+        self.anki_utils.run_in_background(lambda: self.verify_api_key(self.config['api_key']), self.verify_config_api_key_done)
+
+    def verify_config_api_key_done(self, future):
+        self.api_key_verification_running = False
+        try:
+            future.result()
+        except Exception as e:
+            logging.warning(f'could not verify API key: {str(e)}')
+
     def load_language_data(self):
-        if self.language_data == None:
+        # revalidate the language data once per session, only downloads it if it changed
+        if self.language_data_revalidated or not self.cloud_language_tools.api_key_set():
+            return
+        result = self.cloud_language_tools.get_language_data_conditional(self.language_data_etag)
+        self.language_data_revalidated = True
+        if result == None:
+            logging.info(f'language data unchanged (etag {self.language_data_etag})')
+            return
+        language_data, etag = result
+        logging.info(f'loaded new language data (etag {etag})')
+        self.set_language_data(language_data, etag)
+        self.save_cached_language_data()
+
+    def set_language_data(self, language_data, etag):
+        # dialogs which are already open keep using the lists they got, everything else sees the new data
+        self.language_list = language_data['language_list']
+        self.translation_language_list = language_data['translation_options']
+        self.transliteration_language_list = language_data['transliteration_options']
+        self.voice_list = language_data['voice_list']
+        self.tokenization_options = language_data['tokenization_options']
+        self.build_language_data_indexes()
+        self.language_data_etag = etag
+        self.language_data = language_data
+
+    def build_language_data_indexes(self):
+        # the option lists get filtered every time a combobox changes, index them once instead
+        def index_by(item_list, key_fn):
+            index = {}
+            for item in item_list:
+                index.setdefault(key_fn(item), []).append(item)
+            return index
+        self.translation_options_by_language = index_by(self.translation_language_list, lambda x: x['language_code'])
+        self.translation_options_by_service_language = index_by(self.translation_language_list, lambda x: (x['service'], x['language_code']))
+        self.transliteration_options_by_language = index_by(self.transliteration_language_list, lambda x: x['language_code'])
+        self.tokenization_options_by_language = index_by(self.tokenization_options, lambda x: x['language_code'])
+        self.voices_by_language = index_by(sorted(self.voice_list, key=lambda x: x['voice_description']), lambda x: x['language_code'])
+
+    def get_language_data_cache_path(self):
+        return os.path.join(self.get_user_files_dir(), constants.LANGUAGE_DATA_CACHE_FILENAME)
+
+    def load_cached_language_data(self):
+        cache_path = self.get_language_data_cache_path()
+        if not os.path.isfile(cache_path):
+            return False
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cached_data = json.load(f)
+            self.set_language_data(cached_data['language_data'], cached_data['etag'])
+            logging.info(f'loaded cached language data (etag {self.language_data_etag})')
+            # the key from the config was verified during an earlier session, the requests can go out
+            # to the same api before it gets verified again
+            api_key = self.config['api_key']
+            if len(api_key) > 0 and cached_data.get('api_key_hash') == self.get_api_key_hash(api_key):
+                self.cloud_language_tools.set_api_key(api_key, cached_data['use_vocabai_api'])
+            return True
+        except:
+            logging.exception(f'could not load cached language data')
+            return False
+
+    def save_cached_language_data(self):
+        cache_path = self.get_language_data_cache_path()
+        # write to a temporary file first, so that a crash never leaves a truncated file behind
+        temp_path = cache_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            api_key_hash = None
             if self.cloud_language_tools.api_key_set():
-                # get language data
-                self.language_data = self.cloud_language_tools.get_language_data()
-                self.language_list = self.language_data['language_list']
-                self.translation_language_list = self.language_data['translation_options']
-                self.transliteration_language_list = self.language_data['transliteration_options']
-                self.voice_list = self.language_data['voice_list']
-                self.tokenization_options = self.language_data['tokenization_options']
+                api_key_hash = self.get_api_key_hash(self.cloud_language_tools.api_key)
+            json.dump({'etag': self.language_data_etag, 'language_data': self.language_data,
+                'api_key_hash': api_key_hash, 'use_vocabai_api': self.cloud_language_tools.use_vocabai_api}, f)
+        os.replace(temp_path, cache_path)
+
+    def get_api_key_hash(self, api_key):
+        return hashlib.sha224(api_key.encode('utf-8')).hexdigest()
+
+    def clear_language_data_cache(self):
+        cache_path = self.get_language_data_cache_path()
+        if os.path.isfile(cache_path):
+            os.remove(cache_path)
 
     def language_detection_done(self):
         return len(self.config[constants.CONFIG_DECK_LANGUAGES]) > 0
 
     def show_about(self):
         text = f'{constants.ADDON_NAME}: v{version.ANKI_LANGUAGE_TOOLS_VERSION}'
-        aqt.utils.showInfo(text, title=constants.ADDON_NAME)
+        self.anki_utils.info_message(text, None)
 
     def get_language_name(self, language):
         if language == None:
@@ -220,32 +360,7 @@ class LanguageTools():
         return self.anki_utils.get_noteids_for_deck_note_type(deck_id, model_id, sample_size)
 
     def get_field_samples(self, deck_note_type_field: deck_utils.DeckNoteTypeField, sample_size: int) -> List[str]:
-        note_ids = self.get_noteids_for_deck_note_type(deck_note_type_field.deck_note_type, sample_size)
-
-        stripImagesRe = re.compile("(?i)<img[^>]+src=[\"']?([^\"'>]+)[\"']?[^>]*>")
-        
-        def process_field_value(note_id, field_name):
-            note = self.anki_utils.get_note_by_id(note_id)
-            if field_name not in note:
-                # field was removed
-                raise errors.AnkiItemNotFoundError(f'field {field_name} not found')
-            original_field_value = note[field_name]
-            field_value = stripImagesRe.sub('', original_field_value)
-            field_value = self.anki_utils.html_to_text_line(field_value)
-            max_len = 200 # restrict to 200 characters
-            if len(original_field_value) > max_len:
-                field_value = original_field_value[:max_len]
-            return field_value
-
-        all_field_values = [process_field_value(x, deck_note_type_field.field_name) for x in note_ids]
-        non_empty_fields = [x for x in all_field_values if len(x) > 0]
-
-        if len(non_empty_fields) < sample_size:
-            field_sample = non_empty_fields
-        else:
-            field_sample = random.sample(non_empty_fields, sample_size)
-
-        return field_sample
+        return field_sampler.FieldSampler(self, sample_size).get_field_samples(deck_note_type_field)
 
     def get_field_samples_for_language(self, language_code, sample_size):
         # self.config[constants.CONFIG_DECK_LANGUAGES][model_name][deck_name][field_name] = language
@@ -263,10 +378,12 @@ class LanguageTools():
                             # this deck probably got deleted
                             pass
 
+        # fields of the same Deck / Note Type share the sampled notes
+        sampler = field_sampler.FieldSampler(self, sample_size)
         all_field_samples = []
         for dntf in dntf_list:
             try:
-                field_samples = self.get_field_samples(dntf, sample_size)
+                field_samples = sampler.get_field_samples(dntf)
                 all_field_samples.extend(field_samples)
             except errors.AnkiItemNotFoundError as error:
                 # might be a field missing
@@ -281,17 +398,46 @@ class LanguageTools():
         return result
 
 
-    def perform_language_detection_deck_note_type_field(self, deck_note_type_field: deck_utils.DeckNoteTypeField):
-        # get a random sample of data within this field
-
-        sample_size = 100 # max supported by azure
-        field_sample = self.get_field_samples(deck_note_type_field, sample_size)
-        if len(field_sample) == 0:
-            return None
+    def perform_language_detection_deck_note_type_field(self, deck_note_type_field: deck_utils.DeckNoteTypeField, sampler=None):
+        # get a random sample of data within this field. when detecting many fields, pass the same sampler
+        # so that the notes get read once per Deck / Note Type
+        if sampler == None:
+            sampler = self.build_language_detection_sampler()
+        field_sample = sampler.get_field_samples(deck_note_type_field)
+        return self.detect_field_sample_language(field_sample, self.build_language_classifier())
 
+    def detect_field_sample_language(self, field_sample, classifier):
+        # the obvious cases (empty, sound, a script used by a single language) don't need a detect request
+        decided, language = classifier.classify(field_sample)
+        if decided:
+            return language
         return self.cloud_language_tools.language_detection(field_sample)
 
 
+    def perform_language_detection_dntf_list(self, deck_note_type_field_list):
+        # generator, yields (deck_note_type_field, language, exception) in completion order. the samples are read on the
+        # calling thread, the detect requests run in parallel. the detect api returns a single language for all the texts
+        # it receives, so each field gets its own request
+        sampler = self.build_language_detection_sampler()
+        classifier = self.build_language_classifier()
+        def get_field_sample_list():
+            for deck_note_type_field in deck_note_type_field_list:
+                yield deck_note_type_field, sampler.get_field_samples(deck_note_type_field)
+
+        def detect_language(item):
+            deck_note_type_field, field_sample = item
+            return self.detect_field_sample_language(field_sample, classifier)
+
+        executor = batch_utils.BoundedExecutor(self.get_batch_concurrency())
+        for item, language, exception in executor.run(detect_language, get_field_sample_list()):
+            yield item[0], language, exception
+
+    def build_language_detection_sampler(self):
+        return field_sampler.FieldSampler(self, constants.LANGUAGE_DETECTION_SAMPLE_SIZE)
+
+    def build_language_classifier(self):
+        return language_classifier.LanguageClassifier(self.get_all_languages().keys())
+
     def guess_language(self, deck_note_type_field: deck_utils.DeckNoteTypeField):
         # retrieve notes
         return self.perform_language_detection_deck_note_type_field(deck_note_type_field)
@@ -341,7 +487,7 @@ class LanguageTools():
         deck_name = deck_note_type_field.get_deck_name()
         field_name = deck_note_type_field.field_name        
         del self.config[constants.CONFIG_BATCH_TRANSLATION][model_name][deck_name][field_name]
-        aqt.mw.addonManager.writeConfig(__name__, self.config)
+        self.anki_utils.write_config(self.config)
 
     def store_batch_transliteration_setting(self, deck_note_type_field: deck_utils.DeckNoteTypeField, source_field: str, transliteration_option):
         model_name = deck_note_type_field.get_model_name()
@@ -368,7 +514,7 @@ class LanguageTools():
         deck_name = deck_note_type_field.get_deck_name()
         field_name = deck_note_type_field.field_name        
         del self.config[constants.CONFIG_BATCH_TRANSLITERATION][model_name][deck_name][field_name]
-        aqt.mw.addonManager.writeConfig(__name__, self.config)
+        self.anki_utils.write_config(self.config)
 
     def get_batch_translation_settings(self, deck_note_type: deck_utils.DeckNoteType):
         model_name = deck_note_type.model_name
@@ -397,7 +543,7 @@ class LanguageTools():
         if deck_name not in self.config[constants.CONFIG_BATCH_AUDIO][model_name]:
             self.config[constants.CONFIG_BATCH_AUDIO][model_name][deck_name] = {}
         self.config[constants.CONFIG_BATCH_AUDIO][model_name][deck_name][field_name] = source_field
-        aqt.mw.addonManager.writeConfig(__name__, self.config)
+        self.anki_utils.write_config(self.config)
 
         # the language for the target field should be set to sound
         self.store_language_detection_result(deck_note_type_field, constants.SpecialLanguage.sound.name)
@@ -407,7 +553,7 @@ class LanguageTools():
         deck_name = deck_note_type_field.get_deck_name()
         field_name = deck_note_type_field.field_name        
         del self.config[constants.CONFIG_BATCH_AUDIO][model_name][deck_name][field_name]
-        aqt.mw.addonManager.writeConfig(__name__, self.config)
+        self.anki_utils.write_config(self.config)
 
     def get_batch_audio_settings(self, deck_note_type: deck_utils.DeckNoteType):
         model_name = deck_note_type.model_name
@@ -458,6 +604,9 @@ class LanguageTools():
         self.config[constants.CONFIG_LIVE_UPDATE_DELAY] = value
         self.anki_utils.write_config(self.config)
 
+    def get_batch_concurrency(self):
+        return self.config.get(constants.CONFIG_BATCH_CONCURRENCY, constants.DEFAULT_BATCH_CONCURRENCY)
+
     def get_language(self, deck_note_type_field: deck_utils.DeckNoteTypeField):
         """will return None if no language is associated with this field"""
         model_name = deck_note_type_field.get_model_name()
@@ -479,9 +628,19 @@ class LanguageTools():
     def get_translation_async(self, source_text, translation_option):
         processed_text = self.text_utils.process(source_text, constants.TransformationType.Translation)
         logging.info(f'before text processing: [{source_text}], after text processing: [{processed_text}]')
-        if self.text_utils.is_empty(processed_text):
+        if self.text_utils.is_processed_empty(processed_text):
             raise errors.LanguageToolsValidationFieldEmpty()
-        return self.cloud_language_tools.get_translation(processed_text, translation_option)
+        cached_result = self.translation_cache.get(constants.TransformationType.Translation, processed_text, translation_option)
+        if cached_result != None:
+            return cache_utils.CachedResponse({'translated_text': cached_result})
+        def request_translation():
+            response = self.cloud_language_tools.get_translation(processed_text, translation_option)
+            if response.status_code == 200:
+                data = json.loads(response.content)
+                self.translation_cache.put(constants.TransformationType.Translation, processed_text, translation_option, data['translated_text'])
+            return response
+        key = self.get_single_flight_key(constants.TransformationType.Translation, processed_text, translation_option)
+        return self.single_flight.do(key, request_translation)
 
     def interpret_translation_response_async(self, response):
         # print(response.status_code)
@@ -504,7 +663,7 @@ class LanguageTools():
     def get_translation_all(self, source_text, from_language, to_language):
         processed_text = self.text_utils.process(source_text, constants.TransformationType.Translation)
         logging.info(f'before text processing: [{source_text}], after text processing: [{processed_text}]')
-        if self.text_utils.is_empty(processed_text):
+        if self.text_utils.is_processed_empty(processed_text):
             raise errors.LanguageToolsValidationFieldEmpty()        
         return self.cloud_language_tools.get_translation_all(source_text, from_language, to_language)
     
@@ -514,9 +673,19 @@ class LanguageTools():
     def get_transliteration_async(self, source_text, transliteration_option):
         processed_text = self.text_utils.process(source_text, constants.TransformationType.Transliteration)
         logging.info(f'before text processing: [{source_text}], after text processing: [{processed_text}]')
-        if self.text_utils.is_empty(processed_text):
+        if self.text_utils.is_processed_empty(processed_text):
             raise errors.LanguageToolsValidationFieldEmpty()        
-        return self.cloud_language_tools.get_transliteration(processed_text, transliteration_option)
+        cached_result = self.translation_cache.get(constants.TransformationType.Transliteration, processed_text, transliteration_option)
+        if cached_result != None:
+            return cache_utils.CachedResponse({'transliterated_text': cached_result})
+        def request_transliteration():
+            response = self.cloud_language_tools.get_transliteration(processed_text, transliteration_option)
+            if response.status_code == 200:
+                data = json.loads(response.content)
+                self.translation_cache.put(constants.TransformationType.Transliteration, processed_text, transliteration_option, data['transliterated_text'])
+            return response
+        key = self.get_single_flight_key(constants.TransformationType.Transliteration, processed_text, transliteration_option)
+        return self.single_flight.do(key, request_transliteration)
 
     def interpret_transliteration_response_async(self, response):
         if response.status_code == 200:
@@ -536,6 +705,103 @@ class LanguageTools():
     def get_transliteration(self, source_text, transliteration_option):
         return self.interpret_transliteration_response_async(self.get_transliteration_async(source_text, transliteration_option))
 
+    # batch translation / transliteration
+    # ===================================
+
+    def get_translation_batch(self, source_text_list, translation_option):
+        # returns one entry per source text, either {'result': translated_text} or {'error': exception}
+        return self.get_transformation_batch(source_text_list, translation_option, constants.TransformationType.Translation)
+
+    def get_transliteration_batch(self, source_text_list, transliteration_option):
+        # returns one entry per source text, either {'result': transliterated_text} or {'error': exception}
+        return self.get_transformation_batch(source_text_list, transliteration_option, constants.TransformationType.Transliteration)
+
+    def get_transformation_batch(self, source_text_list, option, transformation_type):
+        results = [None] * len(source_text_list)
+
+        # empty fields and cached results never get sent to the server
+        pending = []
+        for i, source_text in enumerate(source_text_list):
+            processed_text = self.text_utils.process(source_text, transformation_type)
+            if self.text_utils.is_processed_empty(processed_text):
+                results[i] = {'error': errors.LanguageToolsValidationFieldEmpty()}
+                continue
+            cached_result = self.translation_cache.get(transformation_type, processed_text, option)
+            if cached_result != None:
+                results[i] = {'result': cached_result}
+            else:
+                pending.append((i, processed_text))
+
+        chunk_size = constants.BATCH_REQUEST_CHUNK_SIZE
+        for chunk_start in range(0, len(pending), chunk_size):
+            chunk = pending[chunk_start:chunk_start + chunk_size]
+            processed_text_list = [processed_text for i, processed_text in chunk]
+            try:
+                request_start = time.monotonic()
+                chunk_results = self.request_transformation_chunk(processed_text_list, option, transformation_type)
+                self.request_latency.record(transformation_type, option.get('service'), time.monotonic() - request_start)
+            except Exception as e:
+                # the whole request failed, report the error on every row
+                chunk_results = [{'error': e}] * len(chunk)
+            for (i, processed_text), result in zip(chunk, chunk_results):
+                results[i] = result
+                if 'result' in result:
+                    self.translation_cache.put(transformation_type, processed_text, option, result['result'])
+
+        return results
+
+    def request_transformation_chunk(self, processed_text_list, option, transformation_type):
+        if self.batch_api_supported[transformation_type]:
+            if transformation_type == constants.TransformationType.Translation:
+                response = self.cloud_language_tools.get_translation_batch(processed_text_list, option)
+            else:
+                response = self.cloud_language_tools.get_transliteration_batch(processed_text_list, option)
+            if response.status_code != 404:
+                return self.interpret_batch_response(response, len(processed_text_list), transformation_type)
+            logging.warning(f'bulk {transformation_type.name} not supported by server, falling back to single requests')
+            self.batch_api_supported[transformation_type] = False
+
+        # one request per text
+        results = []
+        for processed_text in processed_text_list:
+            try:
+                if transformation_type == constants.TransformationType.Translation:
+                    response = self.cloud_language_tools.get_translation(processed_text, option)
+                    results.append({'result': self.interpret_translation_response_async(response)})
+                else:
+                    response = self.cloud_language_tools.get_transliteration(processed_text, option)
+                    results.append({'result': self.interpret_transliteration_response_async(response)})
+            except errors.LanguageToolsError as e:
+                results.append({'error': e})
+        return results
+
+    def interpret_batch_response(self, response, expected_count, transformation_type):
+        result_key_map = {
+            constants.TransformationType.Translation: 'translated_text',
+            constants.TransformationType.Transliteration: 'transliterated_text'
+        }
+        if response.status_code != 200:
+            # same error for every text in the request
+            try:
+                if transformation_type == constants.TransformationType.Translation:
+                    self.interpret_translation_response_async(response)
+                else:
+                    self.interpret_transliteration_response_async(response)
+            except errors.LanguageToolsError as e:
+                return [{'error': e}] * expected_count
+        data = json.loads(response.content)
+        result_list = data['results']
+        if len(result_list) != expected_count:
+            raise errors.LanguageToolsRequestError(f'Expected {expected_count} results, received {len(result_list)}')
+        results = []
+        for entry in result_list:
+            if 'error' in entry:
+                error_text = f"Could not load {transformation_type.name.lower()}: {entry['error']}"
+                results.append({'error': errors.LanguageToolsRequestError(error_text)})
+            else:
+                results.append({'result': entry[result_key_map[transformation_type]]})
+        return results
+
     # breakdown
     # =========
 
@@ -572,6 +838,13 @@ class LanguageTools():
 
     def generate_audio_for_field(self, note_id, from_field, to_field, voice):
         note = self.anki_utils.get_note_by_id(note_id)
+        if self.generate_audio_for_note(note, from_field, to_field, voice):
+            self.anki_utils.update_note(note)
+            return True # success
+        return False # failure
+
+    def generate_audio_for_note(self, note, from_field, to_field, voice):
+        # sets the sound tag on the note without writing it, returns True if the note was modified
         source_text = note[from_field]
         if self.text_utils.is_empty(source_text):
             return False
@@ -579,17 +852,20 @@ class LanguageTools():
         response = self.generate_audio_tag_collection(source_text, voice)
         sound_tag = response['sound_tag']
         if sound_tag != None:
-            # write to note
             note[to_field] = sound_tag
-            self.anki_utils.update_note(note)
-            return True # success
+            return True
 
-        return False # failure
+        return False
 
     def generate_audio_tag_collection(self, source_text, voice):
+        generated_filename = self.get_tts_audio(source_text, voice['service'], voice['language_code'], voice['voice_key'], {})
+        return self.add_audio_to_collection(generated_filename)
+
+    def add_audio_to_collection(self, generated_filename):
+        # adds the audio file to the collection media and builds the sound tag. batch operations download
+        # audio on several threads, but call this from a single thread
         result = {'sound_tag': None,
                   'full_filename': None}
-        generated_filename = self.get_tts_audio(source_text, voice['service'], voice['language_code'], voice['voice_key'], {})
         if generated_filename != None:
             full_filename = self.anki_utils.media_add_file(generated_filename)
             collection_filename = os.path.basename(full_filename)
@@ -598,6 +874,9 @@ class LanguageTools():
             result['full_filename'] = full_filename
         return result
 
+    def get_single_flight_key(self, transformation_type, processed_text, option):
+        return (transformation_type, processed_text, json.dumps(option, sort_keys=True))
+
     def get_hash_for_request(self, url_path, data):
         combined_data = {
             'url': url_path,
@@ -619,40 +898,84 @@ class LanguageTools():
         user_files_dir = os.path.join(addon_dir, 'user_files')
         return user_files_dir        
 
+    def flush_caches(self):
+        # called once a batch operation completes, writes the access times of the cache hits
+        self.translation_cache.flush()
+        self.audio_cache.flush()
+
     def clean_user_files_audio(self):
-        user_files_dir = self.get_user_files_dir()
-        files = glob.glob(f'{user_files_dir}/*.mp3')
-        for f in files:
-            os.remove(f)
+        self.audio_cache.clear()
+
+    def get_translation_cache_services(self):
+        return self.translation_cache.get_services()
+
+    def invalidate_translation_cache(self, service):
+        # service None clears the whole cache
+        if service == None:
+            self.translation_cache.clear()
+        else:
+            self.translation_cache.invalidate(service)
+
+    def get_request_stats(self):
+        # number of retried / throttled / deduplicated requests since startup
+        request_stats = dict(self.cloud_language_tools.get_request_stats())
+        request_stats['deduplicated'] = self.deduplicated_request_count
+        return request_stats
+
+    def add_deduplicated_requests(self, count):
+        self.deduplicated_request_count += count
+
+    def get_translation_cache_stats(self):
+        return self.translation_cache.get_stats()
+
+    def get_audio_cache_stats(self):
+        return self.audio_cache.get_stats()
+
+    def get_cache_stats_str(self):
+        # size and hit rate of the caches, hits and misses are counted since startup
+        translation_stats = self.get_translation_cache_stats()
+        translation_lookup_count = translation_stats['hits'] + translation_stats['misses']
+        translation_hit_rate = translation_stats['hits'] / translation_lookup_count if translation_lookup_count > 0 else 0
+        audio_stats = self.get_audio_cache_stats()
+        megabyte = 1024 * 1024
+        translation_str = f"<b>Translation cache</b>: entries: {translation_stats['entries']}, size: {translation_stats['bytes'] / megabyte:.1f} MB out of {self.translation_cache.max_bytes / megabyte:.0f} MB, " + \
+            f"hit rate: {translation_hit_rate:.0%} (hits: {translation_stats['hits']}, misses: {translation_stats['misses']})"
+        audio_str = f"<b>Audio cache</b>: files: {audio_stats['entries']}, size: {audio_stats['bytes'] / megabyte:.1f} MB out of {self.audio_cache.max_bytes / megabyte:.0f} MB, " + \
+            f"hit rate: {audio_stats['hit_rate']:.0%} (hits: {audio_stats['hits']}, misses: {audio_stats['misses']})"
+        return f'<p>{translation_str}</p><p>{audio_str}</p>'
 
     def get_audio_filename(self, source_text, service, voice_key, options):
-        user_files_dir = self.get_user_files_dir()
         hash_str = self.get_hash_for_audio_request(source_text, service, voice_key, options)
-        filename = f'languagetools-{hash_str}.mp3'
-        return os.path.join(user_files_dir, filename)
+        return self.audio_cache.get_filename(hash_str)
 
     def get_tts_audio(self, source_text, service, language_code, voice_key, options):
         processed_text = self.text_utils.process(source_text, constants.TransformationType.Audio)
         logging.info(f'before text processing: [{source_text}], after text processing: [{processed_text}]')
-        if self.text_utils.is_empty(processed_text):
+        if self.text_utils.is_processed_empty(processed_text):
             raise errors.LanguageToolsValidationFieldEmpty()
-        filename = self.get_audio_filename(processed_text, service, voice_key, options)
-        if os.path.isfile(filename):
+        hash_str = self.get_hash_for_audio_request(processed_text, service, voice_key, options)
+        filename = self.audio_cache.get(hash_str)
+        if filename != None:
+            return filename
+        def request_audio():
+            request_start = time.monotonic()
+            audio_content = self.cloud_language_tools.get_tts_audio(processed_text, service, language_code, voice_key, options)
+            self.request_latency.record(constants.TransformationType.Audio, service, time.monotonic() - request_start)
+            filename = self.audio_cache.put(hash_str, audio_content, service, json.dumps(voice_key, sort_keys=True))
+            logging.info(f'wrote audio filename {filename}')
             return filename
-        audio_content = self.cloud_language_tools.get_tts_audio(processed_text, service, language_code, voice_key, options)
-        with open(filename, 'wb') as f:
-            f.write(audio_content)
-        f.close()
-        logging.info(f'wrote audio filename {filename}')
-        return filename
+        return self.single_flight.do((constants.TransformationType.Audio, hash_str), request_audio)
 
     def play_tts_audio(self, source_text, service, language_code, voice_key, options):
         audio_filename = self.get_tts_audio(source_text, service, language_code, voice_key, options)
         self.anki_utils.play_sound(audio_filename)
 
     def get_transliteration_options(self, language):
-        candidates = [x for x in self.transliteration_language_list if x['language_code'] == language]
-        return candidates
+        return list(self.transliteration_options_by_language.get(language, []))
+
+    def get_voices_for_language(self, language):
+        # sorted by voice description
+        return list(self.voices_by_language.get(language, []))
 
     def build_translation_option(self, service, source_language_id, target_language_id):
         return {
@@ -665,11 +988,11 @@ class LanguageTools():
     def get_translation_options(self, source_language: str, target_language: str):
         # get list of services which support source_language
         translation_options = []
-        source_language_options = [x for x in self.translation_language_list if x['language_code'] == source_language]
+        source_language_options = self.translation_options_by_language.get(source_language, [])
         for source_language_option in source_language_options:
             service = source_language_option['service']
             # find out whether target language is supported
-            target_language_options = [x for x in self.translation_language_list if x['language_code'] == target_language and x['service'] == service]
+            target_language_options = self.translation_options_by_service_language.get((service, target_language), [])
             if len(target_language_options) == 1:
                 # found an option
                 target_language_option = target_language_options[0]
@@ -679,6 +1002,4 @@ class LanguageTools():
 
 
     def get_tokenization_options(self, source_language):
-        tokenization_options = []
-        source_language_options = [x for x in self.tokenization_options if x['language_code'] == source_language]
-        return source_language_options
+        return list(self.tokenization_options_by_language.get(source_language, []))
@@ -0,0 +1,202 @@
+import sys
+import logging
+
+if hasattr(sys, '_pytest_mode'):
+    import constants
+    import errors
+    import batch_utils
+else:
+    from . import constants
+    from . import errors
+    from . import batch_utils
+
+# executes the rules of a Deck / Note Type (translation, transliteration, audio) over many notes.
+# a rule is a dict: type (TransformationType), from_field, to_field, option (translation / transliteration option,
+# or None for audio), action (used for error reporting)
+
+def build_rule_list(languagetools, deck_note_type):
+    # all the rules stored for this Deck / Note Type
+    rule_list = []
+    for to_field, setting in languagetools.get_batch_translation_settings(deck_note_type).items():
+        rule_list.append({'type': constants.TransformationType.Translation, 'from_field': setting['from_field'], 'to_field': to_field,
+            'option': setting['translation_option'], 'action': f'adding translation to field {to_field}'})
+    for to_field, setting in languagetools.get_batch_transliteration_settings(deck_note_type).items():
+        rule_list.append({'type': constants.TransformationType.Transliteration, 'from_field': setting['from_field'], 'to_field': to_field,
+            'option': setting['transliteration_option'], 'action': f'adding transliteration to field {to_field}'})
+    for to_field, from_field in languagetools.get_batch_audio_settings(deck_note_type).items():
+        rule_list.append({'type': constants.TransformationType.Audio, 'from_field': from_field, 'to_field': to_field,
+            'option': None, 'action': f'adding audio to field {to_field}'})
+    return rule_list
+
+def get_rule_stages(rule_list):
+    # rules reading a field written by another rule have to run after it. returns a list of stages,
+    # the rules within a stage don't depend on each other and can run concurrently
+    remaining = list(rule_list)
+    stages = []
+    while len(remaining) > 0:
+        written_fields = set([rule['to_field'] for rule in remaining])
+        stage = [rule for rule in remaining if rule['from_field'] not in written_fields or rule['from_field'] == rule['to_field']]
+        if len(stage) == 0:
+            # circular rules, keep the configured order
+            logging.warning(f'circular rules: {[rule["action"] for rule in remaining]}')
+            stage = [remaining[0]]
+        stages.append(stage)
+        remaining = [rule for rule in remaining if rule not in stage]
+    return stages
+
+class RulesEngine():
+    # runs rules over a list of notes, one segment of notes at a time, with at most max_workers requests in flight.
+    # requests are grouped per rule and distinct processed text: translations / transliterations are sent
+    # in bulk chunks, audio gets one request per text. results come back on the calling thread,
+    # which is also the only thread touching the collection.
+
+    def __init__(self, languagetools, deck_note_type, rule_list, max_workers, cancellation_token=None):
+        self.languagetools = languagetools
+        self.deck_note_type = deck_note_type
+        self.rule_stages = get_rule_stages(rule_list)
+        self.field_name_list = list(set([rule['from_field'] for rule in rule_list] + [rule['to_field'] for rule in rule_list]))
+        self.executor = batch_utils.BoundedExecutor(max_workers)
+        self.cancellation_token = cancellation_token
+        # by (action, processed text), the successful results of the earlier segments. a text repeated in a later segment
+        # doesn't get sent again, the grouping is over the whole selection, like the estimate of the batch planner
+        self.results_by_text = {}
+
+    def is_cancelled(self):
+        return self.cancellation_token != None and self.cancellation_token.is_cancelled()
+
+    def process_notes(self, note_id_list, batch_error_manager, progress_fn, segment_done_fn=None):
+        # progress_fn gets called with the number of (note, rule) pairs completed, segment_done_fn with the note ids
+        # of each segment which are done, once they've been written
+        segment_size = constants.NOTE_UPDATE_CHUNK_SIZE
+        for segment_start in range(0, len(note_id_list), segment_size):
+            if self.is_cancelled():
+                return
+            segment_note_id_list = note_id_list[segment_start:segment_start + segment_size]
+            done_note_id_list = self.process_segment(segment_note_id_list, batch_error_manager, progress_fn)
+            if segment_done_fn != None:
+                segment_done_fn(done_note_id_list)
+
+    def process_segment(self, note_id_list, batch_error_manager, progress_fn):
+        # returns the note ids which are done: every rule ran on them, without an error other than an empty field.
+        # a note with a failed request, or which the job got cancelled before, still gets the results of the other rules
+        # read the fields used by the rules for all notes in the segment at once, the notes only get loaded when we write them
+        field_values = self.languagetools.anki_utils.get_field_values_for_notes(note_id_list, self.field_name_list)
+        note_field_values = [(note_id, field_values[note_id]) for note_id in note_id_list]
+        note_updates = {} # by note id
+        done_rule_count = {} # by note id
+
+        # all the notes of the segment are in flight at once, the rules of a stage run concurrently
+        for rule_stage in self.rule_stages:
+            if self.is_cancelled():
+                break
+            for rule, row_list, result in self.run_stage(rule_stage, note_field_values):
+                for i in row_list:
+                    note_id, values = note_field_values[i]
+                    if 'result' in result or isinstance(result['error'], errors.LanguageToolsValidationFieldEmpty):
+                        done_rule_count[note_id] = done_rule_count.get(note_id, 0) + 1
+                    with batch_error_manager.get_batch_action_context(rule['action']):
+                        if 'error' in result:
+                            raise result['error']
+                        # later stages see the new value
+                        values[rule['to_field']] = result['result']
+                        note_updates.setdefault(note_id, {})[rule['to_field']] = result['result']
+                progress_fn(len(row_list))
+
+        # write output to notes, all at once
+        modified_notes = []
+        for note_id in note_id_list:
+            if note_id in note_updates:
+                note = self.languagetools.anki_utils.get_note_by_id(note_id)
+                for field_name, value in note_updates[note_id].items():
+                    note[field_name] = value
+                modified_notes.append(note)
+        self.languagetools.anki_utils.update_notes(modified_notes)
+
+        rule_count = sum([len(rule_stage) for rule_stage in self.rule_stages])
+        return [note_id for note_id in note_id_list if done_rule_count.get(note_id, 0) == rule_count]
+
+    def run_stage(self, rule_list, note_field_values):
+        # note_field_values: list of (note_id, {field_name: value})
+        # generator, yields (rule, row_index_list, result) with result either {'result': value} or {'error': exception}
+        task_list = []
+        for rule in rule_list:
+            for row_list, result in self.build_tasks(rule, note_field_values, task_list):
+                yield rule, row_list, result
+
+        for (rule, group_list, text_list, processed_text_list), result_list, exception in self.executor.run(self.run_task, task_list, self.cancellation_token):
+            if exception != None:
+                result_list = [{'error': exception}] * len(group_list)
+            for row_list, processed_text, result in zip(group_list, processed_text_list, result_list):
+                if rule['type'] == constants.TransformationType.Audio and 'result' in result:
+                    # the audio file got downloaded by a worker, it's added to the collection here
+                    result = {'result': self.languagetools.add_audio_to_collection(result['result'])['sound_tag']}
+                if 'result' in result:
+                    self.results_by_text[(rule['action'], processed_text)] = result
+                yield rule, row_list, result
+
+    def build_tasks(self, rule, note_field_values, task_list):
+        # appends the requests for this rule to task_list, returns the rows which fail right away, or got their result
+        # in an earlier segment
+        from_dntf = self.languagetools.deck_utils.build_dntf_from_dnt(self.deck_note_type, rule['from_field'])
+        to_dntf = self.languagetools.deck_utils.build_dntf_from_dnt(self.deck_note_type, rule['to_field'])
+        logging.info(f"{rule['action']}, from {from_dntf} to {to_dntf}")
+
+        failed_rows = []
+        pending_rows = []
+        for i, (note_id, values) in enumerate(note_field_values):
+            if rule['from_field'] not in values:
+                failed_rows.append(([i], {'error': errors.FieldNotFoundError(from_dntf)}))
+            elif rule['to_field'] not in values:
+                failed_rows.append(([i], {'error': errors.FieldNotFoundError(to_dntf)}))
+            else:
+                pending_rows.append(i)
+
+        option = rule['option']
+        if rule['type'] == constants.TransformationType.Audio:
+            try:
+                option = self.languagetools.get_voice_for_field(from_dntf)
+            except errors.LanguageToolsError as e:
+                return failed_rows + [([i], {'error': e}) for i in pending_rows]
+
+        # rows with the same processed text share a request
+        done_rows = []
+        request_rows = []
+        request_text_list = []
+        for i in pending_rows:
+            processed_text = self.languagetools.text_utils.process(note_field_values[i][1][rule['from_field']], rule['type'])
+            if (rule['action'], processed_text) in self.results_by_text:
+                done_rows.append(([i], self.results_by_text[(rule['action'], processed_text)]))
+            else:
+                request_rows.append(i)
+                request_text_list.append(processed_text)
+        group_list = batch_utils.group_identical(request_text_list)
+        processed_text_list = [request_text_list[group[0]] for group in group_list]
+        group_list = [[request_rows[j] for j in group] for group in group_list]
+        self.languagetools.add_deduplicated_requests(len(pending_rows) - len(group_list))
+
+        if rule['type'] == constants.TransformationType.Audio:
+            chunk_size = 1
+        else:
+            chunk_size = constants.BATCH_REQUEST_CHUNK_SIZE
+        for chunk_start in range(0, len(group_list), chunk_size):
+            chunk = group_list[chunk_start:chunk_start + chunk_size]
+            text_list = [note_field_values[row_list[0]][1][rule['from_field']] for row_list in chunk]
+            task_list.append((dict(rule, option=option), chunk, text_list, processed_text_list[chunk_start:chunk_start + chunk_size]))
+
+        return failed_rows + done_rows
+
+    def run_task(self, task):
+        # runs on a worker thread, doesn't touch the collection
+        rule, group_list, text_list, processed_text_list = task
+        if rule['type'] == constants.TransformationType.Translation:
+            return self.languagetools.get_translation_batch(text_list, rule['option'])
+        elif rule['type'] == constants.TransformationType.Transliteration:
+            return self.languagetools.get_transliteration_batch(text_list, rule['option'])
+        voice = rule['option']
+        result_list = []
+        for text in text_list:
+            try:
+                result_list.append({'result': self.languagetools.get_tts_audio(text, voice['service'], voice['language_code'], voice['voice_key'], {})})
+            except errors.LanguageToolsError as e:
+                result_list.append({'error': e})
+        return result_list
@@ -0,0 +1,107 @@
+import constants
+import deck_utils
+import testing_utils
+import rules_engine
+import batch_planner
+
+def build_planner_test(config_name):
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance(config_name)
+    # a fourth note with the same text as the second one
+    note_id_4 = 45005
+    mock_language_tools.anki_utils.notes_by_id[note_id_4] = testing_utils.MockNote(note_id_4, config_gen.model_id, {
+        config_gen.field_chinese: '<b>你好</b>',
+        config_gen.field_english: '',
+        config_gen.field_sound: '',
+        config_gen.field_pinyin: ''
+    }, config_gen.all_fields)
+    deck_note_type = deck_utils.DeckNoteType(config_gen.deck_id, config_gen.deck_name, config_gen.model_id, config_gen.model_name)
+    return config_gen, mock_language_tools, deck_note_type
+
+def test_plan_rules(qtbot):
+    # pytest test_batch_planner.py -rPP -k test_plan_rules
+    config_gen, mock_language_tools, deck_note_type = build_planner_test('batch_audio_translation_transliteration')
+    note_id_list = config_gen.get_note_id_list()
+    rule_list = rules_engine.build_rule_list(mock_language_tools, deck_note_type)
+
+    # one translation is already cached, the translation service has been used before
+    translation_option = mock_language_tools.get_batch_translation_settings(deck_note_type)['English']['translation_option']
+    mock_language_tools.translation_cache.put(constants.TransformationType.Translation, '老人家', translation_option, 'old people')
+    mock_language_tools.request_latency.record(constants.TransformationType.Translation, 'Azure', 2.0)
+
+    plan = batch_planner.BatchPlanner(mock_language_tools).plan(deck_note_type, rule_list, note_id_list)
+    entries = {entry['action']: entry for entry in plan['entries']}
+
+    translation = entries['adding translation to field English']
+    assert translation['service'] == 'Azure'
+    assert translation['notes'] == 4
+    assert translation['empty'] == 1
+    assert translation['duplicates'] == 1
+    assert translation['cached'] == 1
+    assert translation['requests'] == 1
+    assert translation['characters'] == len('你好')
+    assert translation['latency_measured'] == True
+    assert translation['estimated_seconds'] == 2.0 / mock_language_tools.get_batch_concurrency()
+
+    transliteration = entries['adding transliteration to field Pinyin']
+    assert transliteration['cached'] == 0
+    assert transliteration['requests'] == 1
+    assert transliteration['characters'] == len('老人家') + len('你好')
+    assert transliteration['latency_measured'] == False
+
+    # one audio request per distinct text
+    audio = entries['adding audio to field Sound']
+    assert audio['requests'] == 2
+    assert audio['duplicates'] == 1
+
+    assert plan['requests'] == 4
+    assert 'Estimate for 4 notes' in batch_planner.plan_str(plan)
+
+    # nothing was sent, and the cache stats are untouched
+    assert mock_language_tools.cloud_language_tools.batch_request_count == 0
+    assert mock_language_tools.get_translation_cache_stats()['hits'] == 0
+
+def test_plan_dependent_rules(qtbot):
+    # pytest test_batch_planner.py -rPP -k test_plan_dependent_rules
+    config_gen, mock_language_tools, deck_note_type = build_planner_test('default')
+    note_id_list = config_gen.get_note_id_list()
+
+    translation_option = mock_language_tools.build_translation_option('Azure', 'zh-Hans', 'en')
+    voice = mock_language_tools.get_voice_selection_settings()['zh_cn']
+    rule_list = [
+        # reads the output of the translation
+        {'type': constants.TransformationType.Audio, 'from_field': 'English', 'to_field': 'Sound', 'option': voice, 'action': 'adding audio to field Sound'},
+        {'type': constants.TransformationType.Translation, 'from_field': 'Chinese', 'to_field': 'English', 'option': translation_option, 'action': 'adding translation to field English'}
+    ]
+    plan = batch_planner.BatchPlanner(mock_language_tools).plan(deck_note_type, rule_list, note_id_list)
+
+    audio = plan['entries'][0]
+    assert audio['output_of'] == 'adding translation to field English'
+    # at most one request per distinct translation
+    assert audio['requests'] == 2
+    assert audio['characters'] == None
+    assert 'characters: unknown' in batch_planner.plan_str(plan)
+
+def test_plan_matches_run(qtbot, monkeypatch):
+    # pytest test_batch_planner.py -rPP -k test_plan_matches_run
+    config_gen, mock_language_tools, deck_note_type = build_planner_test('batch_audio_translation_transliteration')
+    note_id_list = config_gen.get_note_id_list()
+    rule_list = rules_engine.build_rule_list(mock_language_tools, deck_note_type)
+    mock_language_tools.cloud_language_tools.translation_map = {'老人家': 'translation 1', '你好': 'translation 2'}
+    mock_language_tools.cloud_language_tools.transliteration_map = {'老人家': 'transliteration 1', '你好': 'transliteration 2'}
+    # one note per segment, the duplicate text is in another segment
+    monkeypatch.setattr(constants, 'NOTE_UPDATE_CHUNK_SIZE', 1)
+
+    plan = batch_planner.BatchPlanner(mock_language_tools).plan(deck_note_type, rule_list, note_id_list)
+    duplicate_count = sum([entry['duplicates'] for entry in plan['entries']])
+    assert duplicate_count == 3
+
+    batch_error_manager = mock_language_tools.error_manager.get_batch_error_manager('run rules')
+    engine = rules_engine.RulesEngine(mock_language_tools, deck_note_type, rule_list, 2)
+    engine.process_notes(note_id_list, batch_error_manager, lambda count: None)
+
+    # the rules engine groups the same texts as the estimate
+    assert mock_language_tools.get_request_stats()['deduplicated'] == duplicate_count
+    note_2_set_values = config_gen.notes_by_id[config_gen.note_id_2].set_values
+    assert note_2_set_values['English'] == 'translation 2'
+    assert mock_language_tools.anki_utils.notes_by_id[45005].set_values == note_2_set_values
@@ -0,0 +1,82 @@
+import time
+import threading
+import batch_utils
+
+def test_split_chunks(qtbot):
+    assert batch_utils.split_chunks([], 4) == []
+    # small lists get spread over all workers
+    assert batch_utils.split_chunks(list(range(8)), 4) == [(0, [0, 1]), (2, [2, 3]), (4, [4, 5]), (6, [6, 7])]
+    assert batch_utils.split_chunks(list(range(5)), 4) == [(0, [0, 1]), (2, [2, 3]), (4, [4])]
+    # large lists are limited by the chunk size
+    chunk_list = batch_utils.split_chunks(list(range(100)), 2, max_chunk_size=25)
+    assert [start for start, chunk in chunk_list] == [0, 25, 50, 75]
+    assert sum([chunk for start, chunk in chunk_list], []) == list(range(100))
+
+def test_bounded_executor(qtbot):
+    lock = threading.Lock()
+    state = {'running': 0, 'max_running': 0}
+
+    def task(item):
+        with lock:
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+        time.sleep(0.02)
+        with lock:
+            state['running'] -= 1
+        if item == 7:
+            raise Exception('failed on 7')
+        return item * 2
+
+    executor = batch_utils.BoundedExecutor(3)
+    results = {}
+    errors = {}
+    for item, result, exception in executor.run(task, range(20)):
+        if exception != None:
+            errors[item] = str(exception)
+        else:
+            results[item] = result
+
+    assert state['max_running'] > 1
+    assert state['max_running'] <= 3
+    assert errors == {7: 'failed on 7'}
+    assert results == {i: i * 2 for i in range(20) if i != 7}
+
+def test_group_identical(qtbot):
+    assert batch_utils.group_identical([]) == []
+    assert batch_utils.group_identical(['a', 'b', 'a', 'c', 'b', 'a']) == [[0, 2, 5], [1, 4], [3]]
+
+def test_bounded_executor_cancel(qtbot):
+    cancellation_token = batch_utils.CancellationToken()
+    executor = batch_utils.BoundedExecutor(2)
+    yielded_items = []
+    for item, result, exception in executor.run(lambda item: item, range(20), cancellation_token):
+        yielded_items.append(item)
+        cancellation_token.cancel()
+    # the items submitted before cancelling still come back, nothing else gets started
+    assert len(yielded_items) <= 4
+    assert len(yielded_items) >= 1
+
+class MockAnkiUtils():
+    def __init__(self):
+        self.run_on_main_count = 0
+
+    def run_on_main(self, task_fn):
+        self.run_on_main_count += 1
+        task_fn()
+
+def test_progress_reporter(qtbot):
+    anki_utils = MockAnkiUtils()
+    progress_values = []
+    cells = []
+    progress = batch_utils.ProgressReporter(anki_utils, progress_values.append, updates_per_second=10)
+    for i in range(1000):
+        progress.add_ui_fn(lambda i=i: cells.append(i))
+        progress.increment(1)
+    progress.finish()
+
+    # coalesced into a handful of updates on the main thread, the last one has the final value
+    assert anki_utils.run_on_main_count < 10
+    assert progress_values[-1] == 1000
+    assert progress_values == sorted(progress_values)
+    # every ui update gets delivered, in order
+    assert cells == list(range(1000))
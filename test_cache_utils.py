@@ -0,0 +1,220 @@
+import os
+import time
+import sqlite3
+import threading
+import cache_utils
+import constants
+
+def test_translation_cache(qtbot, tmp_path):
+    db_path = os.path.join(tmp_path, 'cache.sqlite3')
+    cache = cache_utils.TranslationCache(db_path, 1024 * 1024)
+    option_azure = {'service': 'Azure', 'source_language_id': 'fr', 'target_language_id': 'en'}
+    option_deepl = {'service': 'DeepL', 'source_language_id': 'fr', 'target_language_id': 'en'}
+
+    assert cache.get(constants.TransformationType.Translation, 'bonjour', option_azure) == None
+    cache.put(constants.TransformationType.Translation, 'bonjour', option_azure, 'hello')
+    cache.put(constants.TransformationType.Translation, 'bonjour', option_deepl, 'good day')
+    assert cache.get(constants.TransformationType.Translation, 'bonjour', option_azure) == 'hello'
+    assert cache.get(constants.TransformationType.Translation, 'bonjour', option_deepl) == 'good day'
+    # the transformation type is part of the key
+    assert cache.get(constants.TransformationType.Transliteration, 'bonjour', option_azure) == None
+
+    stats = cache.get_stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+    assert stats['entries'] == 2
+
+    # invalidate a single service
+    cache.invalidate('DeepL')
+    assert cache.get(constants.TransformationType.Translation, 'bonjour', option_deepl) == None
+    assert cache.get(constants.TransformationType.Translation, 'bonjour', option_azure) == 'hello'
+    cache.close()
+
+    # entries survive re-opening the cache
+    cache = cache_utils.TranslationCache(db_path, 1024 * 1024)
+    assert cache.get(constants.TransformationType.Translation, 'bonjour', option_azure) == 'hello'
+    assert cache.get_stats()['entries'] == 1
+    cache.close()
+
+def test_translation_cache_reopen(qtbot, tmp_path):
+    # pytest test_cache_utils.py -rPP -k test_translation_cache_reopen
+    # the cache gets closed when the profile closes, the add-on keeps using it after the next profile opens
+    db_path = os.path.join(tmp_path, 'cache.sqlite3')
+    cache = cache_utils.TranslationCache(db_path, 1024 * 1024)
+    option = {'service': 'Azure'}
+    cache.put(constants.TransformationType.Translation, 'bonjour', option, 'hello')
+    cache.close()
+    cache.close()
+
+    assert cache.get(constants.TransformationType.Translation, 'bonjour', option) == 'hello'
+    cache.put(constants.TransformationType.Translation, 'merci', option, 'thank you')
+    assert cache.get(constants.TransformationType.Translation, 'merci', option) == 'thank you'
+    assert cache.get_stats()['entries'] == 2
+    cache.close()
+
+def test_translation_cache_access_flush(qtbot, tmp_path):
+    # pytest test_cache_utils.py -rPP -k test_translation_cache_access_flush
+    # cache hits don't commit one by one, the access times get written in bulk
+    db_path = os.path.join(tmp_path, 'cache.sqlite3')
+    cache = cache_utils.TranslationCache(db_path, 1024 * 1024)
+    option = {'service': 'Azure'}
+    for i in range(cache_utils.TranslationCache.ACCESS_FLUSH_COUNT):
+        cache.put(constants.TransformationType.Translation, f'text {i}', option, f'result {i}')
+    cache.put(constants.TransformationType.Translation, 'bonjour', option, 'hello')
+    def get_last_access():
+        reader = sqlite3.connect(db_path)
+        last_access = reader.execute('SELECT MAX(last_access) FROM translation_cache').fetchone()[0]
+        reader.close()
+        return last_access
+    put_time = get_last_access()
+
+    time.sleep(0.01)
+    assert cache.get(constants.TransformationType.Translation, 'bonjour', option) == 'hello'
+    assert get_last_access() == put_time
+    cache.flush()
+    assert get_last_access() > put_time
+    flush_time = get_last_access()
+
+    time.sleep(0.01)
+    for i in range(cache_utils.TranslationCache.ACCESS_FLUSH_COUNT - 1):
+        cache.get(constants.TransformationType.Translation, f'text {i}', option)
+    assert get_last_access() == flush_time
+    # the hit which fills up the pending access times writes them
+    cache.get(constants.TransformationType.Translation, f'text {cache_utils.TranslationCache.ACCESS_FLUSH_COUNT - 1}', option)
+    assert get_last_access() > flush_time
+    cache.close()
+
+def test_translation_cache_lru(qtbot, tmp_path):
+    db_path = os.path.join(tmp_path, 'cache.sqlite3')
+    option = {'service': 'Azure'}
+    # each entry is 56 bytes of key + 44 bytes of result
+    cache = cache_utils.TranslationCache(db_path, 1000)
+    for i in range(10):
+        cache.put(constants.TransformationType.Translation, f'text {i}', option, f'{i:044d}')
+    assert cache.get_stats()['bytes'] == 1000
+
+    # touch the first entry, it should survive the eviction
+    assert cache.get(constants.TransformationType.Translation, 'text 0', option) != None
+    cache.put(constants.TransformationType.Translation, 'text 10', option, f'{10:044d}')
+    assert cache.get_stats()['bytes'] <= 900
+    assert cache.get(constants.TransformationType.Translation, 'text 0', option) != None
+    assert cache.get(constants.TransformationType.Translation, 'text 1', option) == None
+    assert cache.get(constants.TransformationType.Translation, 'text 10', option) != None
+    cache.close()
+
+def test_audio_cache(qtbot, tmp_path):
+    db_path = os.path.join(tmp_path, 'audio.sqlite3')
+    cache = cache_utils.AudioCache(tmp_path, db_path, 100)
+
+    assert cache.get('hash1') == None
+    filename = cache.put('hash1', b'a' * 40, 'Azure', 'voice1')
+    assert os.path.isfile(filename)
+    assert cache.get('hash1') == filename
+    cache.put('hash2', b'b' * 40, 'Azure', 'voice1')
+
+    # hash1 was used most recently, hash2 gets evicted
+    assert cache.get('hash1') == filename
+    cache.put('hash3', b'c' * 40, 'Google', 'voice2')
+    assert cache.get('hash2') == None
+    assert not os.path.isfile(cache.get_filename('hash2'))
+    assert cache.get('hash3') != None
+
+    stats = cache.get_stats()
+    assert stats['entries'] == 2
+    assert stats['bytes'] == 80
+    assert stats['hits'] == 3
+    assert stats['misses'] == 2
+    cache.close()
+
+    # the index survives re-opening, and files written before the index existed get picked up
+    with open(os.path.join(tmp_path, 'languagetools-legacy.mp3'), 'wb') as f:
+        f.write(b'd' * 10)
+    cache = cache_utils.AudioCache(tmp_path, db_path, 100)
+    assert cache.get_stats()['entries'] == 3
+    assert cache.get('hash1') == filename
+    assert cache.get('legacy') != None
+
+    # a file deleted outside of the cache is a miss
+    os.remove(filename)
+    assert cache.get('hash1') == None
+
+    cache.clear()
+    assert cache.get_stats()['entries'] == 0
+    assert len(os.listdir(tmp_path)) == 1 # only the index remains
+    cache.close()
+
+def test_audio_cache_access_flush(qtbot, tmp_path):
+    # pytest test_cache_utils.py -rPP -k test_audio_cache_access_flush
+    db_path = os.path.join(tmp_path, 'audio.sqlite3')
+    cache = cache_utils.AudioCache(tmp_path, db_path, 100)
+    cache.put('hash1', b'a' * 40, 'Azure', 'voice1')
+    cache.put('hash2', b'b' * 40, 'Azure', 'voice1')
+    # hash1 becomes the most recently used once the access time is written, when the cache closes
+    assert cache.get('hash1') != None
+    cache.close()
+
+    cache = cache_utils.AudioCache(tmp_path, db_path, 100)
+    cache.put('hash3', b'c' * 40, 'Azure', 'voice1')
+    assert cache.get('hash1') != None
+    assert cache.get('hash2') == None
+    cache.close()
+
+def test_audio_cache_reopen(qtbot, tmp_path):
+    # pytest test_cache_utils.py -rPP -k test_audio_cache_reopen
+    db_path = os.path.join(tmp_path, 'audio.sqlite3')
+    cache = cache_utils.AudioCache(tmp_path, db_path, 100)
+    filename = cache.put('hash1', b'a' * 40, 'Azure', 'voice1')
+    cache.close()
+
+    # used again after the profile closed
+    assert cache.get('hash1') == filename
+    cache.put('hash2', b'b' * 40, 'Azure', 'voice1')
+    cache.close()
+
+    cache = cache_utils.AudioCache(tmp_path, db_path, 100)
+    assert cache.get_stats()['entries'] == 2
+    assert cache.get('hash2') != None
+    cache.close()
+
+def test_single_flight(qtbot):
+    single_flight = cache_utils.SingleFlight()
+    release = threading.Event()
+    call_count = {'value': 0}
+
+    def slow_call():
+        call_count['value'] += 1
+        release.wait()
+        return 'result'
+
+    def failing_call():
+        call_count['value'] += 1
+        release.wait()
+        raise Exception('request failed')
+
+    def run_callers(key, fn):
+        results = []
+        def caller():
+            try:
+                results.append(single_flight.do(key, fn))
+            except Exception as e:
+                results.append(str(e))
+        threads = [threading.Thread(target=caller) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        # wait until the other callers joined the in-flight call
+        while key not in single_flight.in_flight or single_flight.in_flight[key]['waiters'] < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        release.clear()
+        return results
+
+    assert run_callers('key1', slow_call) == ['result'] * 5
+    assert call_count['value'] == 1
+    assert run_callers('key2', failing_call) == ['request failed'] * 5
+    assert call_count['value'] == 2
+    assert single_flight.in_flight == {}
+
+    # once complete, the next call goes through again
+    assert single_flight.do('key1', lambda: 'second result') == 'second result'
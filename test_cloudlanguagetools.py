@@ -2,6 +2,11 @@ import json
 import os
 import unittest
 import pprint
+import time
+import datetime
+import threading
+import email.utils
+import requests
 
 # add external search path
 import sys
@@ -9,6 +14,8 @@ sys.path.append(os.path.join(os.path.dirname(__file__), 'external'))
 
 import cloudlanguagetools
 import constants
+import batch_utils
+import testing_server
 
 
 # create unit test class for CLT API tests
@@ -100,5 +107,169 @@ class CloudLanguageToolsVocabTests(unittest.TestCase):
     def test_get_base_url(self):
         self.assertEquals(self.clt.get_base_url(), constants.VOCABAI_API_BASE_URL)
 
+class MockResponse():
+    def __init__(self, status_code, headers={}):
+        self.status_code = status_code
+        self.headers = headers
+
+class RequestSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.sleep_calls = []
+        self.scheduler = cloudlanguagetools.RequestScheduler(max_retries=4, backoff_base=1.0, backoff_max=5.0, 
+            sleep_fn=self.sleep_calls.append, clock_fn=lambda: 100.0)
+
+    def test_backoff(self):
+        # pytest test_cloudlanguagetools.py -k test_backoff
+        responses = [MockResponse(503), MockResponse(503), MockResponse(503), MockResponse(503), MockResponse(200)]
+        response = self.scheduler.execute(lambda: responses.pop(0))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.sleep_calls), 4)
+        # exponential with jitter, capped at backoff_max
+        for delay, max_delay in zip(self.sleep_calls, [1.0, 2.0, 4.0, 5.0]):
+            self.assertGreaterEqual(delay, max_delay / 2)
+            self.assertLessEqual(delay, max_delay)
+        # a 503 is not throttling, the request rate is unaffected
+        self.assertEqual(self.scheduler.get_stats(), {'retries': 4, 'throttled': 0})
+        self.assertEqual(self.scheduler.rate, None)
+
+    def test_retry_after_date(self):
+        # pytest test_cloudlanguagetools.py -k test_retry_after_date
+        retry_date = email.utils.format_datetime(datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=3), usegmt=True)
+        delay = self.scheduler.get_retry_after(MockResponse(429, {'Retry-After': retry_date}))
+        self.assertGreater(delay, 1.0)
+        self.assertLessEqual(delay, 3.0)
+        self.assertEqual(self.scheduler.get_retry_after(MockResponse(429, {'Retry-After': '120'})), 120.0)
+        self.assertEqual(self.scheduler.get_retry_after(MockResponse(429, {'Retry-After': 'invalid'})), None)
+
+    def test_retry_after_max(self):
+        # pytest test_cloudlanguagetools.py -k test_retry_after_max
+        # honored even above backoff_max, up to retry_after_max
+        responses = [MockResponse(429, {'Retry-After': '8'}), MockResponse(200)]
+        self.assertEqual(self.scheduler.execute(lambda: responses.pop(0)).status_code, 200)
+        self.assertEqual(self.sleep_calls, [8.0])
+        # a longer wait would block a worker, the 429 goes back to the caller right away
+        responses = [MockResponse(429, {'Retry-After': '3600'}), MockResponse(200)]
+        self.assertEqual(self.scheduler.execute(lambda: responses.pop(0)).status_code, 429)
+        self.assertEqual(self.scheduler.get_stats(), {'retries': 1, 'throttled': 2})
+
+    def test_cancelled_while_waiting(self):
+        # pytest test_cloudlanguagetools.py -k test_cancelled_while_waiting
+        # requests made by a batch job stop waiting for their retry once the job gets cancelled
+        scheduler = cloudlanguagetools.RequestScheduler(max_retries=4, backoff_base=30.0, backoff_max=30.0)
+        cancellation_token = batch_utils.CancellationToken()
+        def request(item):
+            return scheduler.execute(lambda: MockResponse(503))
+        threading.Timer(0.1, cancellation_token.cancel).start()
+        start_time = time.monotonic()
+        result_list = list(batch_utils.BoundedExecutor(1).run(request, [1], cancellation_token))
+        self.assertLess(time.monotonic() - start_time, 5.0)
+        self.assertEqual(result_list[0][1].status_code, 503)
+        self.assertEqual(scheduler.get_stats()['retries'], 1)
+
+    def test_connection_error(self):
+        # pytest test_cloudlanguagetools.py -k test_connection_error
+        def failing_request():
+            raise requests.exceptions.ConnectionError('connection reset')
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.scheduler.execute(failing_request)
+        self.assertEqual(self.scheduler.get_stats()['retries'], 4)
+
+    def test_rate(self):
+        # pytest test_cloudlanguagetools.py -k test_rate
+        self.scheduler.record_throttled()
+        self.assertEqual(self.scheduler.rate, constants.REQUEST_MAX_RATE / 2)
+        # once throttled, requests get spaced out
+        self.scheduler.wait_for_slot()
+        self.scheduler.wait_for_slot()
+        self.assertEqual(len(self.sleep_calls), 1)
+        self.assertAlmostEqual(self.sleep_calls[0], 1.0 / self.scheduler.rate)
+        # successful requests bring the rate back up, until it's no longer limited
+        for i in range(1000):
+            self.scheduler.record_success()
+        self.assertEqual(self.scheduler.rate, None)
+
+# these tests run against a local stand-in server, no API key required
+class CloudLanguageToolsStandInTests(unittest.TestCase):
+    def setUp(self):
+        self.server = testing_server.StandInServer().start()
+        self.clt = cloudlanguagetools.CloudLanguageTools(pool_size=4)
+        self.server.configure_cloudlanguagetools(self.clt)
+
+    def tearDown(self):
+        self.clt.close()
+        self.server.stop()
+
+    def test_keep_alive(self):
+        # pytest test_cloudlanguagetools.py -k test_keep_alive
+        translation_option = {'service': 'Azure', 'source_language_id': 'fr', 'target_language_id': 'en'}
+        for i in range(10):
+            response = self.clt.get_translation(f'text {i}', translation_option)
+            self.assertEqual(response.status_code, 200)
+        audio = self.clt.get_tts_audio('Bonjour', 'Azure', 'fr', {'name': 'voice'}, {})
+        self.assertEqual(audio, b'audio of Bonjour')
+        self.assertEqual(self.server.get_request_count('translate'), 10)
+        # the api key check used one connection, every subsequent request reused the pooled one
+        self.assertEqual(self.server.connection_count, 1)
+        self.assertEqual(list(self.clt.sessions.keys()), [self.clt.vocab_api_base_url])
+
+    def test_close(self):
+        # pytest test_cloudlanguagetools.py -k test_close
+        self.clt.account_info()
+        self.assertEqual(self.server.connection_count, 1)
+        self.clt.close()
+        self.assertEqual(len(self.clt.sessions), 0)
+        # a new session gets created transparently
+        self.clt.account_info()
+        self.assertEqual(self.server.connection_count, 2)
+
+    def test_language_data_conditional(self):
+        # pytest test_cloudlanguagetools.py -k test_language_data_conditional
+        language_data, etag = self.clt.get_language_data_conditional(None)
+        self.assertEqual(language_data['language_list'], {'en': 'English', 'fr': 'French'})
+        # unchanged, the server answers with a 304
+        self.assertEqual(self.clt.get_language_data_conditional(etag), None)
+        # changed on the server
+        self.server.language_data['language_list']['de'] = 'German'
+        language_data, new_etag = self.clt.get_language_data_conditional(etag)
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(language_data['language_list']['de'], 'German')
+        self.assertEqual(self.server.get_request_count('language_data'), 3)
+
+    def test_retry_throttled(self):
+        # pytest test_cloudlanguagetools.py -k test_retry_throttled
+        sleep_calls = []
+        self.clt.scheduler = cloudlanguagetools.RequestScheduler(max_retries=3, sleep_fn=sleep_calls.append)
+        translation_option = {'service': 'Azure', 'source_language_id': 'fr', 'target_language_id': 'en'}
+
+        # throttled twice, then succeeds. the delay from Retry-After is honored
+        self.server.throttle('translate', 2, retry_after='7')
+        response = self.clt.get_translation('bonjour', translation_option)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.get_request_count('translate'), 3)
+        self.assertIn(7.0, sleep_calls)
+        self.assertEqual(self.clt.get_request_stats(), {'retries': 2, 'throttled': 2})
+        # the request rate got halved twice
+        self.assertEqual(self.clt.scheduler.rate, constants.REQUEST_MAX_RATE / 4 + constants.REQUEST_RATE_INCREASE)
+
+        # still throttled after all retries, the 429 gets returned to the caller
+        self.server.throttle('translate', 10)
+        response = self.clt.get_translation('bonjour', translation_option)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.clt.get_request_stats(), {'retries': 5, 'throttled': 6})
+
+    def test_translation_batch(self):
+        # pytest test_cloudlanguagetools.py -k test_translation_batch
+        translation_option = {'service': 'Azure', 'source_language_id': 'fr', 'target_language_id': 'en'}
+        response = self.clt.get_translation_batch(['un', 'deux', 'trois'], translation_option)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['results'], [
+            {'translated_text': 'translation of un'},
+            {'translated_text': 'translation of deux'},
+            {'translated_text': 'translation of trois'}
+        ])
+        self.assertEqual(self.server.get_request_count('translate_batch'), 1)
+        self.assertEqual(self.server.get_request_count('translate'), 0)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
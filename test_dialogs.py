@@ -1,7 +1,9 @@
 import unittest
 import pytest
 import pprint
+import time
 import logging
+import threading
 import aqt.qt
 
 import dialogs
@@ -18,6 +20,7 @@ import constants
 import testing_utils
 import deck_utils
 import errors
+import batch_utils
 
 def assert_combobox_items_equal(combobox, expected_items):
     combobox_items = []
@@ -31,6 +34,12 @@ def assert_combobox_items_equal(combobox, expected_items):
         logging.error(f'expected_items: {expected_items}')
     assert combobox_items == expected_items
 
+def run_add_audio_task(add_audio_dialog):
+    # what the apply button sets up before starting the background task
+    add_audio_dialog.success_count = 0
+    add_audio_dialog.cancellation_token = batch_utils.CancellationToken()
+    add_audio_dialog.add_audio_task()
+
 # https://pytest-qt.readthedocs.io/en/latest/tutorial.html
 
 
@@ -78,6 +87,183 @@ def test_add_audio(qtbot):
     # only uncomment if you want to see the dialog come up
     # add_audio_dialog.exec()
 
+def test_add_audio_task(qtbot):
+    # pytest test_dialogs.py -rPP -k test_add_audio_task
+
+    # a fourth note with the same text as the second one
+    config_gen = testing_utils.DuplicateTextConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    note_4 = config_gen.notes_by_id[config_gen.note_id_4]
+
+    deck_note_type = mock_language_tools.deck_utils.build_deck_note_type(config_gen.deck_id, config_gen.model_id)
+    note_id_list = config_gen.get_note_id_list()
+    add_audio_dialog = dialogs.AddAudioDialog(mock_language_tools, deck_note_type, note_id_list)
+    add_audio_dialog.setupUi()
+    add_audio_dialog.to_field_combobox.setCurrentIndex(config_gen.all_fields.index(config_gen.field_sound))
+    assert add_audio_dialog.to_field == config_gen.field_sound
+
+    run_add_audio_task(add_audio_dialog)
+
+    note_1 = config_gen.notes_by_id[config_gen.note_id_1]
+    note_2 = config_gen.notes_by_id[config_gen.note_id_2]
+    note_3 = config_gen.notes_by_id[config_gen.note_id_3]
+    assert 'sound:' in note_1.set_values['Sound']
+    assert 'sound:' in note_2.set_values['Sound']
+    assert note_1.set_values['Sound'] != note_2.set_values['Sound']
+    assert note_4.set_values == note_2.set_values
+    # empty field, skipped
+    assert note_3.set_values == {}
+
+    assert add_audio_dialog.success_count == 3
+    assert add_audio_dialog.generate_audio_errors == []
+    assert add_audio_dialog.progress_bar.value() == 4
+    assert mock_language_tools.anki_utils.update_notes_calls == [3]
+    assert mock_language_tools.get_request_stats()['deduplicated'] == 1
+    assert mock_language_tools.job_journal.get_interrupted_jobs() == []
+
+def test_add_audio_task_duplicates_across_segments(qtbot, monkeypatch):
+    # pytest test_dialogs.py -rPP -k test_add_audio_task_duplicates_across_segments
+
+    # a fourth note with the same text as the second one, in another segment
+    config_gen = testing_utils.DuplicateTextConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    note_4 = config_gen.notes_by_id[config_gen.note_id_4]
+    # one note per segment
+    monkeypatch.setattr(constants, 'NOTE_UPDATE_CHUNK_SIZE', 1)
+
+    tts_text_list = []
+    get_tts_audio = mock_language_tools.get_tts_audio
+    def record_tts_audio(source_text, service, language_code, voice_key, options):
+        tts_text_list.append(source_text)
+        return get_tts_audio(source_text, service, language_code, voice_key, options)
+    mock_language_tools.get_tts_audio = record_tts_audio
+
+    deck_note_type = mock_language_tools.deck_utils.build_deck_note_type(config_gen.deck_id, config_gen.model_id)
+    add_audio_dialog = dialogs.AddAudioDialog(mock_language_tools, deck_note_type, config_gen.get_note_id_list())
+    add_audio_dialog.setupUi()
+    add_audio_dialog.to_field_combobox.setCurrentIndex(config_gen.all_fields.index(config_gen.field_sound))
+    run_add_audio_task(add_audio_dialog)
+
+    # the second note's audio gets reused, like the estimate of the batch planner counts it
+    assert sorted(tts_text_list) == ['你好', '老人家']
+    assert note_4.set_values == config_gen.notes_by_id[config_gen.note_id_2].set_values
+    assert add_audio_dialog.success_count == 3
+    assert mock_language_tools.get_request_stats()['deduplicated'] == 1
+
+def test_add_audio_task_cancel(qtbot, monkeypatch):
+    # pytest test_dialogs.py -rPP -k test_add_audio_task_cancel
+
+    config_gen = testing_utils.DuplicateTextConfigGenerator('老人家')
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    note_4 = config_gen.notes_by_id[config_gen.note_id_4]
+    # two notes per segment
+    monkeypatch.setattr(constants, 'NOTE_UPDATE_CHUNK_SIZE', 2)
+
+    deck_note_type = mock_language_tools.deck_utils.build_deck_note_type(config_gen.deck_id, config_gen.model_id)
+    note_id_list = config_gen.get_note_id_list()
+    add_audio_dialog = dialogs.AddAudioDialog(mock_language_tools, deck_note_type, note_id_list)
+    add_audio_dialog.setupUi()
+    add_audio_dialog.to_field_combobox.setCurrentIndex(config_gen.all_fields.index(config_gen.field_sound))
+
+    # the user clicks Cancel while the first segment is being written
+    update_notes = mock_language_tools.anki_utils.update_notes
+    def update_notes_cancel(notes):
+        add_audio_dialog.reject()
+        update_notes(notes)
+    monkeypatch.setattr(mock_language_tools.anki_utils, 'update_notes', update_notes_cancel)
+
+    run_add_audio_task(add_audio_dialog)
+
+    assert add_audio_dialog.cancelButton.text() == 'Cancelling...'
+    # the first segment got written, the second one didn't start
+    assert 'sound:' in config_gen.notes_by_id[config_gen.note_id_1].set_values['Sound']
+    assert 'sound:' in config_gen.notes_by_id[config_gen.note_id_2].set_values['Sound']
+    assert note_4.set_values == {}
+    assert add_audio_dialog.success_count == 2
+    assert add_audio_dialog.progress_bar.value() == 2
+
+    # the job can be resumed
+    job = mock_language_tools.job_journal.get_interrupted_jobs()[0]
+    assert job['remaining'] == 2
+    assert mock_language_tools.job_journal.get_remaining_note_ids(job['job_id']) == [config_gen.note_id_3, config_gen.note_id_4]
+
+def test_add_audio_task_errors(qtbot):
+    # pytest test_dialogs.py -rPP -k test_add_audio_task_errors
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+
+    # the download fails for the first note
+    get_tts_audio = mock_language_tools.get_tts_audio
+    def failing_tts_audio(source_text, service, language_code, voice_key, options):
+        if source_text == '老人家':
+            raise errors.AudioLanguageToolsRequestError('audio request failed')
+        return get_tts_audio(source_text, service, language_code, voice_key, options)
+    mock_language_tools.get_tts_audio = failing_tts_audio
+
+    deck_note_type = mock_language_tools.deck_utils.build_deck_note_type(config_gen.deck_id, config_gen.model_id)
+    add_audio_dialog = dialogs.AddAudioDialog(mock_language_tools, deck_note_type, config_gen.get_note_id_list())
+    add_audio_dialog.setupUi()
+    add_audio_dialog.to_field_combobox.setCurrentIndex(config_gen.all_fields.index(config_gen.field_sound))
+    run_add_audio_task(add_audio_dialog)
+
+    assert add_audio_dialog.generate_audio_errors == ['audio request failed']
+    assert add_audio_dialog.success_count == 1
+    # the note which failed can be retried, the note with an empty field is done
+    job = mock_language_tools.job_journal.get_interrupted_jobs()[0]
+    assert mock_language_tools.job_journal.get_remaining_note_ids(job['job_id']) == [config_gen.note_id_1]
+    assert add_audio_dialog.remaining_count == 1
+
+def test_benchmark_add_audio_task(qtbot):
+    # pytest test_dialogs.py -k test_benchmark_add_audio_task -s
+    config_gen = testing_utils.TestConfigGenerator()
+    deck_note_type = deck_utils.DeckNoteType(config_gen.deck_id, config_gen.deck_name, config_gen.model_id, config_gen.model_name)
+
+    def run_add_audio(concurrency):
+        mock_language_tools = config_gen.build_languagetools_instance('default')
+        mock_language_tools.config['batch_concurrency'] = concurrency
+        cloud_language_tools = mock_language_tools.cloud_language_tools
+        cloud_language_tools.tts_audio_delay = 0.02
+
+        # keep track of how many downloads run at the same time
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+        get_tts_audio = cloud_language_tools.get_tts_audio
+        def counting_get_tts_audio(source_text, service, language_code, voice_key, options):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            try:
+                return get_tts_audio(source_text, service, language_code, voice_key, options)
+            finally:
+                with lock:
+                    running[0] -= 1
+        cloud_language_tools.get_tts_audio = counting_get_tts_audio
+
+        note_id_list = [50000 + i for i in range(40)]
+        for note_id in note_id_list:
+            mock_language_tools.anki_utils.notes_by_id[note_id] = testing_utils.MockNote(note_id, config_gen.model_id, {
+                config_gen.field_chinese: f'sentence {note_id}',
+                config_gen.field_english: '',
+                config_gen.field_sound: '',
+                config_gen.field_pinyin: ''
+            }, config_gen.all_fields)
+        add_audio_dialog = dialogs.AddAudioDialog(mock_language_tools, deck_note_type, note_id_list)
+        add_audio_dialog.setupUi()
+        start = time.perf_counter()
+        run_add_audio_task(add_audio_dialog)
+        elapsed = time.perf_counter() - start
+        assert add_audio_dialog.success_count == 40
+        return elapsed, max_running[0]
+
+    serial_time, serial_max_running = run_add_audio(1)
+    concurrent_time, concurrent_max_running = run_add_audio(8)
+    print(f'add audio, 40 notes: serial {serial_time * 1000:.0f}ms concurrent {concurrent_time * 1000:.0f}ms speedup {serial_time / concurrent_time:.1f}x')
+    # the downloads overlap, up to the configured concurrency
+    assert serial_max_running == 1
+    assert concurrent_max_running == 8
+
 def test_add_translation_transliteration_no_language_mapping(qtbot):
     # pytest test_dialogs.py -rPP -k test_add_translation_transliteration_no_language_mapping
 
@@ -462,6 +648,9 @@ def test_batch_transformation(qtbot):
     qtbot.keyClicks(dialog.from_combobox, 'Chinese')
     qtbot.keyClicks(dialog.to_combobox, 'English')
 
+    # the sample data comes from bulk field reads, no notes get loaded
+    assert mock_language_tools.anki_utils.get_note_by_id_count == 0
+
     # load translations button should be enabled
     assert dialog.load_translations_button.isEnabled() == True
     # apply to notes should be disabled
@@ -525,9 +714,99 @@ def test_batch_transformation(qtbot):
     assert note_3.set_values == {} # no values set
     assert note_3.flush_called == False
 
+    # both notes written in a single call
+    assert mock_language_tools.anki_utils.update_notes_calls == [2]
 
     # dialog.exec()
 
+def test_batch_transformation_large_selection(qtbot):
+    # pytest test_dialogs.py -rPP -k test_batch_transformation_large_selection
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    anki_utils = mock_language_tools.anki_utils
+
+    deck_note_type = deck_utils.DeckNoteType(config_gen.deck_id, config_gen.deck_name, config_gen.model_id, config_gen.model_name)
+    note_id_list = [50000 + i for i in range(3000)]
+    for note_id in note_id_list:
+        anki_utils.notes_by_id[note_id] = testing_utils.MockNote(note_id, config_gen.model_id, {
+            config_gen.field_chinese: f'sentence {note_id}',
+            config_gen.field_english: '',
+            config_gen.field_sound: '',
+            config_gen.field_pinyin: ''
+        }, config_gen.all_fields)
+    mock_language_tools.cloud_language_tools.translation_map = {f'sentence {note_id}': f'translation {note_id}' for note_id in note_id_list}
+
+    dialog = dialog_batchtransformation.prepare_batch_transformation_dialogue(mock_language_tools, deck_note_type, note_id_list, constants.TransformationType.Translation)
+    model = dialog.noteTableModel
+    anki_utils.get_field_values_for_notes_count = 0
+
+    # only the first page is exposed to the view, nothing gets read until it's displayed
+    assert model.rowCount(aqt.qt.QModelIndex()) == constants.NOTE_TABLE_PAGE_SIZE
+    assert model.canFetchMore(aqt.qt.QModelIndex()) == True
+    assert anki_utils.get_field_values_for_notes_count == 0
+    assert model.data(model.createIndex(0, 0), aqt.qt.Qt.ItemDataRole.DisplayRole) == 'sentence 50000'
+    assert model.data(model.createIndex(199, 0), aqt.qt.Qt.ItemDataRole.DisplayRole) == 'sentence 50199'
+    assert anki_utils.get_field_values_for_notes_count == 1
+
+    # scrolling down fetches more rows, their values are read a page at a time
+    while model.canFetchMore(aqt.qt.QModelIndex()):
+        model.fetchMore(aqt.qt.QModelIndex())
+    assert model.rowCount(aqt.qt.QModelIndex()) == 3000
+    for row in range(0, 3000, 100):
+        assert model.data(model.createIndex(row, 0), aqt.qt.Qt.ItemDataRole.DisplayRole) == f'sentence {50000 + row}'
+    assert anki_utils.get_field_values_for_notes_count == 3000 // constants.NOTE_TABLE_PAGE_SIZE
+    # only the most recently used pages are kept
+    assert len(model.from_field_pages) == constants.NOTE_TABLE_MAX_CACHED_PAGES
+
+    qtbot.mouseClick(dialog.load_translations_button, aqt.qt.Qt.MouseButton.LeftButton)
+    assert model.data(model.createIndex(2999, 1), aqt.qt.Qt.ItemDataRole.DisplayRole) == 'translation 52999'
+    assert len(model.getToFieldResults()) == 3000
+
+    qtbot.mouseClick(dialog.applyButton, aqt.qt.Qt.MouseButton.LeftButton)
+    assert anki_utils.notes_by_id[50000].set_values == {'English': 'translation 50000'}
+    assert anki_utils.notes_by_id[52999].set_values == {'English': 'translation 52999'}
+
+def test_batch_transformation_duplicates_across_segments(qtbot, monkeypatch):
+    # pytest test_dialogs.py -rPP -k test_batch_transformation_duplicates_across_segments
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    anki_utils = mock_language_tools.anki_utils
+    # the from field is read 4 notes at a time
+    monkeypatch.setattr(constants, 'NOTE_QUERY_CHUNK_SIZE', 4)
+
+    deck_note_type = deck_utils.DeckNoteType(config_gen.deck_id, config_gen.deck_name, config_gen.model_id, config_gen.model_name)
+    note_id_list = [50000 + i for i in range(30)]
+    for note_id in note_id_list:
+        anki_utils.notes_by_id[note_id] = testing_utils.MockNote(note_id, config_gen.model_id, {
+            config_gen.field_chinese: f'sentence {note_id % 3}',
+            config_gen.field_english: '',
+            config_gen.field_sound: '',
+            config_gen.field_pinyin: ''
+        }, config_gen.all_fields)
+    mock_language_tools.cloud_language_tools.translation_map = {f'sentence {i}': f'translation {i}' for i in range(3)}
+
+    sent_text_list = []
+    get_translation_batch = mock_language_tools.get_translation_batch
+    def record_translation_batch(source_text_list, translation_option):
+        sent_text_list.extend(source_text_list)
+        return get_translation_batch(source_text_list, translation_option)
+    mock_language_tools.get_translation_batch = record_translation_batch
+
+    dialog = dialog_batchtransformation.prepare_batch_transformation_dialogue(mock_language_tools, deck_note_type, note_id_list, constants.TransformationType.Translation)
+    qtbot.mouseClick(dialog.load_translations_button, aqt.qt.Qt.MouseButton.LeftButton)
+
+    # each distinct text is sent once, even though it shows up in every segment
+    assert sorted(sent_text_list) == ['sentence 0', 'sentence 1', 'sentence 2']
+    assert mock_language_tools.get_request_stats()['deduplicated'] == 27
+    # reported without errors as well
+    assert anki_utils.tooltip_message_received == 'Requests saved on duplicate text: 27'
+    model = dialog.noteTableModel
+    assert len(model.getToFieldResults()) == 30
+    for row in range(30):
+        assert model.data(model.createIndex(row, 1), aqt.qt.Qt.ItemDataRole.DisplayRole) == f'translation {(50000 + row) % 3}'
+
 def test_batch_transformation_error_handling(qtbot):
     # pytest test_dialogs.py -rPP -k test_batch_transformation_error_handling
 
@@ -866,6 +1145,12 @@ def test_dialog_runrules(qtbot):
     dialog.setupUi()
     # dialog.exec()
 
+    # dry run first, nothing gets sent
+    qtbot.mouseClick(dialog.estimateButton, aqt.qt.Qt.MouseButton.LeftButton)
+    assert 'Estimate for 3 notes' in mock_language_tools.anki_utils.info_message_received
+    assert mock_language_tools.cloud_language_tools.batch_request_count == 0
+    mock_language_tools.anki_utils.get_field_values_for_notes_count = 0
+
     # click apply button
     qtbot.mouseClick(dialog.applyButton, aqt.qt.Qt.MouseButton.LeftButton)
 
@@ -892,6 +1177,11 @@ def test_dialog_runrules(qtbot):
     assert note_3.set_values == {} # no values set
     assert note_3.flush_called == False
 
+    # fields were read in bulk, only the two modified notes got loaded
+    assert mock_language_tools.anki_utils.get_field_values_for_notes_count == 1
+    assert mock_language_tools.anki_utils.get_note_by_id_count == 2
+    assert mock_language_tools.anki_utils.update_notes_calls == [2]
+
     # check action stats
     expected_action_stats = {
         'adding translation to field English': {
@@ -912,3 +1202,158 @@ def test_dialog_runrules(qtbot):
 
 
 
+
+    # the job completed, nothing left to resume
+    assert mock_language_tools.job_journal.get_interrupted_jobs() == []
+
+def test_dialog_runrules_resume(qtbot):
+    # pytest test_dialogs.py -rPP -k test_dialog_runrules_resume
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('batch_audio_translation_transliteration')
+
+    deck_note_type = deck_utils.DeckNoteType(config_gen.deck_id, config_gen.deck_name, config_gen.model_id, config_gen.model_name)
+    note_id_list = config_gen.get_note_id_list()
+
+    mock_language_tools.cloud_language_tools.translation_map = {
+        '老人家': 'translation 1',
+        '你好': 'translation 2'
+    }
+
+    # a job which only ran the translation rule got interrupted after the first note
+    journal = mock_language_tools.job_journal
+    job_id = journal.start_job(constants.JOB_TYPE_RUN_RULES, 'Run Rules', 'previous fingerprint', {'enabled_fields': ['English']}, note_id_list)
+    journal.mark_done(job_id, [config_gen.note_id_1])
+    job = journal.get_interrupted_jobs()[0]
+    assert job['remaining'] == 2
+    remaining_note_id_list = journal.get_remaining_note_ids(job_id)
+    assert remaining_note_id_list == [config_gen.note_id_2, config_gen.note_id_3]
+
+    dialog = dialog_notesettings.RunRulesDialog(mock_language_tools, deck_note_type, remaining_note_id_list, resume_job=job)
+    dialog.setupUi()
+    # the rules selected when the job started are restored
+    assert dialog.get_enabled_fields() == ['English']
+
+    qtbot.mouseClick(dialog.applyButton, aqt.qt.Qt.MouseButton.LeftButton)
+
+    assert config_gen.notes_by_id[config_gen.note_id_1].set_values == {}
+    assert config_gen.notes_by_id[config_gen.note_id_2].set_values == {'English': 'translation 2'}
+    # the interrupted job got replaced by the new run, which completed
+    assert journal.get_interrupted_jobs() == []
+
+def test_dialog_runrules_cancel(qtbot, monkeypatch):
+    # pytest test_dialogs.py -rPP -k test_dialog_runrules_cancel
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('batch_audio_translation_transliteration')
+    # one note per segment
+    monkeypatch.setattr(constants, 'NOTE_UPDATE_CHUNK_SIZE', 1)
+
+    deck_note_type = deck_utils.DeckNoteType(config_gen.deck_id, config_gen.deck_name, config_gen.model_id, config_gen.model_name)
+    note_id_list = config_gen.get_note_id_list()
+
+    mock_language_tools.cloud_language_tools.translation_map = {
+        '老人家': 'translation 1',
+        '你好': 'translation 2'
+    }
+    mock_language_tools.cloud_language_tools.transliteration_map = {
+        '老人家': 'transliteration 1',
+        '你好': 'transliteration 2'
+    }
+
+    dialog = dialog_notesettings.RunRulesDialog(mock_language_tools, deck_note_type, note_id_list)
+    dialog.setupUi()
+
+    # the user clicks Cancel while the first segment is being written
+    update_notes = mock_language_tools.anki_utils.update_notes
+    def update_notes_cancel(notes):
+        dialog.reject()
+        update_notes(notes)
+    monkeypatch.setattr(mock_language_tools.anki_utils, 'update_notes', update_notes_cancel)
+
+    qtbot.mouseClick(dialog.applyButton, aqt.qt.Qt.MouseButton.LeftButton)
+
+    # the first note got all its rules, the next ones weren't processed
+    note_1_set_values = config_gen.notes_by_id[config_gen.note_id_1].set_values
+    assert note_1_set_values['English'] == 'translation 1'
+    assert note_1_set_values['Pinyin'] == 'transliteration 1'
+    assert 'sound:' in note_1_set_values['Sound']
+    assert config_gen.notes_by_id[config_gen.note_id_2].set_values == {}
+    assert mock_language_tools.anki_utils.update_notes_calls == [1]
+    assert 'Cancelled' in mock_language_tools.anki_utils.info_message_received
+
+    # the job can be resumed
+    job = mock_language_tools.job_journal.get_interrupted_jobs()[0]
+    assert mock_language_tools.job_journal.get_remaining_note_ids(job['job_id']) == [config_gen.note_id_2, config_gen.note_id_3]
+
+def test_dialog_runrules_errors(qtbot):
+    # pytest test_dialogs.py -rPP -k test_dialog_runrules_errors
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('batch_audio_translation_transliteration')
+
+    deck_note_type = deck_utils.DeckNoteType(config_gen.deck_id, config_gen.deck_name, config_gen.model_id, config_gen.model_name)
+    note_id_list = config_gen.get_note_id_list()
+
+    # the translation of the first note fails
+    mock_language_tools.cloud_language_tools.translation_map = {
+        '你好': 'translation 2'
+    }
+    mock_language_tools.cloud_language_tools.translation_error_map = {
+        '老人家': 'translation error 42'
+    }
+    mock_language_tools.cloud_language_tools.transliteration_map = {
+        '老人家': 'transliteration 1',
+        '你好': 'transliteration 2'
+    }
+
+    dialog = dialog_notesettings.RunRulesDialog(mock_language_tools, deck_note_type, note_id_list)
+    dialog.setupUi()
+    qtbot.mouseClick(dialog.applyButton, aqt.qt.Qt.MouseButton.LeftButton)
+
+    # the other rules still got written
+    note_1_set_values = config_gen.notes_by_id[config_gen.note_id_1].set_values
+    assert 'English' not in note_1_set_values
+    assert note_1_set_values['Pinyin'] == 'transliteration 1'
+    assert config_gen.notes_by_id[config_gen.note_id_2].set_values['English'] == 'translation 2'
+
+    # the note which failed can be retried, the note with an empty field is done
+    job = mock_language_tools.job_journal.get_interrupted_jobs()[0]
+    assert mock_language_tools.job_journal.get_remaining_note_ids(job['job_id']) == [config_gen.note_id_1]
+    assert 'Resume Interrupted Job' in mock_language_tools.anki_utils.info_message_received
+
+def test_dialog_runrules_duplicate_text(qtbot):
+    # pytest test_dialogs.py -rPP -k test_dialog_runrules_duplicate_text
+
+    # a fourth note with the same text as the second one, once the formatting is removed
+    config_gen = testing_utils.DuplicateTextConfigGenerator('<b>你好</b>')
+    mock_language_tools = config_gen.build_languagetools_instance('batch_audio_translation_transliteration')
+    note_4 = config_gen.notes_by_id[config_gen.note_id_4]
+
+    deck_note_type = deck_utils.DeckNoteType(config_gen.deck_id, config_gen.deck_name, config_gen.model_id, config_gen.model_name)
+    note_id_list = config_gen.get_note_id_list()
+    assert config_gen.note_id_4 in note_id_list
+
+    mock_language_tools.cloud_language_tools.translation_map = {
+        '老人家': 'translation 1',
+        '你好': 'translation 2'
+    }
+    mock_language_tools.cloud_language_tools.transliteration_map = {
+        '老人家': 'transliteration 1',
+        '你好': 'transliteration 2'
+    }
+
+    dialog = dialog_notesettings.RunRulesDialog(mock_language_tools, deck_note_type, note_id_list)
+    dialog.setupUi()
+    qtbot.mouseClick(dialog.applyButton, aqt.qt.Qt.MouseButton.LeftButton)
+
+    # the duplicate note gets the same results
+    note_2_set_values = config_gen.notes_by_id[config_gen.note_id_2].set_values
+    assert note_4.set_values == note_2_set_values
+    assert note_4.set_values['English'] == 'translation 2'
+    assert note_4.set_values['Pinyin'] == 'transliteration 2'
+
+    # one request saved for each of translation, transliteration and audio
+    assert mock_language_tools.get_request_stats()['deduplicated'] == 3
+    assert dialog.batch_error_manager.action_stats['adding translation to field English']['success'] == 3
+    assert 'Requests saved on duplicate text: 3' in dialog.batch_error_manager.get_stats_str()
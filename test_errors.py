@@ -139,4 +139,23 @@ def test_error_manager(qtbot):
             'success': 0,
             'error': {'Unknown Error: this is unhandled': 1}
         }        
-    }
\ No newline at end of file
+    }
+
+
+def test_batch_error_manager_request_stats(qtbot):
+    # pytest test_errors.py -k test_batch_error_manager_request_stats
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    cloud_language_tools = mock_language_tools.cloud_language_tools
+    cloud_language_tools.request_stats = {'retries': 3, 'throttled': 1}
+
+    batch_error_manager = mock_language_tools.error_manager.get_batch_error_manager('batch test')
+    with batch_error_manager.get_batch_action_context('batch iteration'):
+        logging.info('ok')
+    # no retries during this batch
+    assert 'Retried requests' not in batch_error_manager.get_stats_str()
+
+    # only the retries which happened since the batch started get reported
+    cloud_language_tools.request_stats = {'retries': 7, 'throttled': 3}
+    assert 'Retried requests: 4, throttled by server: 2' in batch_error_manager.get_stats_str()
@@ -0,0 +1,135 @@
+import os
+import time
+import threading
+import random
+import collections
+import pytest
+import anki.collection
+import constants
+import deck_utils
+import errors
+import testing_utils
+import field_sampler
+
+def test_field_samples(qtbot):
+    # pytest test_field_sampler.py -rPP -k test_field_samples
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    anki_utils = mock_language_tools.anki_utils
+    note_id = config_gen.get_note_id_list()[0]
+    anki_utils.notes_by_id[note_id].field_dict[config_gen.field_english] = '<b>old</b> <img src="image.png">people'
+
+    deck_note_type = deck_utils.DeckNoteType(config_gen.deck_id, config_gen.deck_name, config_gen.model_id, config_gen.model_name)
+    sampler = field_sampler.FieldSampler(mock_language_tools, 20)
+
+    assert sorted(sampler.get_field_samples(deck_utils.DeckNoteTypeField(deck_note_type, config_gen.field_english))) == ['empty', 'hello', 'old people']
+    assert sorted(sampler.get_field_samples(deck_utils.DeckNoteTypeField(deck_note_type, config_gen.field_chinese))) == ['你好', '老人家']
+    # empty fields don't produce samples
+    assert sampler.get_field_samples(deck_utils.DeckNoteTypeField(deck_note_type, config_gen.field_sound)) == []
+
+    # all the fields were read in a single query, without loading the notes
+    assert anki_utils.get_field_values_for_notes_count == 1
+    assert anki_utils.get_note_by_id_count == 0
+
+    with pytest.raises(errors.AnkiItemNotFoundError):
+        sampler.get_field_samples(deck_utils.DeckNoteTypeField(deck_note_type, 'Removed Field'))
+
+def test_language_detection_shared_sampler(qtbot):
+    # pytest test_field_sampler.py -rPP -k test_language_detection_shared_sampler
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    anki_utils = mock_language_tools.anki_utils
+
+    sampler = mock_language_tools.build_language_detection_sampler()
+    detected = {}
+    for dntf in mock_language_tools.get_populated_dntf():
+        detected[dntf.field_name] = mock_language_tools.perform_language_detection_deck_note_type_field(dntf, sampler)
+    assert detected[config_gen.field_chinese] == 'zh_cn'
+    assert detected[config_gen.field_english] == 'en'
+    assert detected[config_gen.field_sound] == None
+    assert anki_utils.get_field_values_for_notes_count == 1
+
+def build_large_collection(collection_path, note_count):
+    # notes of two note types, each one with two cards spread over two decks, written straight to the tables
+    col = anki.collection.Collection(collection_path)
+    col.db.executemany('INSERT INTO notes (id, guid, mid, mod, usn, tags, flds, sfld, csum, flags, data) VALUES (?, ?, ?, 0, 0, "", "text", "text", 0, 0, "")',
+        [(note_id, str(note_id), 1 + note_id % 2) for note_id in range(1, note_count + 1)])
+    col.db.executemany('INSERT INTO cards (id, nid, did, ord, mod, usn, type, queue, due, ivl, factor, reps, lapses, left, odue, odid, flags, data) VALUES (?, ?, ?, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, "")',
+        [(card_id, (card_id + 1) // 2, 1 + card_id % 3 // 2) for card_id in range(1, 2 * note_count + 1)])
+    return col
+
+def test_sample_note_ids(qtbot, tmp_path):
+    # pytest test_field_sampler.py -rPP -k test_sample_note_ids
+    col = build_large_collection(os.path.join(tmp_path, 'collection.anki2'), 20)
+    try:
+        all_note_id_list = col.db.list('SELECT DISTINCT notes.id FROM notes INNER JOIN cards ON notes.id = cards.nid WHERE notes.mid=2 AND cards.did=1')
+        picked = collections.Counter()
+        for i in range(300):
+            note_id_list = field_sampler.sample_note_ids(col.db.all, 1, 2, 3)
+            assert len(note_id_list) == len(set(note_id_list))
+            assert set(note_id_list).issubset(all_note_id_list)
+            picked.update(note_id_list)
+        # every note of the Deck / Note Type gets picked
+        assert set(picked.keys()) == set(all_note_id_list)
+        # fewer notes than the sample size
+        assert sorted(field_sampler.sample_note_ids(col.db.all, 1, 2, 100)) == sorted(all_note_id_list)
+        # some notes have both of their cards in the deck, a full sample is still made of distinct notes
+        assert len(field_sampler.sample_note_ids(col.db.all, 1, 2, len(all_note_id_list))) == len(all_note_id_list)
+    finally:
+        col.close()
+
+# builds a large collection, only runs with LANGUAGETOOLS_BENCHMARK=enable
+@pytest.mark.skipif(os.environ.get('LANGUAGETOOLS_BENCHMARK', '') != 'enable', reason='benchmark, set LANGUAGETOOLS_BENCHMARK=enable to run it')
+def test_benchmark_sample_note_ids(qtbot, tmp_path):
+    # LANGUAGETOOLS_BENCHMARK=enable pytest test_field_sampler.py -rPP -k test_benchmark_sample_note_ids
+    col = build_large_collection(os.path.join(tmp_path, 'collection.anki2'), 200000)
+    try:
+        start_time = time.time()
+        note_id_list = field_sampler.sample_note_ids(col.db.all, 1, 2, constants.LANGUAGE_DETECTION_SAMPLE_SIZE)
+        sample_seconds = time.time() - start_time
+        assert len(note_id_list) > 0
+
+        # alternative: read all the note ids, sample them in python
+        start_time = time.time()
+        all_note_id_list = col.db.list('SELECT DISTINCT notes.id FROM notes INNER JOIN cards ON notes.id = cards.nid WHERE notes.mid=2 AND cards.did=1')
+        random.sample(all_note_id_list, constants.LANGUAGE_DETECTION_SAMPLE_SIZE)
+        read_all_seconds = time.time() - start_time
+
+        print(f'{len(all_note_id_list)} notes, ORDER BY RANDOM() LIMIT: {sample_seconds:.3f}s, read all ids and sample: {read_all_seconds:.3f}s')
+    finally:
+        col.close()
+
+def test_language_detection_dntf_list(qtbot):
+    # pytest test_field_sampler.py -rPP -k test_language_detection_dntf_list
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    mock_language_tools.config[constants.CONFIG_BATCH_CONCURRENCY] = 2
+
+    # slow detect requests, keep track of how many run at the same time
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+    language_detection = mock_language_tools.cloud_language_tools.language_detection
+    def slow_language_detection(field_sample):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+        return language_detection(field_sample)
+    mock_language_tools.cloud_language_tools.language_detection = slow_language_detection
+
+    dntf_list = mock_language_tools.get_populated_dntf()
+    detected = {}
+    for dntf, language, exception in mock_language_tools.perform_language_detection_dntf_list(dntf_list):
+        assert exception == None
+        detected[dntf.field_name] = language
+    assert detected == {
+        config_gen.field_chinese: 'zh_cn',
+        config_gen.field_english: 'en',
+        config_gen.field_sound: None,
+        config_gen.field_pinyin: None
+    }
+    assert max_running[0] == 2
+    assert mock_language_tools.anki_utils.get_field_values_for_notes_count == 1
@@ -0,0 +1,100 @@
+import os
+import json
+import anki.collection
+
+# add external search path
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), 'external'))
+
+import constants
+import headless
+import testing_server
+
+def build_collection(collection_path):
+    col = anki.collection.Collection(collection_path)
+    model = col.models.by_name('Basic')
+    col.models.add_field(model, col.models.new_field('Sound'))
+    col.models.update_dict(model)
+    deck_id = col.decks.id('French')
+    other_deck_id = col.decks.id('Other')
+    note_id_list = []
+    for text in ['bonjour', 'merci', 'bonjour', '']:
+        note = col.new_note(model)
+        note['Front'] = text
+        col.add_note(note, deck_id)
+        note_id_list.append(note.id)
+    # not in the deck being processed
+    note = col.new_note(model)
+    note['Front'] = 'au revoir'
+    col.add_note(note, other_deck_id)
+    other_note_id = note.id
+    col.close()
+    return note_id_list, other_note_id
+
+def build_config(config_path, api_key):
+    config = {
+        'api_key': api_key,
+        constants.CONFIG_DECK_LANGUAGES: {'Basic': {'French': {'Front': 'fr', 'Back': 'en', 'Sound': 'sound'}}},
+        constants.CONFIG_WANTED_LANGUAGES: {'en': True, 'fr': True},
+        constants.CONFIG_VOICE_SELECTION: {
+            'en': {'voice_key': {'name': 'en-voice'}, 'voice_description': 'English voice', 'service': 'Azure', 'language_code': 'en'}
+        },
+        constants.CONFIG_BATCH_TRANSLATION: {'Basic': {'French': {
+            'Back': {'from_field': 'Front', 'translation_option': {'service': 'Azure', 'source_language_id': 'fr', 'target_language_id': 'en'}}
+        }}},
+        # reads the output of the translation rule
+        constants.CONFIG_BATCH_AUDIO: {'Basic': {'French': {'Sound': 'Back'}}}
+    }
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+
+def test_headless_run_rules(qtbot, tmp_path, monkeypatch, capsys):
+    # pytest test_headless.py -rPP -k test_headless_run_rules
+    stand_in = testing_server.StandInServer().start()
+    monkeypatch.setenv(constants.ENV_VAR_ANKI_LANGUAGE_TOOLS_BASE_URL, stand_in.base_url)
+    monkeypatch.setenv(constants.ENV_VAR_ANKI_LANGUAGE_TOOLS_VOCABAI_BASE_URL, stand_in.base_url + '/vocab')
+
+    collection_path = os.path.join(tmp_path, 'collection.anki2')
+    config_path = os.path.join(tmp_path, 'config.json')
+    note_id_list, other_note_id = build_collection(collection_path)
+    build_config(config_path, stand_in.api_key)
+
+    col = headless.open_collection(collection_path)
+    try:
+        languagetools = headless.build_languagetools(col, config_path)
+        # the caches in user_files are shared with the other tests
+        languagetools.translation_cache.clear()
+        languagetools.clean_user_files_audio()
+        # a dry run doesn't send anything
+        estimate_list = headless.run_rules(languagetools, deck_name='French', dry_run=True)
+        assert 'Estimate for 4 notes' in estimate_list[0]
+        assert stand_in.get_request_count('translate_batch') == 0
+        headless.run_rules(languagetools, deck_name='French')
+        languagetools.shutdown()
+    finally:
+        col.close()
+        stand_in.stop()
+
+    output = capsys.readouterr().out
+    assert 'Run Rules for Basic / French: 2 rules, 4 notes' in output
+    assert 'adding translation to field Back: success: 3, errors: (Field is empty: 1)' in output
+
+    col = anki.collection.Collection(collection_path)
+    try:
+        note = col.get_note(note_id_list[0])
+        assert note['Back'] == 'translation of bonjour'
+        assert note['Sound'].startswith('[sound:languagetools-')
+        # the audio file was added to the collection media
+        sound_filename = note['Sound'][len('[sound:'):-1]
+        assert os.path.isfile(os.path.join(col.media.dir(), sound_filename))
+        assert col.get_note(note_id_list[1])['Back'] == 'translation of merci'
+        assert col.get_note(note_id_list[2])['Sound'] == note['Sound']
+        assert col.get_note(note_id_list[3])['Back'] == ''
+        # other deck untouched
+        assert col.get_note(other_note_id)['Back'] == ''
+    finally:
+        col.close()
+
+    # one bulk request for the two distinct texts, one audio request per distinct translation
+    assert stand_in.get_request_count('translate_batch') == 1
+    assert stand_in.get_request_count('audio') <= 2
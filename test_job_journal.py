@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import job_journal
+
+def test_job_journal(qtbot, tmp_path):
+    db_path = os.path.join(tmp_path, 'job_journal.sqlite3')
+    journal = job_journal.JobJournal(db_path, lambda: 'profile1/collection.anki2')
+    assert journal.get_interrupted_jobs() == []
+
+    fingerprint = job_journal.get_fingerprint({'from_field': 'Chinese', 'to_field': 'Sound'})
+    job_id = journal.start_job('add_audio', 'Add Audio to Sound', fingerprint, {'from_field': 'Chinese', 'to_field': 'Sound'}, [5, 3, 4, 1, 2])
+    journal.mark_done(job_id, [5, 3])
+    assert journal.get_remaining_note_ids(job_id) == [4, 1, 2]
+    journal.close()
+
+    # the job survives a restart
+    journal = job_journal.JobJournal(db_path, lambda: 'profile1/collection.anki2')
+    job_list = journal.get_interrupted_jobs()
+    assert len(job_list) == 1
+    job = job_list[0]
+    assert job['job_id'] == job_id
+    assert job['job_type'] == 'add_audio'
+    assert job['fingerprint'] == fingerprint
+    assert job['parameters'] == {'from_field': 'Chinese', 'to_field': 'Sound'}
+    assert job['total'] == 5
+    assert job['remaining'] == 3
+    assert journal.get_remaining_note_ids(job_id) == [4, 1, 2]
+
+    # the fingerprint doesn't depend on key order, but does on values
+    assert job_journal.get_fingerprint({'to_field': 'Sound', 'from_field': 'Chinese'}) == fingerprint
+    assert job_journal.get_fingerprint({'from_field': 'Chinese', 'to_field': 'Sound 2'}) != fingerprint
+
+    journal.mark_done(job_id, [4, 1, 2])
+    assert journal.get_remaining_note_ids(job_id) == []
+    journal.finish_job(job_id)
+    assert journal.get_interrupted_jobs() == []
+    journal.close()
+
+def test_job_journal_profiles(qtbot, tmp_path):
+    # pytest test_job_journal.py -rPP -k test_job_journal_profiles
+    # every profile shares the journal, the jobs only get offered to the collection they were started on
+    db_path = os.path.join(tmp_path, 'job_journal.sqlite3')
+    collection_key = ['profile1/collection.anki2']
+    journal = job_journal.JobJournal(db_path, lambda: collection_key[0])
+    job_id = journal.start_job('add_audio', 'Add Audio to Sound', 'fingerprint', {}, [1, 2, 3])
+    assert len(journal.get_interrupted_jobs()) == 1
+    # profile switch
+    journal.close()
+
+    collection_key[0] = 'profile2/collection.anki2'
+    assert journal.get_interrupted_jobs() == []
+    job_id_2 = journal.start_job('run_rules', 'Run Rules', 'fingerprint', {}, [1, 2])
+    assert [job['job_id'] for job in journal.get_interrupted_jobs()] == [job_id_2]
+    journal.close()
+
+    collection_key[0] = 'profile1/collection.anki2'
+    assert [job['job_id'] for job in journal.get_interrupted_jobs()] == [job_id]
+    assert journal.get_remaining_note_ids(job_id) == [1, 2, 3]
+    journal.close()
+
+def test_job_journal_upgrade(qtbot, tmp_path):
+    # pytest test_job_journal.py -rPP -k test_job_journal_upgrade
+    # journal written before jobs were recorded along with their collection
+    db_path = os.path.join(tmp_path, 'job_journal.sqlite3')
+    connection = sqlite3.connect(db_path)
+    connection.execute('CREATE TABLE jobs (job_id INTEGER PRIMARY KEY AUTOINCREMENT, job_type TEXT, description TEXT, fingerprint TEXT, parameters TEXT, created REAL)')
+    connection.execute("INSERT INTO jobs (job_type, description, fingerprint, parameters, created) VALUES ('add_audio', 'Add Audio', 'fingerprint', '{}', 0)")
+    connection.commit()
+    connection.close()
+
+    journal = job_journal.JobJournal(db_path, lambda: 'profile1/collection.anki2')
+    assert journal.get_interrupted_jobs() == []
+    job_id = journal.start_job('add_audio', 'Add Audio to Sound', 'fingerprint', {}, [1])
+    assert [job['job_id'] for job in journal.get_interrupted_jobs()] == [job_id]
+    journal.close()
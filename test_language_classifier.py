@@ -0,0 +1,89 @@
+import constants
+import deck_utils
+import testing_utils
+import language_classifier
+
+def test_classify_sample(qtbot):
+    # pytest test_language_classifier.py -rPP -k test_classify_sample
+    assert language_classifier.classify_sample('[sound:languagetools-123.mp3]') == 'sound'
+    # html_to_text_line keeps the filename of the sound tags
+    assert language_classifier.classify_sample('languagetools-123.mp3 other.ogg') == 'sound'
+    assert language_classifier.classify_sample('12.5 / 3') == None
+    assert language_classifier.classify_sample('사과') == 'hangul'
+    assert language_classifier.classify_sample('林檎 りんご') == 'kana'
+    assert language_classifier.classify_sample('ขอบคุณ') == 'thai'
+    assert language_classifier.classify_sample('שלום') == 'hebrew'
+    assert language_classifier.classify_sample('ευχαριστώ') == 'greek'
+    assert language_classifier.classify_sample('мышь') == 'ru'
+    # could be another language written in cyrillic
+    assert language_classifier.classify_sample('привет') == 'cyrillic'
+    assert language_classifier.classify_sample('дякую, їжак') == 'ambiguous'
+    # chuvash, bashkir
+    assert language_classifier.classify_sample('ҫырӑ') == 'ambiguous'
+    assert language_classifier.classify_sample('ҡыҙ') == 'ambiguous'
+    # chinese characters on their own, latin, mixed scripts
+    assert language_classifier.classify_sample('老人家') == 'ambiguous'
+    assert language_classifier.classify_sample('bonjour') == 'ambiguous'
+    assert language_classifier.classify_sample('사과 apple') == 'ambiguous'
+
+def test_classify_field_sample(qtbot):
+    # pytest test_language_classifier.py -rPP -k test_classify_field_sample
+    classifier = language_classifier.LanguageClassifier(['en', 'ko', 'ru'])
+
+    assert classifier.classify([]) == (True, None)
+    assert classifier.classify(['1', '2.5']) == (True, None)
+    assert classifier.classify(['[sound:a.mp3]', '[sound:b.mp3]']) == (True, constants.SpecialLanguage.sound.name)
+    assert classifier.classify(['사과', '123', '바나나']) == (True, 'ko')
+    assert classifier.classify(['привет', 'мышь']) == (True, 'ru')
+    # not enough to tell russian apart from other languages
+    assert classifier.classify(['привет']) == (False, None)
+    assert classifier.classify(['사과', 'りんご']) == (False, None)
+    assert classifier.classify(['bonjour', 'merci']) == (False, None)
+    # not a language known to the server
+    assert classifier.classify(['ขอบคุณ']) == (False, None)
+
+def test_classify_field_sample_shared_script(qtbot):
+    # pytest test_language_classifier.py -rPP -k test_classify_field_sample_shared_script
+    # hebrew is also used by yiddish, only decided when the server doesn't list yiddish
+    assert language_classifier.LanguageClassifier(['en', 'he']).classify(['שלום']) == (True, 'he')
+    assert language_classifier.LanguageClassifier(['en', 'he', 'yi']).classify(['שלום']) == (False, None)
+    # two variants of the same language
+    assert language_classifier.LanguageClassifier(['el', 'el_cy']).classify(['ευχαριστώ']) == (False, None)
+    # erzya is written with the russian letters only
+    assert language_classifier.LanguageClassifier(['ru', 'uk']).classify(['мышь']) == (True, 'ru')
+    assert language_classifier.LanguageClassifier(['ru', 'myv']).classify(['мышь']) == (False, None)
+    # bashkir has letters of its own
+    assert language_classifier.LanguageClassifier(['ru', 'ba']).classify(['мышь', 'ҡыҙ']) == (False, None)
+
+def test_language_detection_decided_locally(qtbot):
+    # pytest test_language_classifier.py -rPP -k test_language_detection_decided_locally
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    mock_language_tools.language_list['ko'] = 'Korean'
+    anki_utils = mock_language_tools.anki_utils
+    for note_id, sound, pinyin in [(config_gen.note_id_1, '[sound:1.mp3]', '사과'), (config_gen.note_id_2, '[sound:2.mp3]', '바나나')]:
+        anki_utils.notes_by_id[note_id].field_dict[config_gen.field_sound] = sound
+        anki_utils.notes_by_id[note_id].field_dict[config_gen.field_pinyin] = pinyin
+
+    detection_request_list = []
+    language_detection = mock_language_tools.cloud_language_tools.language_detection
+    def record_language_detection(field_sample):
+        detection_request_list.append(field_sample)
+        return language_detection(field_sample)
+    mock_language_tools.cloud_language_tools.language_detection = record_language_detection
+
+    dntf_list = mock_language_tools.get_populated_dntf()
+    detected = {dntf.field_name: language for dntf, language, exception in mock_language_tools.perform_language_detection_dntf_list(dntf_list)}
+    assert detected == {
+        config_gen.field_chinese: 'zh_cn',
+        config_gen.field_english: 'en',
+        config_gen.field_sound: constants.SpecialLanguage.sound.name,
+        config_gen.field_pinyin: 'ko'
+    }
+    # only the chinese and english fields were sent
+    assert len(detection_request_list) == 2
+
+    deck_note_type = deck_utils.DeckNoteType(config_gen.deck_id, config_gen.deck_name, config_gen.model_id, config_gen.model_name)
+    dntf = deck_utils.DeckNoteTypeField(deck_note_type, config_gen.field_sound)
+    assert mock_language_tools.perform_language_detection_deck_note_type_field(dntf) == constants.SpecialLanguage.sound.name
+    assert len(detection_request_list) == 2
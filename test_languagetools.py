@@ -1,7 +1,21 @@
+import os
+import sys
 import json
+import time
+import threading
+import pytest
 import unittest
 import errors
+import constants
 import testing_utils
+import languagetools
+import deck_utils
+
+# add external search path
+sys.path.append(os.path.join(os.path.dirname(__file__), 'external'))
+
+import cloudlanguagetools
+import testing_server
 
 class EmptyFieldConfigGenerator(testing_utils.TestConfigGenerator):
     def __init__(self):
@@ -119,6 +133,27 @@ def test_get_tts_audio(qtbot):
     assert data['voice_key'] == {'name': 'voice1'}
     assert data['options'] == {}
 
+def test_cache_stats(qtbot):
+    # pytest test_languagetools.py -k test_cache_stats
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+
+    mock_language_tools.get_tts_audio('old people', 'Azure', 'en_US', {'name': 'voice1'}, {})
+    mock_language_tools.get_tts_audio('old people', 'Azure', 'en_US', {'name': 'voice1'}, {})
+    mock_language_tools.cloud_language_tools.translation_map = {'老人家': 'old people'}
+    mock_language_tools.get_translation('老人家', {'service': 'Azure', 'translation_key': 'zh to en'})
+
+    stats_str = mock_language_tools.get_cache_stats_str()
+    assert 'Translation cache</b>: entries: 1,' in stats_str
+    assert 'hit rate: 0% (hits: 0, misses: 1)' in stats_str
+    assert 'Audio cache</b>: files: 1,' in stats_str
+    assert 'hit rate: 50% (hits: 1, misses: 1)' in stats_str
+
+    # the audio cache can be cleared from the Tools menu
+    mock_language_tools.clean_user_files_audio()
+    assert mock_language_tools.get_audio_cache_stats()['entries'] == 0
+
 
 def test_get_translation(qtbot):
     # pytest test_languagetools.py -k test_get_translation
@@ -134,6 +169,80 @@ def test_get_translation(qtbot):
     translated_text = mock_language_tools.get_translation(source_text, {'translation_key': 'de to en'})
     assert translated_text == 'under something'
 
+def test_get_translation_cached(qtbot):
+    # pytest test_languagetools.py -k test_get_translation_cached
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+
+    translation_option = {'service': 'Azure', 'translation_key': 'zh to en'}
+    mock_language_tools.cloud_language_tools.translation_map = {
+        '老人家': 'old people'
+    }
+    assert mock_language_tools.get_translation('老人家', translation_option) == 'old people'
+    # second request gets served from the cache, the mock would raise a KeyError
+    mock_language_tools.cloud_language_tools.translation_map = {}
+    assert mock_language_tools.get_translation('老人家', translation_option) == 'old people'
+    assert mock_language_tools.get_translation_batch(['老人家'], translation_option) == [{'result': 'old people'}]
+    assert mock_language_tools.cloud_language_tools.batch_request_count == 0
+
+    stats = mock_language_tools.get_translation_cache_stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+
+    # errors don't get cached
+    mock_language_tools.cloud_language_tools.translation_error_map = {'坏': 'translation error 42'}
+    with pytest.raises(errors.LanguageToolsRequestError):
+        mock_language_tools.get_translation('坏', translation_option)
+    mock_language_tools.cloud_language_tools.translation_error_map = {}
+    mock_language_tools.cloud_language_tools.translation_map = {'坏': 'bad'}
+    assert mock_language_tools.get_translation('坏', translation_option) == 'bad'
+
+    assert mock_language_tools.get_translation_cache_services() == ['Azure']
+    mock_language_tools.invalidate_translation_cache('Azure')
+    assert mock_language_tools.get_translation_cache_services() == []
+    mock_language_tools.cloud_language_tools.translation_map = {'老人家': 'elderly'}
+    assert mock_language_tools.get_translation('老人家', translation_option) == 'elderly'
+
+    # all services
+    mock_language_tools.cloud_language_tools.translation_map = {'老人家': 'old people'}
+    assert mock_language_tools.get_translation('老人家', {'service': 'DeepL', 'translation_key': 'zh to en'}) == 'old people'
+    assert mock_language_tools.get_translation_cache_services() == ['Azure', 'DeepL']
+    mock_language_tools.invalidate_translation_cache(None)
+    assert mock_language_tools.get_translation_cache_services() == []
+
+def test_get_translation_single_flight(qtbot):
+    # pytest test_languagetools.py -k test_get_translation_single_flight
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+
+    translation_option = {'service': 'Azure', 'translation_key': 'zh to en'}
+    cloud_language_tools = mock_language_tools.cloud_language_tools
+    cloud_language_tools.translation_map = {'老人家': 'old people'}
+    release = threading.Event()
+    request_count = {'value': 0}
+    mock_get_translation = cloud_language_tools.get_translation
+    def slow_get_translation(source_text, translation_option):
+        request_count['value'] += 1
+        release.wait()
+        return mock_get_translation(source_text, translation_option)
+    cloud_language_tools.get_translation = slow_get_translation
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(mock_language_tools.get_translation('老人家', translation_option))) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    key = mock_language_tools.get_single_flight_key(constants.TransformationType.Translation, '老人家', translation_option)
+    while key not in mock_language_tools.single_flight.in_flight or mock_language_tools.single_flight.in_flight[key]['waiters'] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == ['old people'] * 4
+    assert request_count['value'] == 1
+
 def test_get_transliteration(qtbot):
     # pytest test_languagetools.py -k test_get_transliteration
 
@@ -148,6 +257,148 @@ def test_get_transliteration(qtbot):
     transliterated_text = mock_language_tools.get_transliteration(source_text, {'transliteration_key': 'de to en'})
     assert transliterated_text == 'ˈʊntɐ ˈɛtvas'
 
+def test_get_translation_batch(qtbot):
+    # pytest test_languagetools.py -k test_get_translation_batch
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+
+    mock_language_tools.cloud_language_tools.translation_map = {
+        '老人家': 'old people',
+        '你好': 'hello'
+    }
+    mock_language_tools.cloud_language_tools.translation_error_map = {
+        '坏': 'translation error 42'
+    }
+
+    results = mock_language_tools.get_translation_batch(['老人家', '', '坏', '你好'], {'translation_key': 'zh to en'})
+    assert mock_language_tools.cloud_language_tools.batch_request_count == 1
+    assert len(results) == 4
+    assert results[0] == {'result': 'old people'}
+    assert isinstance(results[1]['error'], errors.LanguageToolsValidationFieldEmpty)
+    assert str(results[2]['error']) == 'Could not load translation: translation error 42'
+    assert results[3] == {'result': 'hello'}
+
+    # large inputs get split into several requests
+    mock_language_tools.cloud_language_tools.batch_request_count = 0
+    source_text_list = [f'text {i}' for i in range(60)]
+    mock_language_tools.cloud_language_tools.translation_map = {x: f'translation {x}' for x in source_text_list}
+    results = mock_language_tools.get_translation_batch(source_text_list, {'translation_key': 'zh to en'})
+    assert mock_language_tools.cloud_language_tools.batch_request_count == 3
+    assert [x['result'] for x in results] == [f'translation {x}' for x in source_text_list]
+
+def test_get_transliteration_batch_fallback(qtbot):
+    # pytest test_languagetools.py -k test_get_transliteration_batch_fallback
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+
+    # server without batch endpoints, we should fall back to one request per text
+    mock_language_tools.cloud_language_tools.batch_api_available = False
+    mock_language_tools.cloud_language_tools.transliteration_map = {
+        '老人家': 'lǎorénjiā',
+        '你好': 'nǐhǎo'
+    }
+
+    results = mock_language_tools.get_transliteration_batch(['老人家', '你好'], {'transliteration_key': 'pinyin'})
+    assert results == [{'result': 'lǎorénjiā'}, {'result': 'nǐhǎo'}]
+    assert mock_language_tools.batch_api_supported[constants.TransformationType.Transliteration] == False
+
+def test_language_data_cache(qtbot):
+    # pytest test_languagetools.py -k test_language_data_cache
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    assert mock_language_tools.cloud_language_tools.language_data_request_count == 1
+    assert mock_language_tools.language_data_etag == 'language-data-1'
+
+    # next startup, the cached language data is available before the API key gets verified
+    anki_utils = testing_utils.MockAnkiUtils(config_gen.get_languagetools_config('default'))
+    cloud_language_tools = testing_utils.MockCloudLanguageTools()
+    cloud_language_tools.verify_api_key_is_valid = False
+    language_tools = languagetools.LanguageTools(anki_utils, deck_utils.DeckUtils(anki_utils), cloud_language_tools)
+    language_tools.initialize()
+    assert language_tools.language_data_etag == 'language-data-1'
+    assert language_tools.get_language_name('zh_cn') == 'Chinese'
+    assert cloud_language_tools.language_data_request_count == 0
+
+    # unchanged on the server, nothing to swap
+    cloud_language_tools = testing_utils.MockCloudLanguageTools()
+    language_tools = languagetools.LanguageTools(anki_utils, deck_utils.DeckUtils(anki_utils), cloud_language_tools)
+    language_tools.initialize()
+    assert cloud_language_tools.language_data_request_count == 1
+    assert language_tools.get_language_name('zh_cn') == 'Chinese'
+
+    # changed on the server, the new data replaces the cached one
+    cloud_language_tools = testing_utils.MockCloudLanguageTools()
+    cloud_language_tools.language_data_etag = 'language-data-2'
+    cloud_language_tools.language_data['language_list']['zh_cn'] = 'Chinese (Simplified)'
+    language_tools = languagetools.LanguageTools(anki_utils, deck_utils.DeckUtils(anki_utils), cloud_language_tools)
+    language_tools.initialize()
+    assert language_tools.language_data_etag == 'language-data-2'
+    assert language_tools.get_language_name('zh_cn') == 'Chinese (Simplified)'
+    with open(language_tools.get_language_data_cache_path(), 'r', encoding='utf-8') as f:
+        assert json.load(f)['etag'] == 'language-data-2'
+    language_tools.clear_language_data_cache()
+
+def test_ensure_api_key_checked(qtbot, monkeypatch):
+    # pytest test_languagetools.py -k test_ensure_api_key_checked
+    # goes through the real http client, against a local stand-in server
+    stand_in = testing_server.StandInServer().start()
+    monkeypatch.setenv(constants.ENV_VAR_ANKI_LANGUAGE_TOOLS_BASE_URL, stand_in.base_url)
+    monkeypatch.setenv(constants.ENV_VAR_ANKI_LANGUAGE_TOOLS_VOCABAI_BASE_URL, stand_in.base_url + '/vocab')
+    config_gen = testing_utils.TestConfigGenerator()
+    translation_option = {'service': 'Azure', 'source_language_id': 'fr', 'target_language_id': 'en'}
+
+    def build_language_tools(api_key):
+        anki_utils = testing_utils.MockAnkiUtils(config_gen.get_languagetools_config('default'))
+        language_tools = languagetools.LanguageTools(anki_utils, deck_utils.DeckUtils(anki_utils), cloudlanguagetools.CloudLanguageTools())
+        language_tools.config['api_key'] = api_key
+        return language_tools
+
+    try:
+        # no cached language data, the key gets verified before the dialogs open
+        language_tools = build_language_tools(stand_in.api_key)
+        language_tools.clear_language_data_cache()
+        language_tools.translation_cache.clear()
+        assert language_tools.ensure_api_key_checked() == True
+        assert stand_in.get_request_count('account') == 1
+        language_tools.shutdown()
+
+        # the next session: the key was verified during the last one, the requests work before it gets verified again
+        language_tools = build_language_tools(stand_in.api_key)
+        assert language_tools.load_cached_language_data() == True
+        assert language_tools.ensure_api_key_checked() == True
+        assert language_tools.get_translation('bonjour', translation_option) == 'translation of bonjour'
+        assert stand_in.get_request_count('account') == 1
+        language_tools.shutdown()
+
+        # the key in the config changed since the last session, it needs to be verified
+        language_tools = build_language_tools('other-api-key')
+        assert language_tools.load_cached_language_data() == True
+        assert language_tools.ensure_api_key_checked() == False
+        assert stand_in.get_request_count('account') == 3 # vocab api, then CLT api
+        assert 'Please enter API key' in language_tools.anki_utils.info_message_received
+        language_tools.shutdown()
+
+        # the key restored from the cache gets rejected by the server
+        language_tools = build_language_tools(stand_in.api_key)
+        assert language_tools.load_cached_language_data() == True
+        stand_in.api_key = 'new-stand-in-api-key'
+        language_tools.initialize()
+        assert language_tools.ensure_api_key_checked() == False
+        assert 'Please enter API key' in language_tools.anki_utils.info_message_received
+        language_tools.shutdown()
+
+        # no cached language data, and the key hasn't been verified, the dialogs can't be used
+        language_tools = build_language_tools('')
+        language_tools.clear_language_data_cache()
+        assert language_tools.ensure_api_key_checked() == False
+        assert 'Please enter API key' in language_tools.anki_utils.info_message_received
+        language_tools.shutdown()
+    finally:
+        stand_in.stop()
+
 def test_get_voice_for_field(qtbot):
     # pytest test_languagetools.py -k test_get_voice_for_field
 
@@ -170,4 +421,49 @@ def test_get_voice_for_field(qtbot):
     dntf = config_gen.get_dntf_chinese()
     
     testcase_instance = unittest.TestCase()
-    testcase_instance.assertRaises(errors.FieldLanguageMappingError, mock_language_tools.get_voice_for_field, dntf)
\ No newline at end of file
+    testcase_instance.assertRaises(errors.FieldLanguageMappingError, mock_language_tools.get_voice_for_field, dntf)
+
+def test_benchmark_language_data_indexes(qtbot):
+    # pytest test_languagetools.py -k test_benchmark_language_data_indexes -s
+    # roughly the size of the real payload: 150 languages, 10 translation services, 1500 voices
+    language_codes = [f'lang_{i}' for i in range(150)]
+    services = [f'service_{i}' for i in range(10)]
+    language_data = {
+        'language_list': {code: code for code in language_codes},
+        'translation_options': [{'service': service, 'language_code': code, 'language_id': code} for service in services for code in language_codes],
+        'transliteration_options': [{'service': service, 'language_code': code, 'transliteration_name': f'{code} {service}'} for service in services[:3] for code in language_codes],
+        'voice_list': [{'service': services[i % 10], 'language_code': language_codes[i % 150], 'voice_description': f'voice {i}'} for i in range(1500)],
+        'tokenization_options': [{'service': 'Spacy', 'language_code': code, 'tokenization_name': code} for code in language_codes]
+    }
+
+    config_gen = testing_utils.TestConfigGenerator()
+    mock_language_tools = config_gen.build_languagetools_instance('default')
+    mock_language_tools.set_language_data(language_data, 'benchmark')
+
+    # the previous implementation, linear scans over the full lists
+    def get_translation_options_linear(source_language, target_language):
+        translation_options = []
+        source_language_options = [x for x in language_data['translation_options'] if x['language_code'] == source_language]
+        for source_language_option in source_language_options:
+            service = source_language_option['service']
+            target_language_options = [x for x in language_data['translation_options'] if x['language_code'] == target_language and x['service'] == service]
+            if len(target_language_options) == 1:
+                translation_options.append(mock_language_tools.build_translation_option(service, source_language_option['language_id'], target_language_options[0]['language_id']))
+        return translation_options
+
+    def get_voices_linear(language):
+        return sorted([x for x in language_data['voice_list'] if x['language_code'] == language], key=lambda x: x['voice_description'])
+
+    language_pairs = [(language_codes[i], language_codes[(i * 7) % 150]) for i in range(150)]
+
+    start = time.perf_counter()
+    linear_results = [(get_translation_options_linear(s, t), get_voices_linear(s)) for s, t in language_pairs]
+    linear_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed_results = [(mock_language_tools.get_translation_options(s, t), mock_language_tools.get_voices_for_language(s)) for s, t in language_pairs]
+    indexed_time = time.perf_counter() - start
+
+    assert indexed_results == linear_results
+    # the timings depend on the machine, they're only printed
+    print(f'language data lookups: linear {linear_time * 1000:.1f}ms indexed {indexed_time * 1000:.1f}ms speedup {linear_time / indexed_time:.0f}x')
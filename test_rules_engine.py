@@ -0,0 +1,24 @@
+import constants
+import rules_engine
+
+def build_rule(from_field, to_field):
+    return {'type': constants.TransformationType.Translation, 'from_field': from_field, 'to_field': to_field,
+        'option': None, 'action': f'adding translation to field {to_field}'}
+
+def test_get_rule_stages(qtbot):
+    assert rules_engine.get_rule_stages([]) == []
+
+    # independent rules all run in the same stage
+    english = build_rule('Chinese', 'English')
+    pinyin = build_rule('Chinese', 'Pinyin')
+    assert rules_engine.get_rule_stages([english, pinyin]) == [[english, pinyin]]
+
+    # rules reading a field written by another rule run after it
+    french = build_rule('English', 'French')
+    sound = build_rule('French', 'Sound')
+    assert rules_engine.get_rule_stages([sound, french, pinyin, english]) == [[pinyin, english], [french], [sound]]
+
+    # circular rules run in the configured order
+    rule_1 = build_rule('A', 'B')
+    rule_2 = build_rule('B', 'A')
+    assert rules_engine.get_rule_stages([rule_1, rule_2]) == [[rule_1], [rule_2]]
@@ -1,3 +1,5 @@
+import time
+import random
 import text_utils
 import constants
 import testing_utils
@@ -20,6 +22,42 @@ def test_process(qtbot):
     assert utils.process('<b>hello</b> world', constants.TransformationType.Audio) == 'hello world'
     assert utils.process('<span style="color: var(--field-fg); background: var(--field-bg);">&nbsp;gerund</span>', constants.TransformationType.Audio) == 'gerund'
 
+def test_html_to_text_cache(qtbot, monkeypatch):
+    # pytest test_text_utils.py -rPP -k test_html_to_text_cache
+    anki_utils = testing_utils.MockAnkiUtils({})
+    stripped_list = []
+    html_to_text_line = anki_utils.html_to_text_line
+    def counting_html_to_text_line(html):
+        stripped_list.append(html)
+        return html_to_text_line(html)
+    anki_utils.html_to_text_line = counting_html_to_text_line
+    utils = text_utils.TextUtils(anki_utils, {'replacements': [
+        {'pattern': 'hello', 'replace': ' ', 'replace_type': 'simple'}
+    ]})
+
+    # the field value is checked, then processed for two transformations: stripped only once
+    assert utils.is_empty('<b>hello</b> world') == False
+    processed_text = utils.process('<b>hello</b> world', constants.TransformationType.Audio)
+    assert processed_text == '  world'
+    assert utils.is_processed_empty(processed_text) == False
+    assert utils.process('<b>hello</b> world', constants.TransformationType.Translation) == '  world'
+    assert stripped_list == ['<b>hello</b> world']
+
+    # the replacements can leave nothing
+    assert utils.is_processed_empty(utils.process('<b>hello</b>', constants.TransformationType.Audio)) == True
+
+    # bounded, least recently used values are stripped again
+    monkeypatch.setattr(constants, 'HTML_TO_TEXT_CACHE_SIZE', 2)
+    utils.is_empty('a')
+    utils.is_empty('b')
+    utils.is_empty('a')
+    utils.is_empty('c')
+    assert len(utils.html_to_text_cache) == 2
+    del stripped_list[:]
+    utils.is_empty('a')
+    utils.is_empty('b')
+    assert stripped_list == ['b']
+
 def test_replace(qtbot):
     utils = text_utils.TextUtils(testing_utils.MockAnkiUtils({}), {'replacements': [
         {'pattern': ' / ', 
@@ -119,4 +157,83 @@ def test_replacement_simple(qtbot):
     assert text_replacement.to_dict() == expected_dict
 
     text_replacement2 = text_utils.TextReplacement(expected_dict)
-    assert text_replacement2.process('yoyo)', constants.TransformationType.Audio) == 'rep'
\ No newline at end of file
+    assert text_replacement2.process('yoyo)', constants.TransformationType.Audio) == 'rep'
+
+
+def process_sequential(replacement_list, text, transformation_type):
+    # reference: every replacement applied one after the other
+    for replacement in replacement_list:
+        text = replacement.process(text, transformation_type)
+    return text
+
+def build_simple_replacement(pattern, replace, transformation_types=None):
+    options = {'pattern': pattern, 'replace': replace, 'replace_type': 'simple'}
+    if transformation_types != None:
+        for transformation_type in constants.TransformationType:
+            options[transformation_type.name] = transformation_type in transformation_types
+    return options
+
+def test_pipeline_fusion(qtbot):
+    replacements = [
+        build_simple_replacement('(m)', 'masc'),
+        build_simple_replacement('(f)', 'fem'),
+        build_simple_replacement('etw', 'etwas'),
+        # would match the output of the previous one
+        build_simple_replacement('was', 'WAS'),
+        {'pattern': r'\s+', 'replace': ' '},
+        build_simple_replacement('jdn', 'jemanden', [constants.TransformationType.Audio]),
+        build_simple_replacement('jdm', 'jemandem', [constants.TransformationType.Audio]),
+    ]
+    utils = text_utils.TextUtils(testing_utils.MockAnkiUtils({}), {'replacements': replacements})
+
+    audio_pipeline = utils.pipelines[constants.TransformationType.Audio]
+    assert [type(step).__name__ for step in audio_pipeline] == ['SimpleReplaceStep', 'SimpleReplaceStep', 'RegexReplaceStep', 'SimpleReplaceStep']
+    assert list(audio_pipeline[0].replace_map.keys()) == ['(m)', '(f)', 'etw']
+    assert list(audio_pipeline[1].replace_map.keys()) == ['was']
+    assert list(audio_pipeline[3].replace_map.keys()) == ['jdn', 'jdm']
+    assert len(utils.pipelines[constants.TransformationType.Translation]) == 3
+
+    text = 'Mann (m)  etw   für jdn, Frau (f) etw für jdm'
+    replacement_list = [text_utils.TextReplacement(replacement) for replacement in replacements]
+    for transformation_type in constants.TransformationType:
+        assert utils.process(text, transformation_type) == process_sequential(replacement_list, text, transformation_type)
+    assert utils.process(text, constants.TransformationType.Audio) == 'Mann masc etWAS für jemanden, Frau fem etWAS für jemandem'
+
+def test_pipeline_equivalence(qtbot):
+    # random simple replacements over a small alphabet, so that patterns overlap and chain all the time
+    rng = random.Random(42)
+    def random_string(min_length, max_length):
+        return ''.join([rng.choice('abc') for i in range(rng.randint(min_length, max_length))])
+    for i in range(300):
+        replacements = [build_simple_replacement(random_string(1, 3), random_string(0, 3)) for j in range(rng.randint(1, 6))]
+        utils = text_utils.TextUtils(testing_utils.MockAnkiUtils({}), {'replacements': replacements})
+        replacement_list = [text_utils.TextReplacement(replacement) for replacement in replacements]
+        text = random_string(0, 20)
+        assert utils.process(text, constants.TransformationType.Translation) == process_sequential(replacement_list, text, constants.TransformationType.Translation), replacements
+
+def test_benchmark_pipeline(qtbot):
+    # pytest test_text_utils.py -k test_benchmark_pipeline -s
+    anki_utils = testing_utils.MockAnkiUtils({})
+    text_list = [f'Satz {i}: der Mann (m) gibt jdm etw, die Frau (f) sieht jdn  an, wort{i % 50} / wort{(i * 7) % 50}' for i in range(500)]
+    for rule_count in [1, 10, 50, 100, 500]:
+        replacements = []
+        for i in range(rule_count):
+            if i % 10 == 9:
+                replacements.append({'pattern': f'wort{i}\\b', 'replace': f'Wort {i}'})
+            else:
+                replacements.append(build_simple_replacement(f'wort{i}', f'word {i}'))
+        utils = text_utils.TextUtils(anki_utils, {'replacements': replacements})
+        replacement_list = [text_utils.TextReplacement(replacement) for replacement in replacements]
+
+        start = time.perf_counter()
+        expected = [process_sequential(replacement_list, anki_utils.html_to_text_line(text), constants.TransformationType.Audio) for text in text_list]
+        sequential_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = [utils.process(text, constants.TransformationType.Audio) for text in text_list]
+        pipeline_time = time.perf_counter() - start
+
+        assert actual == expected
+        # the timings depend on the machine, they're only printed
+        print(f'{rule_count} rules, {len(text_list)} texts: sequential {sequential_time * 1000:.1f}ms pipeline {pipeline_time * 1000:.1f}ms ' +
+            f'steps: {len(utils.pipelines[constants.TransformationType.Audio])} speedup {sequential_time / pipeline_time:.1f}x')
@@ -0,0 +1,169 @@
+import json
+import hashlib
+import threading
+import http.server
+import logging
+
+# a local stand-in for the CloudLanguageTools API, used by tests which exercise
+# the real http client code (connection pooling, retries, bulk endpoints)
+
+class StandInRequestHandler(http.server.BaseHTTPRequestHandler):
+    # keep-alive requires HTTP/1.1 and a content-length on every response
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.stand_in.connection_count += 1
+
+    def log_message(self, format, *args):
+        logging.debug(f'stand-in server: {format % args}')
+
+    def send_json(self, status_code, data, headers=None):
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_bytes(self, status_code, content):
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def api_key_valid(self):
+        stand_in = self.server.stand_in
+        return self.headers.get('api_key') == stand_in.api_key or self.headers.get('Authorization') == f'Api-Key {stand_in.api_key}'
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        endpoint = self.path.split('/')[-1]
+        stand_in.record_request(endpoint, None)
+        if not self.api_key_valid():
+            self.send_json(401, {'error': 'invalid api key'})
+            return
+        if endpoint == 'account':
+            self.send_json(200, {'email': 'stand-in@vocab.ai', 'type': 'stand-in'})
+        elif endpoint in ['language_data', 'language_data_v1']:
+            etag = stand_in.get_language_data_etag()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_json(200, stand_in.language_data, headers={'ETag': etag})
+        else:
+            self.send_json(404, {'error': f'unknown endpoint {endpoint}'})
+
+    def do_POST(self):
+        stand_in = self.server.stand_in
+        endpoint = self.path.split('/')[-1]
+        data = self.read_json()
+        stand_in.record_request(endpoint, data)
+        if not self.api_key_valid():
+            self.send_json(401, {'error': 'invalid api key'})
+            return
+        retry_after = stand_in.get_throttle(endpoint)
+        if retry_after != None:
+            self.send_json(429, {'error': 'too many requests'}, headers={'Retry-After': retry_after})
+            return
+        if endpoint == 'translate':
+            self.send_json(200, {'translated_text': stand_in.translate(data['text'])})
+        elif endpoint == 'transliterate':
+            self.send_json(200, {'transliterated_text': stand_in.transliterate(data['text'])})
+        elif endpoint == 'translate_batch':
+            self.send_json(200, {'results': [{'translated_text': stand_in.translate(text)} for text in data['text_list']]})
+        elif endpoint == 'transliterate_batch':
+            self.send_json(200, {'results': [{'transliterated_text': stand_in.transliterate(text)} for text in data['text_list']]})
+        elif endpoint == 'detect':
+            self.send_json(200, {'detected_language': stand_in.detect(data['text_list'])})
+        elif endpoint in ['audio', 'audio_v2']:
+            self.send_bytes(200, stand_in.audio(data['text']))
+        else:
+            self.send_json(404, {'error': f'unknown endpoint {endpoint}'})
+
+
+class StandInServer():
+    def __init__(self, api_key='stand-in-api-key'):
+        self.api_key = api_key
+        self.connection_count = 0
+        self.requests = []
+        self.throttle_map = {}
+        self.lock = threading.Lock()
+        self.language_data = {
+            'language_list': {'en': 'English', 'fr': 'French'},
+            'translation_options': [],
+            'transliteration_options': [],
+            'voice_list': [],
+            'tokenization_options': []
+        }
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stand_in = self
+        self.base_url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get_language_data_etag(self):
+        return '"' + hashlib.sha224(json.dumps(self.language_data, sort_keys=True).encode('utf-8')).hexdigest() + '"'
+
+    def throttle(self, endpoint, count, retry_after='0'):
+        # the next count requests to this endpoint get a 429
+        with self.lock:
+            self.throttle_map[endpoint] = {'count': count, 'retry_after': retry_after}
+
+    def get_throttle(self, endpoint):
+        with self.lock:
+            throttle = self.throttle_map.get(endpoint)
+            if throttle == None or throttle['count'] == 0:
+                return None
+            throttle['count'] -= 1
+            return throttle['retry_after']
+
+    def record_request(self, endpoint, data):
+        with self.lock:
+            self.requests.append({'endpoint': endpoint, 'data': data})
+
+    def get_request_count(self, endpoint):
+        with self.lock:
+            return len([x for x in self.requests if x['endpoint'] == endpoint])
+
+    # deterministic fake results
+    # ==========================
+
+    def translate(self, text):
+        return f'translation of {text}'
+
+    def transliterate(self, text):
+        return f'transliteration of {text}'
+
+    def detect(self, text_list):
+        return 'fr'
+
+    def audio(self, text):
+        return f'audio of {text}'.encode('utf-8')
+
+    def configure_cloudlanguagetools(self, cloud_language_tools):
+        # point both the CLT and vocab api at the stand-in server, then validate the key
+        cloud_language_tools.clt_api_base_url = self.base_url
+        cloud_language_tools.vocab_api_base_url = self.base_url + '/vocab'
+        result = cloud_language_tools.api_key_validate_query(self.api_key)
+        assert result['key_valid'] == True
+        return cloud_language_tools
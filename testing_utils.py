@@ -1,6 +1,7 @@
 import logging
 import json
 import re
+import time
 
 import constants
 import deck_utils
@@ -22,6 +23,10 @@ class MockAnkiUtils():
         self.added_media_file = None
         self.show_loading_indicator_called = None
         self.hide_loading_indicator_called = None
+        self.get_note_by_id_count = 0
+        self.get_field_values_for_notes_count = 0
+        self.update_notes_calls = []
+        self.collection_key = 'collection.anki2'
 
         # exception handling
         self.last_exception = None
@@ -49,6 +54,9 @@ class MockAnkiUtils():
     def play_anki_sound_tag(self, text):
         self.last_played_sound_tag = text
 
+    def get_collection_key(self):
+        return self.collection_key
+
     def get_deckid_modelid_pairs(self):
         return self.deckid_modelid_pairs
 
@@ -59,8 +67,20 @@ class MockAnkiUtils():
         return note_id_list
 
     def get_note_by_id(self, note_id):
+        self.get_note_by_id_count += 1
         return self.notes_by_id[note_id]
 
+    def get_field_values_for_notes(self, note_id_list, field_name_list):
+        self.get_field_values_for_notes_count += 1
+        field_values = {}
+        for note_id in note_id_list:
+            if note_id not in self.notes_by_id:
+                # deleted notes are left out, like the notes table query does
+                continue
+            note = self.notes_by_id[note_id]
+            field_values[note_id] = {field_name: note[field_name] for field_name in field_name_list if field_name in note}
+        return field_values
+
 
     def get_model(self, model_id):
         # should return a dict which has flds
@@ -106,7 +126,8 @@ class MockAnkiUtils():
         self.critical_message_received = message
 
     def tooltip_message(self, message):
-        pass
+        logging.info(f'tooltip message: {message}')
+        self.tooltip_message_received = message
 
     def play_sound(self, filename):
         # load the json inside the file
@@ -156,6 +177,11 @@ class MockAnkiUtils():
         # even though we don't call note.flush anymore, some of the tests expect this
         note.flush()
 
+    def update_notes(self, notes):
+        self.update_notes_calls.append(len(notes))
+        for note in notes:
+            note.flush()
+
     def reset_exceptions(self):
         self.last_exception = None
         self.last_action = None
@@ -187,15 +213,28 @@ class MockCloudLanguageTools():
         self.verify_api_key_called = False
         self.verify_api_key_input = None
         self.verify_api_key_is_valid = True
+        self.api_key = None
+        self.use_vocabai_api = None
 
         self.account_info_called = False
+        self.close_called = False
 
         # used to simulate translation errors
         self.translation_error_map = {}
 
+        # simulates the latency of audio downloads
+        self.tts_audio_delay = 0
+
         # unhandled exceptions
         self.translation_unhandled_exception_map = {}
 
+        # used to simulate a server which doesn't have the batch endpoints
+        self.batch_api_available = True
+
+        # retries / throttling reported by the request scheduler
+        self.request_stats = {'retries': 0, 'throttled': 0}
+        self.batch_request_count = 0
+
         self.language_data = {
             'language_list': {
                 'en': 'English',
@@ -352,6 +391,9 @@ class MockCloudLanguageTools():
             ]
         }
 
+        self.language_data_etag = 'language-data-1'
+        self.language_data_request_count = 0
+
         self.language_list = self.language_data['language_list']
         self.translation_language_list = self.language_data['translation_options']
         self.transliteration_language_list = self.language_data['transliteration_options']
@@ -360,6 +402,12 @@ class MockCloudLanguageTools():
     def get_language_data(self):
         return self.language_data
 
+    def get_language_data_conditional(self, etag):
+        self.language_data_request_count += 1
+        if etag == self.language_data_etag:
+            return None
+        return self.language_data, self.language_data_etag
+
     def get_language_list(self):
         return self.language_list
 
@@ -370,12 +418,29 @@ class MockCloudLanguageTools():
         return self.transliteration_language_list
 
     def api_key_set(self):
-        return self.verify_api_key_called and self.verify_api_key_is_valid
+        return self.api_key != None
+
+    def set_api_key(self, api_key, use_vocabai_api):
+        self.api_key = api_key
+        self.use_vocabai_api = use_vocabai_api
+
+    def clear_api_key(self):
+        self.api_key = None
+        self.use_vocabai_api = None
+
+    def close(self):
+        self.close_called = True
+
+    def get_request_stats(self):
+        return dict(self.request_stats)
 
     def api_key_validate_query(self, api_key):
 
         self.verify_api_key_called = True
         self.verify_api_key_input = api_key
+        if self.verify_api_key_is_valid:
+            self.api_key = api_key
+            self.use_vocabai_api = True
 
         return {
             'key_valid': self.verify_api_key_is_valid,
@@ -396,6 +461,8 @@ class MockCloudLanguageTools():
         return self.language_detection_result[field_sample[0]]
 
     def get_tts_audio(self, source_text, service, language_code, voice_key, options):
+        if self.tts_audio_delay > 0:
+            time.sleep(self.tts_audio_delay)
         self.requested_audio = {
             'text': source_text,
             'service': service,
@@ -422,6 +489,25 @@ class MockCloudLanguageTools():
         transliterated_text = self.transliteration_map[source_text]
         return MockTranslationResponse(200, {'transliterated_text': transliterated_text})
 
+    def get_translation_batch(self, source_text_list, translation_option):
+        if not self.batch_api_available:
+            return MockTranslationResponse(404, {'error': 'not found'})
+        self.batch_request_count += 1
+        results = []
+        for source_text in source_text_list:
+            if source_text in self.translation_error_map:
+                results.append({'error': self.translation_error_map[source_text]})
+            else:
+                results.append({'translated_text': self.translation_map[source_text]})
+        return MockTranslationResponse(200, {'results': results})
+
+    def get_transliteration_batch(self, source_text_list, transliteration_option):
+        if not self.batch_api_available:
+            return MockTranslationResponse(404, {'error': 'not found'})
+        self.batch_request_count += 1
+        results = [{'transliterated_text': self.transliteration_map[source_text]} for source_text in source_text_list]
+        return MockTranslationResponse(200, {'results': results})
+
     def get_breakdown(self, source_text, tokenization_option, translation_option, transliteration_option):
         breakdown_response = self.breakdown_map[source_text]
         return MockBreakdownResponse(200, {'breakdown': breakdown_response})
@@ -724,8 +810,11 @@ class TestConfigGenerator():
         anki_utils = MockAnkiUtils(languagetools_config)
         deckutils = deck_utils.DeckUtils(anki_utils)
         mock_language_tools = languagetools.LanguageTools(anki_utils, deckutils, mock_cloudlanguagetools)
+        mock_language_tools.clear_language_data_cache()
         mock_language_tools.initialize()
         mock_language_tools.clean_user_files_audio()
+        mock_language_tools.translation_cache.clear()
+        mock_language_tools.job_journal.clear()
 
         anki_utils.models = self.get_model_map()
         anki_utils.decks = self.get_deck_map()
@@ -735,4 +824,15 @@ class TestConfigGenerator():
         anki_utils.notes_by_id, anki_utils.notes = self.get_notes()
         mock_cloudlanguagetools.language_detection_result = self.get_language_detection_result()
 
-        return mock_language_tools
\ No newline at end of file
+        return mock_language_tools
+class DuplicateTextConfigGenerator(TestConfigGenerator):
+    # a fourth note, with the same text as the second one by default
+    def __init__(self, chinese_text='你好'):
+        TestConfigGenerator.__init__(self)
+        self.note_id_4 = 45005
+        self.notes_by_id[self.note_id_4] = MockNote(self.note_id_4, self.model_id, {
+            self.field_chinese: chinese_text,
+            self.field_english: '',
+            self.field_sound: '',
+            self.field_pinyin: ''
+        }, self.all_fields)
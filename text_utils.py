@@ -2,6 +2,8 @@ import sys
 import logging
 import anki.utils
 import re
+import threading
+import collections
 
 if hasattr(sys, '_pytest_mode'):
     import constants
@@ -52,22 +54,123 @@ class TextReplacement():
                     logging.error(f'error while processing regular expression {self.pattern} / {self.replace}: {e}')
         return result
 
+def strings_overlap(a, b):
+    # whether a and b can match overlapping parts of a text: one contains the other,
+    # or the end of one is the start of the other
+    if a in b or b in a:
+        return True
+    for i in range(1, min(len(a), len(b))):
+        if a.endswith(b[:i]) or b.endswith(a[:i]):
+            return True
+    return False
+
+class RegexReplaceStep():
+    def __init__(self, replacement):
+        self.pattern = replacement.pattern
+        self.replace = replacement.replace
+        self.compiled_pattern = re.compile(replacement.pattern)
+
+    def process(self, text):
+        try:
+            return self.compiled_pattern.sub(self.replace, text)
+        except Exception as e:
+            logging.error(f'error while processing regular expression {self.pattern} / {self.replace}: {e}')
+            return text
+
+class SimpleReplaceStep():
+    # consecutive simple replacements, applied in a single pass over the text. only replacements which
+    # can't interact are grouped: their patterns don't overlap each other, nor the replacement text of
+    # the replacements before them, so the result is the same as applying them one after the other.
+    def __init__(self, replacement):
+        self.replace_map = {replacement.pattern: replacement.replace}
+        self.compiled_pattern = None
+
+    def can_add(self, replacement):
+        if len(replacement.pattern) == 0:
+            return False
+        for pattern, replace in self.replace_map.items():
+            if len(pattern) == 0 or strings_overlap(pattern, replacement.pattern) or strings_overlap(replace, replacement.pattern):
+                return False
+        return True
+
+    def add(self, replacement):
+        self.replace_map[replacement.pattern] = replacement.replace
+
+    def compile(self):
+        if len(self.replace_map) > 1:
+            self.compiled_pattern = re.compile('|'.join([re.escape(pattern) for pattern in self.replace_map.keys()]))
+
+    def process(self, text):
+        if self.compiled_pattern == None:
+            for pattern, replace in self.replace_map.items():
+                text = text.replace(pattern, replace)
+            return text
+        return self.compiled_pattern.sub(lambda match: self.replace_map[match.group(0)], text)
+
+def compile_pipeline(replacements, transformation_type):
+    # the replacements enabled for transformation_type, as a list of steps
+    steps = []
+    for replacement in replacements:
+        if not replacement.transformation_type_map[transformation_type]:
+            continue
+        if replacement.pattern == None or replacement.replace == None:
+            continue
+        if replacement.replace_type == constants.ReplaceType.simple:
+            if len(steps) > 0 and isinstance(steps[-1], SimpleReplaceStep) and steps[-1].can_add(replacement):
+                steps[-1].add(replacement)
+            else:
+                steps.append(SimpleReplaceStep(replacement))
+        elif replacement.replace_type == constants.ReplaceType.regex:
+            try:
+                steps.append(RegexReplaceStep(replacement))
+            except Exception as e:
+                logging.error(f'error while processing regular expression {replacement.pattern} / {replacement.replace}: {e}')
+        else:
+            logging.error(f'unsupported replacement type: {replacement.replace_type}')
+    for step in steps:
+        if isinstance(step, SimpleReplaceStep):
+            step.compile()
+    return steps
+
 class TextUtils():
     def __init__(self, anki_utils, options):
         self.anki_utils = anki_utils
         self.options = options
         replacements_array = self.options.get('replacements', [])
         self.replacements = [TextReplacement(replacement) for replacement in replacements_array]
+        # the replacements get compiled once, changes to self.replacements only apply to a new TextUtils
+        self.pipelines = {transformation_type: compile_pipeline(self.replacements, transformation_type) for transformation_type in constants.TransformationType}
+        # field value -> html stripped text, least recently used first. used from the batch worker threads
+        self.html_to_text_cache = collections.OrderedDict()
+        self.html_to_text_cache_lock = threading.Lock()
+
+    def html_to_text_line(self, text):
+        with self.html_to_text_cache_lock:
+            stripped_text = self.html_to_text_cache.get(text)
+            if stripped_text != None:
+                self.html_to_text_cache.move_to_end(text)
+                return stripped_text
+        stripped_text = self.anki_utils.html_to_text_line(text)
+        with self.html_to_text_cache_lock:
+            self.html_to_text_cache[text] = stripped_text
+            if len(self.html_to_text_cache) > constants.HTML_TO_TEXT_CACHE_SIZE:
+                self.html_to_text_cache.popitem(last=False)
+        return stripped_text
 
     def is_empty(self, text):
-        stripped_field_value = self.anki_utils.html_to_text_line(text)
+        # text is a field value
+        stripped_field_value = self.html_to_text_line(text)
         return len(stripped_field_value) == 0
 
+    def is_processed_empty(self, processed_text):
+        # processed_text is the output of process, the html has already been stripped
+        return len(processed_text.strip()) == 0
+
     def process(self, text, transformation_type: constants.TransformationType):
-        result = self.anki_utils.html_to_text_line(text)
+        result = self.html_to_text_line(text)
 
         # apply replacements
-        for replacement in self.replacements:
-            result = replacement.process(result, transformation_type)
+        for step in self.pipelines[transformation_type]:
+            result = step.process(result)
 
-        return result
\ No newline at end of file
+        return result